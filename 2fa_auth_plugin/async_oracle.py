@@ -0,0 +1,125 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" asyncio variant of the TOTPOracle read path, on top of aiohttp.
+
+Used by the async TOTP panel views under ASGI. States of several users are
+fetched concurrently over one connection pool per event loop. Writes
+(enable, disable) stay on the synchronous TOTPOracle, as does the auth
+backend. Needs aiohttp, which is optional.
+"""
+
+import asyncio
+import logging
+import weakref
+from urllib.parse import quote
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from openstack_dashboard.auth import service_auth
+from openstack_dashboard.auth.exception import IllegalArgument, TOTPRuntimeError
+from openstack_dashboard.auth.session_pool import POOL_SIZE
+from openstack_dashboard.auth.totp_oracle import ORACLE_CALLS, PHASES, TOTPUserState, cache_state, cached_state, validate_state
+
+LOG = logging.getLogger(__name__)
+
+# event loop -> shared aiohttp session
+_SESSIONS = weakref.WeakKeyDictionary()
+
+
+# get (or create) the aiohttp session of the running event loop
+def get_http_session():
+    if aiohttp is None:
+        raise TOTPRuntimeError("[AsyncTOTPOracle]: aiohttp is required for the async TOTP oracle")
+
+    loop = asyncio.get_running_loop()
+    http_session = _SESSIONS.get(loop)
+    if http_session is None or http_session.closed:
+        LOG.debug("[TOTP] creating async keystone connection pool (size %d)" % POOL_SIZE)
+        http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=POOL_SIZE),
+                                             raise_for_status=False)
+        _SESSIONS[loop] = http_session
+    return http_session
+
+
+# close the session of the running event loop, e.g. on ASGI shutdown
+async def close():
+    http_session = _SESSIONS.pop(asyncio.get_running_loop(), None)
+    if http_session is not None:
+        await http_session.close()
+
+
+class AsyncTOTPOracle(object):
+    def __init__(self, auth_url=None, user_data=None, service=False):
+        if service and not service_auth.enabled():
+            raise TOTPRuntimeError("[AsyncTOTPOracle.__init__()]: Missing TOTP_SERVICE_AUTH in Horizon local_settings")
+        if not (service or user_data):
+            raise IllegalArgument("[AsyncTOTPOracle.__init__()]: Either a logged in user or the service account is required")
+        if not auth_url:
+            raise TOTPRuntimeError("[AsyncTOTPOracle.__init__()]: Missing keystone auth url")
+
+        self.__auth_url = auth_url.rstrip('/')
+        # reads use the service account when configured, like TOTPOracle
+        self.__service = service or service_auth.enabled()
+        self.__token = None if self.__service else user_data.token.id
+        self.__states = {}
+
+    async def __get_token(self):
+        if not self.__service:
+            return self.__token
+        # the service token of this process is in memory almost always
+        loop = asyncio.get_running_loop()
+        auth_ref = await loop.run_in_executor(None, service_auth.get_access_info)
+        return auth_ref.auth_token
+
+    # raw keystone user document
+    async def user_get(self, user_id):
+        headers = {"X-Auth-Token": await self.__get_token(), "Accept": "application/json"}
+        url = "%s/users/%s" % (self.__auth_url, quote(user_id, safe=''))
+        ORACLE_CALLS.incr("user_get")
+        with PHASES.time("user_get"):
+            async with get_http_session().get(url, headers=headers) as resp:
+                if resp.status != 200:
+                    raise TOTPRuntimeError("[AsyncTOTPOracle.user_get()]: keystone returned %d for user %s" % (resp.status, user_id))
+                body = await resp.json()
+        return body["user"]
+
+    # same lookup order as TOTPOracle.user_get_state: oracle, state cache, keystone
+    async def user_get_state(self, user_id):
+        state = self.__states.get(user_id)
+        if state is not None:
+            return state
+
+        state = cached_state(user_id)
+        if state is None:
+            state = TOTPUserState.from_dict(await self.user_get(user_id))
+            cache_state(state)
+
+        self.__states[user_id] = state
+        return state
+
+    # states of several users, fetched concurrently. Returns user id -> state.
+    async def user_get_states(self, user_ids, concurrency=POOL_SIZE):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(user_id):
+            async with semaphore:
+                return await self.user_get_state(user_id)
+
+        states = await asyncio.gather(*[fetch(user_id) for user_id in user_ids])
+        return dict((state.user_id, state) for state in states)
+
+    async def validate(self, user_id, otp=None, replay=None):
+        return validate_state(await self.user_get_state(user_id), otp=otp, replay=replay)
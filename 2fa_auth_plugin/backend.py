@@ -17,18 +17,68 @@
 """ Module defining the Django auth backend class for the Two Factor API. """
 
 import logging
+import random
+import threading
+import time
 from urllib.parse import urljoin
 
+from django.utils.translation import ugettext_lazy as _
 from openstack_auth import backend
 from openstack_auth import exceptions
+from openstack_auth import utils
 
-from openstack_dashboard.auth.totp_oracle import TOTPOracle
+from openstack_dashboard.auth import preauth
+from openstack_dashboard.auth import ratelimit
+from openstack_dashboard.auth import seed_store
+from openstack_dashboard.auth import service_auth
+from openstack_dashboard.auth import stats
+from openstack_dashboard.auth.replay import REPLAY_REGISTRY
+from openstack_dashboard.auth.totp_oracle import TOTPOracle, cached_state, local_state, precheck_state
 from openstack_dashboard import settings
 
 LOG = logging.getLogger(__name__)
 
+# check the otp before the keystone password auth when the user's seed is known locally
+OTP_FIRST = getattr(settings, "TOTP_OTP_FIRST", False)
+# delay early rejections to the usual keystone auth latency, so that they cannot be told apart
+OTP_FIRST_PAD = getattr(settings, "TOTP_OTP_FIRST_PAD", True)
+
+INVALID_OTP_MESSAGE = "[OTP Keystone Backend] - Invalid otp token, user not authenticated."
+# what openstack_auth reports when keystone refuses the password
+INVALID_CREDENTIALS_MESSAGE = _("Invalid credentials.")
+
+# keystone password auths per login mode, and login outcomes
+KEYSTONE_CALLS = stats.counters("keystone_password_auth")
+LOGINS = stats.counters("login")
+# latency of each login phase
+PHASES = stats.histograms("login_phase")
+
 KEYSTONE_CLIENT_ATTR = "_keystoneclient"
 
+
+# moving average of the successful keystone password auth latency
+class LatencyEstimate(object):
+    def __init__(self, weight=0.1):
+        self.weight = weight
+        self.value = None
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            if self.value is None:
+                self.value = seconds
+            else:
+                self.value += self.weight * (seconds - self.value)
+
+
+KEYSTONE_LATENCY = LatencyEstimate()
+
+
+# otp rejected by the OTP-first check, before any keystone password auth.
+# Reported like a wrong password: the password has not been checked yet.
+class OTPRejectedEarly(exceptions.KeystoneCredentialsException):
+    pass
+
 # get authentication url from django's own configuration
 def get_auth_url():
     auth_url = getattr(settings, 'OPENSTACK_KEYSTONE_URL')
@@ -37,43 +87,194 @@ def get_auth_url():
 
 # authentication backend custom provider class
 # this overrides the default in settings.py
+#
+# The login mode is decided once, up front:
+# - an explicit otp (login form with a separate OTP field): full password + otp
+# - the user's state read with the service account, when configured
+# - a cached "2FA enabled" hint: password minus the last six chars + otp, or full password
+# - no hint yet: legacy try-then-retry, after which the hint is learned
+# Clients with too many failed attempts are refused before any keystone call.
+# With TOTP_OTP_FIRST, the otp of a user whose seed is known (service account lookup,
+# or hint and state cache) is checked before the keystone password auth.
 class TwoFactorAuthBackend(backend.KeystoneBackend):
-    def authenticate(self, request=None, username=None, password=None, user_domain_name=None, project_domain_name=None, auth_url=None):
-        # try authentication with otp....
+    # single keystone password auth, accounted per login mode
+    def _keystone_authenticate(self, mode, **kwargs):
+        KEYSTONE_CALLS.incr(mode)
+        start = time.perf_counter()
+        try:
+            with PHASES.time("keystone_%s" % mode):
+                user = super(TwoFactorAuthBackend, self).authenticate(**kwargs)
+        except Exception:
+            KEYSTONE_CALLS.incr("%s_failed" % mode)
+            raise
+        KEYSTONE_LATENCY.observe(time.perf_counter() - start)
+        return user
+
+    # TOTP state known without asking keystone, from the hint's user id and
+    # the local seed store or the state cache
+    def _known_state(self, user_id):
+        if not OTP_FIRST or user_id is None:
+            return None
+        if seed_store.SEED_STORE.local:
+            return local_state(user_id)
+        return cached_state(user_id)
+
+    # OTP-first: with the seed known, a wrong, malformed or already used code is rejected
+    # before keystone spends a password hash on it. Same error as a wrong password,
+    # delayed to the same latency, so that it tells nothing about the enrollment or
+    # the code to a client who does not know the password. Nothing is claimed here.
+    def _precheck_otp(self, state, otp, limit_key, client_ip, username):
+        if not OTP_FIRST or state is None or not state.enabled:
+            return
+        start = time.perf_counter()
+        with PHASES.time("otp_first"):
+            valid = precheck_state(state, otp, replay=REPLAY_REGISTRY)
+        if valid:
+            LOGINS.incr("otp_first_passed")
+            return
+
+        LOG.info("[OTP Preauth Phase - TOTP] - Token invalid or expired for user [%s] (checked before keystone)" % username)
+        ratelimit.record_failure(limit_key, client_ip)
+        LOGINS.incr("otp_rejected")
+        LOGINS.incr("otp_first_rejected")
+        if OTP_FIRST_PAD and KEYSTONE_LATENCY.value:
+            delay = KEYSTONE_LATENCY.value * random.uniform(0.9, 1.1) - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        raise OTPRejectedEarly(INVALID_CREDENTIALS_MESSAGE)
+
+    def authenticate(self, request=None, username=None, password=None, user_domain_name=None, project_domain_name=None, auth_url=None, otp=None):
+        with PHASES.time("total"):
+            return self._authenticate(request=request,
+                                      username=username,
+                                      password=password,
+                                      user_domain_name=user_domain_name,
+                                      project_domain_name=project_domain_name,
+                                      auth_url=auth_url,
+                                      otp=otp)
+
+    def _authenticate(self, request, username, password, user_domain_name, project_domain_name, auth_url, otp):
+        ks_args = dict(request=request,
+                       username=username,
+                       user_domain_name=user_domain_name,
+                       project_domain_name=project_domain_name,
+                       auth_url=auth_url)
+        oracle = None
+        source = None
+        hint = None
+
+        # refuse brute-forcing clients before any keystone call
+        limit_key = ratelimit.user_key(username, user_domain_name)
+        client_ip = utils.get_client_ip(request) if request is not None else None
+        with PHASES.time("ratelimit"):
+            allowed = ratelimit.check(limit_key, client_ip)
+        if not allowed:
+            LOG.info('[OTP Preauth Phase - Ratelimit] - Too many failed attempts for user [%s] from [%s]' % (username, client_ip))
+            LOGINS.incr("rate_limited")
+            raise exceptions.KeystoneAuthException("[OTP Keystone Backend] - Too many failed login attempts, retry later.")
+
         try:
-            # last six digits is the OTP token
-            otp = password[-6::]
-            # authenticate with user/pass, with pass being the password from the login page
-            # minus the last six characters
-            user = super(TwoFactorAuthBackend, self).authenticate(request=request,
-                                                               username=username,
-                                                               password=password[:-6:],
-                                                               user_domain_name=user_domain_name,
-                                                               project_domain_name=project_domain_name,
-                                                               auth_url=auth_url)
-            LOG.info('[OTP Preauth Phase - Keystone] - User [%s] authenticated on keystone (with correct-sized otp token)' % username)
-        # or fallback to normal keystone username/pass combo
-        except:
-            # no otp now...
-            otp = None
-
-            # authenticate on keystone
-            user = super(TwoFactorAuthBackend, self).authenticate(request=request,
-                                                               username=username,
-                                                               password=password,
-                                                               user_domain_name=user_domain_name,
-                                                               project_domain_name=project_domain_name,
-                                                               auth_url=auth_url)
-            LOG.info('[OTP Preauth Phase - Keystone] - User [%s] authenticated on keystone (without otp token or no otp)' % username)
+            if otp is not None:
+                # the otp comes in its own form field
+                if OTP_FIRST:
+                    self._precheck_otp(self._known_state(preauth.lookup(username, user_domain_name)[1]),
+                                       otp, limit_key, client_ip, username)
+                user = self._keystone_authenticate("split", password=password, **ks_args)
+                LOG.info('[OTP Preauth Phase - Keystone] - User [%s] authenticated on keystone (separate otp field)' % username)
+            else:
+                # the service account can tell up front whether the user is enrolled...
+                oracle, state = self._lookup_enrollment(username, user_domain_name)
+                source = "lookup"
+                if state is None:
+                    # ...otherwise use the hint learned at the last login
+                    hint, hint_user_id = preauth.lookup(username, user_domain_name)
+                    enrolled = hint
+                    source = "hinted"
+                    if enrolled:
+                        state = self._known_state(hint_user_id)
+                else:
+                    enrolled = state.enabled
+
+                if enrolled is True:
+                    # last six digits is the OTP token
+                    otp = password[-6::]
+                    self._precheck_otp(state, otp, limit_key, client_ip, username)
+                    user = self._keystone_authenticate("%s_otp" % source, password=password[:-6:], **ks_args)
+                    LOG.info('[OTP Preauth Phase - Keystone] - User [%s] authenticated on keystone (%s: otp enabled)' % (username, source))
+                elif enrolled is False:
+                    user = self._keystone_authenticate("%s_plain" % source, password=password, **ks_args)
+                    LOG.info('[OTP Preauth Phase - Keystone] - User [%s] authenticated on keystone (%s: otp disabled)' % (username, source))
+                else:
+                    otp, user = self._legacy_preauth(password, ks_args)
+        except OTPRejectedEarly:
+            raise
+        except Exception:
+            # a stale hint must not lock the user out: next attempt goes through the legacy path.
+            # The hint may not have been forgotten where it is read (per-process cache,
+            # TOTP changed through another worker or totp_disable).
+            if hint is not None:
+                preauth.drop_hint(username, user_domain_name)
+            ratelimit.record_failure(limit_key, client_ip)
+            LOGINS.incr("keystone_rejected")
+            raise
 
         # verify the authentication token if applicable
         try:
-            oracle = TOTPOracle(auth_url=get_auth_url(), user_data=user)
-            if not oracle.validate(user.id, otp=otp):
+            if oracle is None:
+                oracle = TOTPOracle(auth_url=get_auth_url(), user_data=user)
+            with PHASES.time("validate"):
+                valid = oracle.validate(user.id, otp=otp, replay=REPLAY_REGISTRY)
+            if not valid:
                 LOG.info("[OTP Postauth Phase - TOTP] - Token invalid or expired for user [%s] " % username)
-                raise exceptions.KeystoneAuthException("[OTP Keystone Backend] - Invalid otp token, user not authenticated.")
+                raise exceptions.KeystoneAuthException(INVALID_OTP_MESSAGE)
 
             LOG.info("[OTP Postauth Phase - TOTP] - Token for user [%s] is valid: Authentication Complete" % username)
-            return user
         except Exception as e:
+            ratelimit.record_failure(limit_key, client_ip)
+            LOGINS.incr("otp_rejected")
             raise exceptions.KeystoneAuthException(e)
+
+        # remember how this user logs in
+        enrolled = otp is not None
+        if source != "lookup" and hint is not enrolled:
+            preauth.set_hint(username, user_domain_name, user.id, enrolled)
+        ratelimit.record_success(limit_key, client_ip)
+        LOGINS.incr("success")
+        return user
+
+    # authoritative enrollment state read with the service account, if configured.
+    # Returns the oracle holding the state and the TOTPUserState, or None, None.
+    def _lookup_enrollment(self, username, user_domain_name):
+        if not service_auth.enabled():
+            return None, None
+        try:
+            with PHASES.time("lookup"):
+                oracle = TOTPOracle(auth_url=get_auth_url(), service=True)
+                state = oracle.user_find_state(username, user_domain_name)
+        except Exception as e:
+            LOG.warning('[OTP Preauth Phase - Lookup] - Service account lookup failed for user [%s]: %s' % (username, e))
+            return None, None
+        if state is None:
+            return None, None
+        return oracle, state
+
+    # try authentication with otp, or fallback to normal keystone username/pass combo
+    def _legacy_preauth(self, password, ks_args):
+        username = ks_args.get('username')
+        # a password shorter than an otp cannot carry one
+        if password and len(password) > 6:
+            try:
+                # last six digits is the OTP token
+                otp = password[-6::]
+                # authenticate with user/pass, with pass being the password from the login page
+                # minus the last six characters
+                user = self._keystone_authenticate("preauth_otp", password=password[:-6:], **ks_args)
+                LOG.info('[OTP Preauth Phase - Keystone] - User [%s] authenticated on keystone (with correct-sized otp token)' % username)
+                return otp, user
+            except Exception:
+                pass
+
+        # no otp now... authenticate on keystone
+        user = self._keystone_authenticate("fallback", password=password, **ks_args)
+        LOG.info('[OTP Preauth Phase - Keystone] - User [%s] authenticated on keystone (without otp token or no otp)' % username)
+        return None, user
@@ -0,0 +1,48 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Prometheus scrape endpoint, protected by a bearer token instead of a Horizon login.
+
+The panel's metrics view needs a cloud admin session, which a scraper does not
+have. This view is routed outside of the dashboards, in openstack_dashboard's
+urls.py, and only answers requests that carry TOTP_METRICS_TOKEN in an
+"Authorization: Bearer" header. Without a token configured it does not exist.
+"""
+
+import hmac
+
+from django.http import Http404, HttpResponse
+
+from openstack_dashboard import settings
+from openstack_dashboard.auth import stats
+
+# bearer token of the scraper, "" disables the endpoint
+METRICS_TOKEN = getattr(settings, "TOTP_METRICS_TOKEN", "")
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _authorized(request):
+    scheme, _, token = request.META.get("HTTP_AUTHORIZATION", "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode('utf-8'),
+                                                              METRICS_TOKEN.encode('utf-8'))
+
+
+# metrics of this horizon process, for the scraper holding the token
+def scrape(request):
+    if not METRICS_TOKEN:
+        raise Http404
+    if not _authorized(request):
+        response = HttpResponse("Unauthorized", status=401, content_type="text/plain")
+        response["WWW-Authenticate"] = 'Bearer realm="totp-metrics"'
+        return response
+    return HttpResponse(stats.render_prometheus(), content_type=CONTENT_TYPE)
@@ -0,0 +1,220 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Server-side store of pending TOTP enrollments.
+
+A user has at most one in-flight seed, kept here until the activation form is
+submitted or TOTP_PENDING_TTL expires. Pages and forms only see an opaque
+handle, which is resolved back to the seed for the same user only. Reopening
+the activation modal finds the pending enrollment and does not generate a new
+seed; its email is only queued again if no delivery of it went through. The
+django and sqlite backends store the seed encrypted with the seed keys
+(TOTP_SEED_KEYS), like the seed store.
+"""
+
+import hmac
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from django.core.cache import cache
+
+from openstack_dashboard import settings
+from openstack_dashboard.auth import seed_crypto
+from openstack_dashboard.auth import stats
+from openstack_dashboard.auth.exception import TOTPRuntimeError
+
+# "django" (shared django cache), "sqlite" (local file, shared by the workers of a host) or "local"
+PENDING_BACKEND = getattr(settings, "TOTP_PENDING_BACKEND", "django")
+PENDING_TTL = getattr(settings, "TOTP_PENDING_TTL", 900)
+PENDING_SQLITE_PATH = getattr(settings, "TOTP_PENDING_SQLITE_PATH", "/var/lib/openstack-dashboard/totp_pending.sqlite")
+
+KEY_PREFIX = "totp-pending:"
+
+COUNTERS = stats.counters("pending_enrollment")
+
+
+class PendingEnrollment(object):
+    __slots__ = ("user_id", "seed", "handle", "expires_at")
+
+    def __init__(self, user_id, seed, handle, expires_at):
+        self.user_id = user_id
+        self.seed = seed
+        self.handle = handle
+        self.expires_at = expires_at
+
+    @classmethod
+    def new(cls, user_id, seed, ttl):
+        return cls(user_id, seed, secrets.token_urlsafe(18), time.time() + ttl)
+
+    def matches(self, handle):
+        return bool(handle) and time.time() < self.expires_at and hmac.compare_digest(self.handle, str(handle))
+
+    # (stored seed, handle, expires_at), the seed encrypted when seed keys are configured
+    def stored(self):
+        return seed_crypto.encrypt_seed(self.user_id, self.seed), self.handle, self.expires_at
+
+    @classmethod
+    def from_stored(cls, user_id, seed, handle, expires_at):
+        return cls(user_id, seed_crypto.decrypt_seed(user_id, seed), handle, expires_at)
+
+
+# seed of a pending enrollment behind a handle; None when unknown or expired
+def _resolved(pending, handle):
+    if pending is None or not pending.matches(handle):
+        COUNTERS.incr("unresolved")
+        return None
+    return pending.seed
+
+
+def _counted(pending, created):
+    COUNTERS.incr("created" if created else "reused")
+    return pending, created
+
+
+# Every backend provides get_or_create(user_id, new_seed), which returns
+# (pending enrollment, created) and only calls new_seed() when there is none,
+# get(user_id), discard(user_id), and resolve(user_id, handle), the seed behind
+# a handle for the handle's owner only.
+
+# in-process store, for single worker deployments and development
+class LocalPendingStore(object):
+    def __init__(self, ttl=PENDING_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get_or_create(self, user_id, new_seed):
+        with self._lock:
+            pending = self._entries.get(user_id)
+            if pending is not None and pending.expires_at > time.time():
+                return _counted(pending, False)
+            pending = self._entries[user_id] = PendingEnrollment.new(user_id, new_seed(), self.ttl)
+            # drop expired entries so that the table stays small
+            now = time.time()
+            for key in [key for key, entry in self._entries.items() if entry.expires_at <= now]:
+                del self._entries[key]
+        return _counted(pending, True)
+
+    def get(self, user_id):
+        pending = self._entries.get(user_id)
+        if pending is None or pending.expires_at <= time.time():
+            return None
+        return pending
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def resolve(self, user_id, handle):
+        return _resolved(self.get(user_id), handle)
+
+
+# django cache framework backed store, relies on the atomic cache.add()
+class DjangoPendingStore(object):
+    def __init__(self, ttl=PENDING_TTL):
+        self.ttl = ttl
+
+    def get_or_create(self, user_id, new_seed):
+        key = KEY_PREFIX + str(user_id)
+        value = cache.get(key)
+        if value is not None:
+            return _counted(PendingEnrollment.from_stored(user_id, *value), False)
+
+        pending = PendingEnrollment.new(user_id, new_seed(), self.ttl)
+        if cache.add(key, pending.stored(), self.ttl):
+            return _counted(pending, True)
+        # another worker won the race, use its seed
+        value = cache.get(key)
+        if value is None:
+            cache.set(key, pending.stored(), self.ttl)
+            return _counted(pending, True)
+        return _counted(PendingEnrollment.from_stored(user_id, *value), False)
+
+    def get(self, user_id):
+        value = cache.get(KEY_PREFIX + str(user_id))
+        return PendingEnrollment.from_stored(user_id, *value) if value is not None else None
+
+    def discard(self, user_id):
+        cache.delete(KEY_PREFIX + str(user_id))
+
+    def resolve(self, user_id, handle):
+        return _resolved(self.get(user_id), handle)
+
+
+# sqlite file store, one connection per thread. The seeds are secrets: the file is
+# created readable by the Horizon user only.
+class SQLitePendingStore(object):
+    def __init__(self, path=PENDING_SQLITE_PATH, ttl=PENDING_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if not os.path.exists(self.path):
+                os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o600))
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS pending_enrollment ("
+                               "user_id TEXT PRIMARY KEY, seed TEXT NOT NULL, "
+                               "handle TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._local.connection = connection
+        return connection
+
+    def get_or_create(self, user_id, new_seed):
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM pending_enrollment WHERE expires_at <= ?", (now,))
+            row = connection.execute("SELECT seed, handle, expires_at FROM pending_enrollment WHERE user_id = ?",
+                                     (user_id,)).fetchone()
+            if row is not None:
+                connection.execute("COMMIT")
+                return _counted(PendingEnrollment.from_stored(user_id, *row), False)
+
+            pending = PendingEnrollment.new(user_id, new_seed(), self.ttl)
+            connection.execute("INSERT INTO pending_enrollment VALUES (?, ?, ?, ?)", (user_id,) + pending.stored())
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return _counted(pending, True)
+
+    def get(self, user_id):
+        row = self._connection().execute("SELECT seed, handle, expires_at FROM pending_enrollment "
+                                         "WHERE user_id = ? AND expires_at > ?", (user_id, time.time())).fetchone()
+        return PendingEnrollment.from_stored(user_id, *row) if row is not None else None
+
+    def discard(self, user_id):
+        self._connection().execute("DELETE FROM pending_enrollment WHERE user_id = ?", (user_id,))
+
+    def resolve(self, user_id, handle):
+        return _resolved(self.get(user_id), handle)
+
+
+def _build_store():
+    if PENDING_BACKEND == "local":
+        return LocalPendingStore()
+    if PENDING_BACKEND == "django":
+        return DjangoPendingStore()
+    if PENDING_BACKEND == "sqlite":
+        return SQLitePendingStore()
+    raise TOTPRuntimeError("[pending]: Unknown TOTP_PENDING_BACKEND %s" % PENDING_BACKEND)
+
+
+# process-wide store instance
+PENDING_ENROLLMENTS = _build_store()
@@ -0,0 +1,78 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Per-user "2FA enabled" hints used to pick the login mode up front.
+
+The auth backend does not know who the user is until Keystone has accepted the
+password, so the enrollment state learned on a successful login is remembered
+here (in the Django cache) keyed by user domain and user name. The next login
+for the same user then needs exactly one Keystone password auth.
+"""
+
+import hashlib
+
+from django.core.cache import cache
+
+from openstack_dashboard import settings
+
+# hint lifetime in seconds
+PREAUTH_CACHE_TTL = getattr(settings, "TOTP_PREAUTH_CACHE_TTL", 86400)
+
+HINT_PREFIX = "totp-preauth:"
+OWNER_PREFIX = "totp-preauth-owner:"
+
+
+# cache keys must be safe for memcached, so hash the login identity
+def _hint_key(username, user_domain_name):
+    identity = "%s\x00%s" % (user_domain_name or "", username or "")
+    return HINT_PREFIX + hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+def _owner_key(user_id):
+    return OWNER_PREFIX + str(user_id)
+
+
+# returns True (enrolled), False (not enrolled) or None (unknown)
+def get_hint(username, user_domain_name):
+    return lookup(username, user_domain_name)[0]
+
+
+# same, along with the user id: (enrolled, user_id), or (None, None)
+def lookup(username, user_domain_name):
+    if not PREAUTH_CACHE_TTL:
+        return None, None
+    value = cache.get(_hint_key(username, user_domain_name))
+    if isinstance(value, tuple):
+        return value
+    # hints cached by older versions hold the flag alone
+    return value, None
+
+
+# remember the enrollment state of a user that just logged in
+def set_hint(username, user_domain_name, user_id, enrolled):
+    if not PREAUTH_CACHE_TTL:
+        return
+    key = _hint_key(username, user_domain_name)
+    cache.set_many({key: (bool(enrolled), user_id), _owner_key(user_id): key}, PREAUTH_CACHE_TTL)
+
+
+# drop the hint for a login identity (e.g. after the hinted mode failed)
+def drop_hint(username, user_domain_name):
+    cache.delete(_hint_key(username, user_domain_name))
+
+
+# drop the hint for a user id, used when totp gets enabled or disabled
+def forget_user(user_id):
+    owner_key = _owner_key(user_id)
+    key = cache.get(owner_key)
+    if key:
+        cache.delete_many([key, owner_key])
@@ -0,0 +1,231 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Token-bucket limiter for failed logins, per user and source address pair, per address
+and per user.
+
+Every failed attempt takes a token from the bucket of the (user, address) pair,
+from the address' bucket and from the user's bucket; buckets refill at a fixed
+rate. A login is refused before any Keystone call when the pair or address
+bucket is empty. Failures from one address never lock the user out of another
+address, so a third party cannot lock out a user by guessing their password.
+
+The user's bucket catches guesses spread over many addresses: once it is empty,
+the account only takes as many attempts per minute as it refills, from
+addresses the user has not logged in from. Addresses of the user's recent
+successful logins are not held back by it, so the account is slowed down for
+the attacker, not locked for its owner.
+
+A bucket that has refilled completely carries no information and is dropped,
+so idle buckets expire on their own.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+from openstack_dashboard import settings
+from openstack_dashboard.auth import stats
+from openstack_dashboard.auth.exception import TOTPRuntimeError
+
+# "django" (shared django cache), "local" (per process) or "" to disable
+RATELIMIT_BACKEND = getattr(settings, "TOTP_RATELIMIT_BACKEND", "django")
+# bucket size and refill rate (tokens per minute) per user and source address...
+RATELIMIT_USER_BURST = getattr(settings, "TOTP_RATELIMIT_USER_BURST", 10)
+RATELIMIT_USER_REFILL = getattr(settings, "TOTP_RATELIMIT_USER_REFILL", 2)
+# ...per source address...
+RATELIMIT_IP_BURST = getattr(settings, "TOTP_RATELIMIT_IP_BURST", 50)
+RATELIMIT_IP_REFILL = getattr(settings, "TOTP_RATELIMIT_IP_REFILL", 20)
+# ...and per user, from all addresses but the user's known ones
+RATELIMIT_ACCOUNT_BURST = getattr(settings, "TOTP_RATELIMIT_ACCOUNT_BURST", 30)
+RATELIMIT_ACCOUNT_REFILL = getattr(settings, "TOTP_RATELIMIT_ACCOUNT_REFILL", 5)
+# seconds an address stays known after a successful login of the user
+RATELIMIT_KNOWN_TTL = getattr(settings, "TOTP_RATELIMIT_KNOWN_TTL", 30 * 24 * 3600)
+
+COUNTERS = stats.counters("ratelimit")
+
+
+# in-process buckets, ordered by last update so that idle ones are purged from the front
+class LocalBuckets(object):
+    def __init__(self, name, burst, refill):
+        self.name = name
+        self.burst = float(burst)
+        self.rate = refill / 60.0
+        self.idle = self.burst / self.rate
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def _purge(self, now):
+        while self._buckets:
+            key, (tokens, updated) = next(iter(self._buckets.items()))
+            if updated + self.idle > now:
+                break
+            del self._buckets[key]
+
+    def _level(self, key, now):
+        entry = self._buckets.get(key)
+        if entry is None:
+            return self.burst
+        tokens, updated = entry
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def allowed(self, key):
+        with self._lock:
+            return self._level(key, time.monotonic()) >= 1
+
+    def consume(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            tokens = max(0.0, self._level(key, now) - 1)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+# buckets kept in the django cache; updates are not atomic, which only makes the limit approximate
+class DjangoBuckets(object):
+    def __init__(self, name, burst, refill):
+        self.name = name
+        self.burst = float(burst)
+        self.rate = refill / 60.0
+        self.idle = int(self.burst / self.rate) + 1
+
+    def _key(self, key):
+        return "totp-ratelimit:%s:%s" % (self.name, key)
+
+    def _level(self, key, now):
+        entry = cache.get(self._key(key))
+        if entry is None:
+            return self.burst
+        tokens, updated = entry
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def allowed(self, key):
+        return self._level(key, time.time()) >= 1
+
+    def consume(self, key):
+        now = time.time()
+        tokens = max(0.0, self._level(key, now) - 1)
+        cache.set(self._key(key), (tokens, now), self.idle)
+
+
+# in-process set of keys that expire ttl seconds after they were last added
+class LocalMarks(object):
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._marks = OrderedDict()
+
+    def add(self, key):
+        now = time.monotonic()
+        with self._lock:
+            while self._marks and next(iter(self._marks.values())) + self.ttl <= now:
+                self._marks.popitem(last=False)
+            self._marks[key] = now
+            self._marks.move_to_end(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            added = self._marks.get(key)
+        return added is not None and added + self.ttl > time.monotonic()
+
+
+# same, in the django cache
+class DjangoMarks(object):
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+
+    def _key(self, key):
+        return "totp-ratelimit:%s:%s" % (self.name, key)
+
+    def add(self, key):
+        cache.set(self._key(key), 1, self.ttl)
+
+    def __contains__(self, key):
+        return cache.get(self._key(key)) is not None
+
+
+def _build_buckets(name, burst, refill):
+    if not RATELIMIT_BACKEND or not burst or not refill:
+        return None
+    if RATELIMIT_BACKEND == "local":
+        return LocalBuckets(name, burst, refill)
+    if RATELIMIT_BACKEND == "django":
+        return DjangoBuckets(name, burst, refill)
+    raise TOTPRuntimeError("[ratelimit]: Unknown TOTP_RATELIMIT_BACKEND %s" % RATELIMIT_BACKEND)
+
+
+def _build_marks(name, ttl):
+    if not RATELIMIT_BACKEND or not ttl:
+        return None
+    return LocalMarks(name, ttl) if RATELIMIT_BACKEND == "local" else DjangoMarks(name, ttl)
+
+
+USER_BUCKETS = _build_buckets("user", RATELIMIT_USER_BURST, RATELIMIT_USER_REFILL)
+IP_BUCKETS = _build_buckets("ip", RATELIMIT_IP_BURST, RATELIMIT_IP_REFILL)
+ACCOUNT_BUCKETS = _build_buckets("account", RATELIMIT_ACCOUNT_BURST, RATELIMIT_ACCOUNT_REFILL)
+KNOWN_SOURCES = _build_marks("known", RATELIMIT_KNOWN_TTL) if ACCOUNT_BUCKETS is not None else None
+
+
+# compact, cache-safe bucket key for a login identity
+def user_key(username, user_domain_name):
+    identity = "%s\x00%s" % (user_domain_name or "", (username or "").lower())
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+# bucket key of a login identity from a source address
+def _pair_key(user, client_ip):
+    return "%s:%s" % (user, client_ip or "")
+
+
+# whether the user logged in successfully from this address lately
+def _known(user, client_ip):
+    return KNOWN_SOURCES is not None and bool(client_ip) and _pair_key(user, client_ip) in KNOWN_SOURCES
+
+
+# True if a login attempt may go on to keystone
+def check(user, client_ip):
+    if USER_BUCKETS is not None and not USER_BUCKETS.allowed(_pair_key(user, client_ip)):
+        COUNTERS.incr("rejected_user")
+        return False
+    if IP_BUCKETS is not None and client_ip and not IP_BUCKETS.allowed(client_ip):
+        COUNTERS.incr("rejected_ip")
+        return False
+    if ACCOUNT_BUCKETS is not None and not ACCOUNT_BUCKETS.allowed(user) and not _known(user, client_ip):
+        COUNTERS.incr("rejected_account")
+        return False
+    return True
+
+
+# account a failed login attempt
+def record_failure(user, client_ip):
+    COUNTERS.incr("failures")
+    if USER_BUCKETS is not None:
+        USER_BUCKETS.consume(_pair_key(user, client_ip))
+    if IP_BUCKETS is not None and client_ip:
+        IP_BUCKETS.consume(client_ip)
+    if ACCOUNT_BUCKETS is not None:
+        ACCOUNT_BUCKETS.consume(user)
+
+
+# remember the address of a successful login, which the user's bucket then lets through
+def record_success(user, client_ip):
+    if KNOWN_SOURCES is not None and client_ip:
+        KNOWN_SOURCES.add(_pair_key(user, client_ip))
@@ -0,0 +1,107 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Registry of consumed OTP codes, keyed by (user id, time step).
+
+A code can be claimed once; entries expire as soon as their time step
+leaves the validation window, so the registry stays bounded.
+"""
+
+import threading
+import time
+from collections import deque
+
+from django.core.cache import cache
+
+from openstack_dashboard import settings
+from openstack_dashboard.auth import stats
+from openstack_dashboard.auth.exception import TOTPRuntimeError
+
+# "django" (shared django cache, needed with several workers), "local" or "" to disable
+REPLAY_BACKEND = getattr(settings, "TOTP_REPLAY_BACKEND", "django")
+REPLAY_SHARDS = getattr(settings, "TOTP_REPLAY_SHARDS", 16)
+
+KEY_PREFIX = "totp-used:"
+
+COUNTERS = stats.counters("replay")
+
+
+# in-process registry: a set of dicts, each with its own lock and expiry queue
+class LocalReplayRegistry(object):
+    def __init__(self, shards=REPLAY_SHARDS):
+        self._shards = [(threading.Lock(), {}, deque()) for _ in range(shards)]
+
+    # mark (user_id, step) as used until expires_at (unix time).
+    # Returns False if it was already used.
+    def claim(self, user_id, step, expires_at):
+        key = (user_id, step)
+        lock, entries, expiry = self._shards[hash(key) % len(self._shards)]
+        now = time.time()
+        with lock:
+            # steps are claimed in roughly increasing order, so expired entries sit at the front
+            while expiry and expiry[0][0] <= now:
+                expired_at, expired_key = expiry.popleft()
+                if entries.get(expired_key) == expired_at:
+                    del entries[expired_key]
+
+            if entries.get(key, 0) > now:
+                COUNTERS.incr("replayed")
+                return False
+            entries[key] = expires_at
+            expiry.append((expires_at, key))
+        COUNTERS.incr("claimed")
+        return True
+
+    def is_used(self, user_id, step):
+        key = (user_id, step)
+        lock, entries, _ = self._shards[hash(key) % len(self._shards)]
+        return entries.get(key, 0) > time.time()
+
+    def __len__(self):
+        return sum(len(entries) for _, entries, _ in self._shards)
+
+
+# django cache registry, relies on the atomic cache.add()
+class DjangoReplayRegistry(object):
+    def claim(self, user_id, step, expires_at):
+        timeout = max(1, int(expires_at - time.time()) + 1)
+        if not cache.add("%s%s:%d" % (KEY_PREFIX, user_id, step), 1, timeout):
+            COUNTERS.incr("replayed")
+            return False
+        COUNTERS.incr("claimed")
+        return True
+
+    def is_used(self, user_id, step):
+        return cache.get("%s%s:%d" % (KEY_PREFIX, user_id, step)) is not None
+
+
+# replay protection disabled
+class NullReplayRegistry(object):
+    def claim(self, user_id, step, expires_at):
+        return True
+
+    def is_used(self, user_id, step):
+        return False
+
+
+def _build_registry():
+    if not REPLAY_BACKEND:
+        return NullReplayRegistry()
+    if REPLAY_BACKEND == "local":
+        return LocalReplayRegistry()
+    if REPLAY_BACKEND == "django":
+        return DjangoReplayRegistry()
+    raise TOTPRuntimeError("[replay]: Unknown TOTP_REPLAY_BACKEND %s" % REPLAY_BACKEND)
+
+
+# process-wide registry instance
+REPLAY_REGISTRY = _build_registry()
@@ -0,0 +1,135 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Encryption at rest of the TOTP seeds, under a versioned set of keys.
+
+Seeds are written as "enc1:<key version>:<base64 nonce + AES-GCM ciphertext>",
+with the user id as associated data, so that a stored value cannot be copied
+to another user. Values without the prefix are plain seeds written before
+encryption was turned on; they are still read, and totp_rotate_seeds
+re-encrypts them. Deriving a key from its secret is deliberately slow
+(PBKDF2), so the AES-GCM objects are built once per key version and cached.
+Needs the cryptography package when TOTP_SEED_KEYS is set.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+import threading
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = InvalidTag = None
+
+from openstack_dashboard import settings
+from openstack_dashboard.auth import stats
+from openstack_dashboard.auth.exception import TOTPRuntimeError
+
+LOG = logging.getLogger(__name__)
+
+# key version -> secret, e.g. {1: "...", 2: "..."}. Empty: seeds are stored in clear.
+SEED_KEYS = getattr(settings, "TOTP_SEED_KEYS", {})
+# version used for new writes, the highest one by default
+SEED_KEY_VERSION = getattr(settings, "TOTP_SEED_KEY_VERSION", None)
+SEED_KEY_ITERATIONS = getattr(settings, "TOTP_SEED_KEY_ITERATIONS", 200000)
+
+PREFIX = "enc1:"
+NONCE_SIZE = 12
+
+COUNTERS = stats.counters("seed_crypto")
+PHASES = stats.histograms("seed_crypto")
+
+
+# the configured keys, with their ciphers derived on first use
+class Keyring(object):
+    def __init__(self, secrets, current=None, iterations=SEED_KEY_ITERATIONS):
+        self.secrets = dict((int(version), secret) for version, secret in (secrets or {}).items())
+        self.current = int(current) if current is not None else max(self.secrets or [0])
+        self.iterations = iterations
+        if self.secrets and self.current not in self.secrets:
+            raise TOTPRuntimeError("[seed_crypto]: TOTP_SEED_KEY_VERSION %s is not in TOTP_SEED_KEYS" % self.current)
+        if self.secrets and AESGCM is None:
+            raise TOTPRuntimeError("[seed_crypto]: the cryptography package is required for TOTP_SEED_KEYS")
+        self._lock = threading.Lock()
+        self._ciphers = {}
+
+    @property
+    def enabled(self):
+        return bool(self.secrets)
+
+    # AES-GCM object of a key version, derived once per process
+    def cipher(self, version):
+        cipher = self._ciphers.get(version)
+        if cipher is not None:
+            return cipher
+
+        with self._lock:
+            cipher = self._ciphers.get(version)
+            if cipher is None:
+                secret = self.secrets.get(version)
+                if secret is None:
+                    raise TOTPRuntimeError("[seed_crypto]: unknown seed key version %s" % version)
+                COUNTERS.incr("derivations")
+                with PHASES.time("derive"):
+                    key = hashlib.pbkdf2_hmac("sha256", secret.encode('utf-8'),
+                                              ("totp-seed:%d" % version).encode('utf-8'), self.iterations)
+                cipher = self._ciphers[version] = AESGCM(key)
+        return cipher
+
+
+KEYRING = Keyring(SEED_KEYS, SEED_KEY_VERSION)
+
+
+# key version of a stored value, None for a plain seed
+def key_version(value):
+    if not value or not value.startswith(PREFIX):
+        return None
+    return int(value[len(PREFIX):].split(":", 1)[0])
+
+
+# whether a stored value is already in the form new writes would have
+def is_current(value):
+    return key_version(value) == (KEYRING.current if KEYRING.enabled else None)
+
+
+# value to store for a seed: encrypted under the current key, or the seed itself
+# when no key is configured
+def encrypt_seed(user_id, seed):
+    if not seed or not KEYRING.enabled:
+        return seed
+    version = KEYRING.current
+    nonce = os.urandom(NONCE_SIZE)
+    with PHASES.time("encrypt"):
+        sealed = KEYRING.cipher(version).encrypt(nonce, seed.encode('utf-8'), str(user_id).encode('utf-8'))
+    return "%s%d:%s" % (PREFIX, version, base64.urlsafe_b64encode(nonce + sealed).decode('ascii'))
+
+
+# seed of a stored value. Plain seeds are returned as they are.
+def decrypt_seed(user_id, value):
+    version = key_version(value)
+    if version is None:
+        if value:
+            COUNTERS.incr("plain_reads")
+        return value
+
+    with PHASES.time("decrypt"):
+        raw = base64.urlsafe_b64decode(value.split(":", 2)[2])
+        try:
+            seed = KEYRING.cipher(version).decrypt(raw[:NONCE_SIZE], raw[NONCE_SIZE:], str(user_id).encode('utf-8'))
+        except InvalidTag:
+            COUNTERS.incr("decrypt_failed")
+            LOG.error("[TOTP] cannot decrypt the seed of user [%s] (key version %d)" % (user_id, version))
+            raise TOTPRuntimeError("[seed_crypto]: cannot decrypt the seed of user %s" % user_id)
+    return seed.decode('utf-8')
@@ -0,0 +1,238 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Storage of the TOTP seeds used by TOTPOracle.
+
+"keystone" keeps the seed in the totp_key extra attribute of the keystone
+user: every read is a user GET and every write a user PATCH. "sqlite" keeps
+the seeds in a local SQLite file, one indexed row per enrolled user, so that
+validating a code needs no HTTP request; keystone is still asked for the
+email address when a page needs it. The file is local to the host: use it for
+single host deployments, or when every Horizon host shares the same store.
+totp_migrate_seeds copies the existing seeds out of keystone. Both stores hold
+the values produced by seed_crypto: encrypted when TOTP_SEED_KEYS is set.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from openstack_dashboard import settings
+from openstack_dashboard.auth import seed_crypto
+from openstack_dashboard.auth import stats
+from openstack_dashboard.auth.exception import TOTPRuntimeError
+
+# "keystone" (user extra attribute) or "sqlite" (local file)
+SEED_BACKEND = getattr(settings, "TOTP_SEED_BACKEND", "keystone")
+SEED_SQLITE_PATH = getattr(settings, "TOTP_SEED_SQLITE_PATH", "/var/lib/openstack-dashboard/totp_seeds.sqlite")
+# connections kept open per process
+SEED_SQLITE_POOL_SIZE = getattr(settings, "TOTP_SEED_SQLITE_POOL_SIZE", 8)
+
+COUNTERS = stats.counters("seed_store")
+PHASES = stats.histograms("seed_store")
+
+# the statements are constant strings, so sqlite3 prepares each of them once per
+# connection and reuses it from the connection's statement cache
+SCHEMA = ("CREATE TABLE IF NOT EXISTS totp_seed ("
+          "user_id TEXT PRIMARY KEY, seed TEXT NOT NULL, updated_at REAL NOT NULL) WITHOUT ROWID")
+SELECT_SEED = "SELECT seed FROM totp_seed WHERE user_id = ?"
+UPSERT_SEED = ("INSERT INTO totp_seed (user_id, seed, updated_at) VALUES (?, ?, ?) "
+               "ON CONFLICT (user_id) DO UPDATE SET seed = excluded.seed, updated_at = excluded.updated_at")
+INSERT_SEED = ("INSERT INTO totp_seed (user_id, seed, updated_at) VALUES (?, ?, ?) "
+               "ON CONFLICT (user_id) DO NOTHING")
+DELETE_SEED = "DELETE FROM totp_seed WHERE user_id = ?"
+SELECT_PAGE = "SELECT user_id, seed FROM totp_seed WHERE user_id > ? ORDER BY user_id LIMIT ?"
+REPLACE_SEED = "UPDATE totp_seed SET seed = ?, updated_at = ? WHERE user_id = ? AND seed = ?"
+
+# custom keystone property holding the seed
+TOTP_KEY_ATTRIBUTE = "totp_key"
+
+
+# seeds in the keystone user's extra attributes, written through the oracle's client
+class KeystoneSeedStore(object):
+    # reads need a keystone user GET
+    local = False
+
+    # seed of a user, given the value of its keystone attribute
+    def key_of(self, user_id, attribute=None):
+        return seed_crypto.decrypt_seed(user_id, attribute) or None
+
+    def set_key(self, oracle, user_id, key):
+        oracle.user_update(user_id, **{TOTP_KEY_ATTRIBUTE: seed_crypto.encrypt_seed(user_id, key) or ""})
+
+    # stored values of raw keystone user documents, as they are: {user_id: value}.
+    # Users without the attribute are left out.
+    def stored_values(self, users):
+        return dict((user["id"], user[TOTP_KEY_ATTRIBUTE]) for user in users if TOTP_KEY_ATTRIBUTE in user)
+
+    # (user id, stored value) of the enrolled users, in user id order, after marker
+    def iter_raw(self, oracle, domain_id=None, marker=None):
+        for user in oracle.users_iter(domain_id=domain_id, marker=marker):
+            if user.get(TOTP_KEY_ATTRIBUTE):
+                yield user["id"], user[TOTP_KEY_ATTRIBUTE]
+
+    # replace a stored value. Keystone has no conditional update: the caller has
+    # just read previous, a concurrent enable in between is overwritten.
+    def put_raw(self, oracle, user_id, value, previous):
+        oracle.user_update(user_id, **{TOTP_KEY_ATTRIBUTE: value})
+        return True
+
+
+# bounded pool of sqlite connections, reopened in a forked child
+class SQLitePool(object):
+    def __init__(self, path, size=SEED_SQLITE_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._idle = None
+        self._open = 0
+
+    def _new_connection(self):
+        # the seeds are secrets: the file is created readable by the Horizon user only
+        if not os.path.exists(self.path):
+            os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o600))
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None,
+                                     check_same_thread=False, cached_statements=16)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(SCHEMA)
+        COUNTERS.incr("connections_opened")
+        return connection
+
+    # connections of the parent process are neither used nor closed by a child
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._idle = queue.LifoQueue()
+                    self._open = 0
+                    self._pid = os.getpid()
+
+    @contextmanager
+    def connection(self):
+        self._check_pid()
+        idle = self._idle
+        try:
+            connection = idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                grow = self._open < self.size
+                if grow:
+                    self._open += 1
+            if grow:
+                try:
+                    connection = self._new_connection()
+                except Exception:
+                    with self._lock:
+                        self._open -= 1
+                    raise
+            else:
+                COUNTERS.incr("pool_waits")
+                connection = idle.get()
+        try:
+            yield connection
+        finally:
+            idle.put(connection)
+
+
+# seeds in a local sqlite file (WAL mode, so that readers never wait for a writer)
+class SQLiteSeedStore(object):
+    # reads are a single primary key lookup
+    local = True
+
+    def __init__(self, path=SEED_SQLITE_PATH, pool_size=SEED_SQLITE_POOL_SIZE):
+        self.pool = SQLitePool(path, pool_size)
+
+    def key_of(self, user_id, attribute=None):
+        return self.get_key(user_id)
+
+    def get_key(self, user_id):
+        COUNTERS.incr("reads")
+        with PHASES.time("read"), self.pool.connection() as connection:
+            row = connection.execute(SELECT_SEED, (user_id,)).fetchone()
+        return seed_crypto.decrypt_seed(user_id, row[0]) if row is not None else None
+
+    def set_key(self, oracle, user_id, key):
+        COUNTERS.incr("writes")
+        value = seed_crypto.encrypt_seed(user_id, key)
+        with PHASES.time("write"), self.pool.connection() as connection:
+            if value:
+                connection.execute(UPSERT_SEED, (user_id, value, time.time()))
+            else:
+                connection.execute(DELETE_SEED, (user_id,))
+
+    # domains are not known locally: domain_id is ignored
+    def iter_raw(self, oracle=None, domain_id=None, marker=None, page_size=500):
+        marker = marker or ""
+        while True:
+            with self.pool.connection() as connection:
+                rows = connection.execute(SELECT_PAGE, (marker, page_size)).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < page_size:
+                return
+            marker = rows[-1][0]
+
+    # replace a stored value, unless it changed since it was read
+    def put_raw(self, oracle, user_id, value, previous):
+        with self.pool.connection() as connection:
+            return connection.execute(REPLACE_SEED, (value, time.time(), user_id, previous)).rowcount == 1
+
+    # bulk insert of (user_id, stored value) pairs in a single transaction, used by the
+    # migration: values are copied as they are, encrypted or not. Users that already have
+    # a seed in the store keep it, returns the number of seeds inserted
+    def import_keys(self, pairs):
+        now = time.time()
+        with self.pool.connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                inserted = connection.executemany(INSERT_SEED, ((user_id, key, now) for user_id, key in pairs)).rowcount
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return inserted
+
+    # stored values of some users, as they are: {user_id: value}
+    def get_raw(self, user_ids, chunk_size=500):
+        user_ids = list(user_ids)
+        values = {}
+        with self.pool.connection() as connection:
+            for start in range(0, len(user_ids), chunk_size):
+                chunk = user_ids[start:start + chunk_size]
+                query = "SELECT user_id, seed FROM totp_seed WHERE user_id IN (%s)" % ",".join("?" * len(chunk))
+                values.update(connection.execute(query, chunk).fetchall())
+        return values
+
+    # same, for raw keystone user documents, e.g. a page of a user listing
+    def stored_values(self, users):
+        return self.get_raw(user["id"] for user in users)
+
+    def count(self):
+        with self.pool.connection() as connection:
+            return connection.execute("SELECT COUNT(*) FROM totp_seed").fetchone()[0]
+
+
+def _build_store():
+    if SEED_BACKEND == "keystone":
+        return KeystoneSeedStore()
+    if SEED_BACKEND == "sqlite":
+        return SQLiteSeedStore()
+    raise TOTPRuntimeError("[seed_store]: Unknown TOTP_SEED_BACKEND %s" % SEED_BACKEND)
+
+
+# process-wide store instance
+SEED_STORE = _build_store()
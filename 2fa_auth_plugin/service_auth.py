@@ -0,0 +1,78 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Service account used for TOTP state lookups.
+
+When TOTP_SERVICE_AUTH is set, each worker process issues one service token
+and shares it between all its TOTP lookups. It is refreshed
+TOTP_SERVICE_TOKEN_REFRESH seconds before it expires. The token is a bearer
+credential of an account that can read every user: it stays in process
+memory, and is never written to the shared Django cache.
+"""
+
+import logging
+import threading
+
+from keystoneauth1.identity import access as access_plugin
+from keystoneauth1.identity import v3 as v3_plugin
+
+from openstack_dashboard import settings
+from openstack_dashboard.auth import session_pool
+from openstack_dashboard.auth import stats
+
+LOG = logging.getLogger(__name__)
+
+# keystone v3 password credentials of the service account, e.g.
+# {"username": ..., "password": ..., "user_domain_name": ...,
+#  "project_name": ..., "project_domain_name": ...}
+SERVICE_AUTH = getattr(settings, "TOTP_SERVICE_AUTH", None)
+SERVICE_TOKEN_REFRESH = getattr(settings, "TOTP_SERVICE_TOKEN_REFRESH", 300)
+KEYSTONE_URL = getattr(settings, "OPENSTACK_KEYSTONE_URL", None)
+
+COUNTERS = stats.counters("service_token")
+
+_lock = threading.Lock()
+_auth_ref = None
+
+
+def enabled():
+    return bool(SERVICE_AUTH)
+
+
+def _fresh(auth_ref):
+    return auth_ref is not None and not auth_ref.will_expire_soon(SERVICE_TOKEN_REFRESH)
+
+
+# issue a new service token
+def _authenticate():
+    COUNTERS.incr("issued")
+    LOG.info("[TOTP] issuing service token for %s" % SERVICE_AUTH.get("username"))
+    plugin = v3_plugin.Password(auth_url=KEYSTONE_URL, **SERVICE_AUTH)
+    return plugin.get_access(session_pool.get_session(None, KEYSTONE_URL))
+
+
+# current service token of this process, issued again when it is about to expire
+def get_access_info():
+    global _auth_ref
+    auth_ref = _auth_ref
+    if _fresh(auth_ref):
+        return auth_ref
+
+    with _lock:
+        if not _fresh(_auth_ref):
+            _auth_ref = _authenticate()
+        return _auth_ref
+
+
+# auth plugin for a lookup, backed by the service token of this process
+def get_auth_plugin():
+    return access_plugin.AccessInfoPlugin(auth_ref=get_access_info(), auth_url=KEYSTONE_URL)
@@ -0,0 +1,74 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Process-wide HTTP connection pools for the Keystone endpoints used by TOTPOracle. """
+
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from keystoneauth1 import session as keystone_session
+
+from openstack_dashboard import settings
+
+LOG = logging.getLogger(__name__)
+
+# maximum number of keep-alive connections kept per keystone endpoint
+POOL_SIZE = getattr(settings, "TOTP_KEYSTONE_POOL_SIZE", 10)
+# number of hosts (auth url, catalog endpoints) each pool keeps connections to
+POOL_HOSTS = getattr(settings, "TOTP_KEYSTONE_POOL_HOSTS", 4)
+# block callers when the pool is exhausted instead of opening extra connections
+POOL_BLOCK = getattr(settings, "TOTP_KEYSTONE_POOL_BLOCK", False)
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+# pools are kept per scheme://host:port
+def _endpoint(url):
+    parts = urlsplit(url or "")
+    return "%s://%s" % (parts.scheme, parts.netloc)
+
+
+# get (or create) the shared requests session for a keystone endpoint
+def get_http_session(url):
+    endpoint = _endpoint(url)
+    http_session = _POOLS.get(endpoint)
+    if http_session is not None:
+        return http_session
+
+    with _POOLS_LOCK:
+        http_session = _POOLS.get(endpoint)
+        if http_session is None:
+            LOG.debug("[TOTP] creating keystone connection pool for %s (size %d)" % (endpoint, POOL_SIZE))
+            adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE, pool_block=POOL_BLOCK)
+            http_session = requests.Session()
+            http_session.mount("https://", adapter)
+            http_session.mount("http://", adapter)
+            _POOLS[endpoint] = http_session
+        return http_session
+
+
+# build a keystone session for a (per request) auth plugin on top of the shared pool
+def get_session(auth, url):
+    return keystone_session.Session(auth=auth, session=get_http_session(url))
+
+
+# drop all pools, e.g. after a fork
+def reset():
+    with _POOLS_LOCK:
+        for http_session in _POOLS.values():
+            http_session.close()
+        _POOLS.clear()
@@ -0,0 +1,129 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Cache of per-user TOTP state (user id -> key and email), invalidated on enable/disable. """
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+from openstack_dashboard import settings
+from openstack_dashboard.auth import stats
+from openstack_dashboard.auth.exception import TOTPRuntimeError
+
+# "django" (shared django cache), "local" (in-process LRU) or "" to disable
+STATE_CACHE_BACKEND = getattr(settings, "TOTP_STATE_CACHE_BACKEND", "django")
+STATE_CACHE_TTL = getattr(settings, "TOTP_STATE_CACHE_TTL", 60)
+STATE_CACHE_SIZE = getattr(settings, "TOTP_STATE_CACHE_SIZE", 10000)
+
+KEY_PREFIX = "totp-state:"
+
+COUNTERS = stats.counters("state_cache")
+
+
+# in-process bounded LRU with per-entry expiry
+class LocalStateCache(object):
+    def __init__(self, ttl=STATE_CACHE_TTL, max_size=STATE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                COUNTERS.incr("misses")
+                return None
+            expires, value = entry
+            if expires <= now:
+                del self._entries[user_id]
+                COUNTERS.incr("expired")
+                COUNTERS.incr("misses")
+                return None
+            self._entries.move_to_end(user_id)
+        COUNTERS.incr("hits")
+        return value
+
+    def set(self, user_id, value):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                COUNTERS.incr("evictions")
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+        COUNTERS.incr("invalidations")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# django cache framework backed cache, shared by all workers using the same cache
+class DjangoStateCache(object):
+    def __init__(self, ttl=STATE_CACHE_TTL):
+        self.ttl = ttl
+        self._cache = cache
+
+    def get(self, user_id):
+        value = self._cache.get(KEY_PREFIX + str(user_id))
+        COUNTERS.incr("misses" if value is None else "hits")
+        return value
+
+    def set(self, user_id, value):
+        self._cache.set(KEY_PREFIX + str(user_id), value, self.ttl)
+
+    def invalidate(self, user_id):
+        self._cache.delete(KEY_PREFIX + str(user_id))
+        COUNTERS.incr("invalidations")
+
+    def clear(self):
+        pass
+
+
+# no caching at all
+class NullStateCache(object):
+    def get(self, user_id):
+        return None
+
+    def set(self, user_id, value):
+        pass
+
+    def invalidate(self, user_id):
+        pass
+
+    def clear(self):
+        pass
+
+
+def _build_cache():
+    if not STATE_CACHE_BACKEND or not STATE_CACHE_TTL:
+        return NullStateCache()
+    if STATE_CACHE_BACKEND == "local":
+        return LocalStateCache()
+    if STATE_CACHE_BACKEND == "django":
+        return DjangoStateCache()
+    raise TOTPRuntimeError("[state_cache]: Unknown TOTP_STATE_CACHE_BACKEND %s" % STATE_CACHE_BACKEND)
+
+
+# process-wide cache instance
+STATE_CACHE = _build_cache()
@@ -0,0 +1,214 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Process-wide counters and latency histograms for the Two Factor auth plugin.
+
+Values are per process; the Prometheus text rendering is served by the TOTP
+panel (see the dashboard's metrics view). With TOTP_METRICS_ENABLED = False
+every counter, histogram and timer is a shared no-op object.
+"""
+
+import bisect
+import threading
+import time
+
+from openstack_dashboard import settings
+
+METRICS_ENABLED = getattr(settings, "TOTP_METRICS_ENABLED", True)
+# histogram bucket upper bounds, in seconds
+HISTOGRAM_BUCKETS = getattr(settings, "TOTP_METRICS_BUCKETS",
+                            (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+
+# registry of named counter groups and histograms
+_REGISTRY = {}
+_HISTOGRAMS = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+# group of thread-safe integer counters
+class Counters(object):
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, key):
+        return self._values.get(key, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+# group of latency histograms, one per label
+class Histograms(object):
+    def __init__(self, name, buckets=HISTOGRAM_BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, label, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label)
+            if entry is None:
+                entry = self._values[label] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, label):
+        return Timer(self, label)
+
+    # label -> (cumulative bucket counts, sum, count)
+    def snapshot(self):
+        with self._lock:
+            values = dict((label, (list(entry[0]), entry[1], entry[2])) for label, entry in self._values.items())
+        for label, (counts, total, count) in values.items():
+            for i in range(1, len(counts)):
+                counts[i] += counts[i - 1]
+        return values
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+# context manager observing the elapsed time of a block
+class Timer(object):
+    __slots__ = ("histograms", "label", "start")
+
+    def __init__(self, histograms, label):
+        self.histograms = histograms
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histograms.observe(self.label, time.perf_counter() - self.start)
+
+
+# stand-ins used when metrics are disabled
+class NullCounters(object):
+    name = None
+
+    def incr(self, key, amount=1):
+        pass
+
+    def get(self, key):
+        return 0
+
+    def snapshot(self):
+        return {}
+
+    def reset(self):
+        pass
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class NullHistograms(object):
+    name = None
+
+    def observe(self, label, value):
+        pass
+
+    def time(self, label):
+        return NULL_TIMER
+
+    def snapshot(self):
+        return {}
+
+    def reset(self):
+        pass
+
+
+NULL_COUNTERS = NullCounters()
+NULL_TIMER = NullTimer()
+NULL_HISTOGRAMS = NullHistograms()
+
+
+# get (or create) a named counter group
+def counters(name):
+    if not METRICS_ENABLED:
+        return NULL_COUNTERS
+    with _REGISTRY_LOCK:
+        group = _REGISTRY.get(name)
+        if group is None:
+            group = _REGISTRY[name] = Counters(name)
+        return group
+
+
+# get (or create) a named group of histograms
+def histograms(name):
+    if not METRICS_ENABLED:
+        return NULL_HISTOGRAMS
+    with _REGISTRY_LOCK:
+        group = _HISTOGRAMS.get(name)
+        if group is None:
+            group = _HISTOGRAMS[name] = Histograms(name)
+        return group
+
+
+# dump all registered counter groups
+def snapshot():
+    with _REGISTRY_LOCK:
+        groups = list(_REGISTRY.values())
+    return dict((group.name, group.snapshot()) for group in groups)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+# all counters and histograms in the prometheus text exposition format
+def render_prometheus(prefix="horizon_totp"):
+    with _REGISTRY_LOCK:
+        groups = sorted(_REGISTRY.values(), key=lambda group: group.name)
+        histogram_groups = sorted(_HISTOGRAMS.values(), key=lambda group: group.name)
+
+    lines = []
+    for group in groups:
+        metric = "%s_%s_total" % (prefix, group.name)
+        lines.append("# TYPE %s counter" % metric)
+        for key, value in sorted(group.snapshot().items()):
+            lines.append('%s{key="%s"} %d' % (metric, _label(key), value))
+
+    for group in histogram_groups:
+        metric = "%s_%s_seconds" % (prefix, group.name)
+        lines.append("# TYPE %s histogram" % metric)
+        for label, (counts, total, count) in sorted(group.snapshot().items()):
+            label = _label(label)
+            for bound, value in zip(group.buckets, counts):
+                lines.append('%s_bucket{phase="%s",le="%s"} %d' % (metric, label, bound, value))
+            lines.append('%s_bucket{phase="%s",le="+Inf"} %d' % (metric, label, counts[-1]))
+            lines.append('%s_sum{phase="%s"} %f' % (metric, label, total))
+            lines.append('%s_count{phase="%s"} %d' % (metric, label, count))
+
+    return "\n".join(lines) + "\n"
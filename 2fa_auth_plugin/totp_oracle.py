@@ -1,6 +1,7 @@
 # TOTP Verification Backend for Openstack Horizon
 #
-# Uses python-otp-lib https://github.com/mcaimi/python-otp-lib.git
+# Uses python-otp-lib https://github.com/mcaimi/python-otp-lib.git for seed generation,
+# tokens are checked by the verifier module.
 #
 # Changelog
 #
@@ -9,125 +10,389 @@
 # - Tue Jun 09 2020 - Porting to Openstack Ussuri. - Marco Caimi <mcaimi@redhat.com>
 
 import logging
-
-# import python-otp-lib, TOTP
-from rfc6238 import totp
+import time
+from urllib.parse import urlencode
 
 # keystone client
+from keystoneauth1 import access
+from keystoneauth1.identity import access as access_plugin
 from keystoneauth1.identity import v3 as v3_plugin
-from keystoneclient.v3 import client as v3_client
-from keystoneauth1 import session as keystone_session
-
-# openstack dashboard api import
-from openstack_dashboard.api import base as api_base
-from openstack_dashboard.api import keystone
 
 from openstack_dashboard import settings
+from openstack_dashboard.auth import preauth
+from openstack_dashboard.auth import seed_crypto
+from openstack_dashboard.auth import seed_store
+from openstack_dashboard.auth import service_auth
+from openstack_dashboard.auth import session_pool
+from openstack_dashboard.auth import stats
 from openstack_dashboard.auth.exception import IllegalArgument, InvalidToken, TOTPRuntimeError
+from openstack_dashboard.auth.state_cache import STATE_CACHE
+from openstack_dashboard.auth.verifier import get_verifier
 
 LOG = logging.getLogger(__name__)
-KS_VERSION = api_base.APIVersionManager('identity', preferred_version=3)
 
 # custom keystone property to read from the database
-TOTP_KEY_ATTRIBUTE = "totp_key"
+TOTP_KEY_ATTRIBUTE = seed_store.TOTP_KEY_ATTRIBUTE
 EMAIL_ATTRIBUTE = "email"
 KEYSTONE_URL = getattr(settings, "OPENSTACK_KEYSTONE_URL", None)
 TOTP_TTL = getattr(settings, "TOTP_VALIDITY_PERIOD", 30)
+DEFAULT_DOMAIN = getattr(settings, "OPENSTACK_KEYSTONE_DEFAULT_DOMAIN", "Default")
+USERS_PAGE_SIZE = getattr(settings, "TOTP_USERS_PAGE_SIZE", 500)
+# accepted clock drift, in time steps before/after the current one
+TOTP_DRIFT_STEPS = getattr(settings, "TOTP_DRIFT_STEPS", 1)
+
+# matched step offsets, to track clock skew across users
+DRIFT = stats.counters("totp_drift")
+# user domain name -> id, used by service account lookups
+DOMAIN_IDS = {}
+
+# keystone lookups and validation outcomes, and their latency
+ORACLE_CALLS = stats.counters("oracle")
+PHASES = stats.histograms("oracle_phase")
+
+# auth plugins built by oracles: only "token" and "password" ones issue new keystone tokens
+AUTH_PLUGINS = stats.counters("oracle_auth_plugin")
+
+
+# keystone client on a session. keystoneclient is imported on first use, as most
+# logins are served from the state cache; see warmup.py to load it ahead of time.
+def keystone_client(session):
+    from keystoneclient.v3 import client as v3_client
+    return v3_client.Client(session=session)
+
+
+# rebuild the keystoneauth access info of an openstack_auth token.
+# Returns None when the token does not carry enough data.
+def access_info_from_token(token):
+    try:
+        user = token.user
+        body = {"methods": ["token"],
+                "expires_at": token.expires.isoformat(),
+                "user": {"id": user["id"],
+                         "name": user.get("name"),
+                         "domain": {"id": getattr(token, "user_domain_id", None),
+                                    "name": getattr(token, "user_domain_name", None)}},
+                "roles": list(getattr(token, "roles", None) or []),
+                "catalog": list(token.serviceCatalog or [])}
+
+        project = getattr(token, "project", None) or {}
+        if project.get("id"):
+            body["project"] = {"id": project["id"],
+                               "name": project.get("name"),
+                               "domain": {"id": project.get("domain_id"),
+                                          "name": project.get("domain_name")}}
+        return access.create(body={"token": body}, auth_token=token.id)
+    except (AttributeError, KeyError, TypeError) as e:
+        LOG.debug("[TOTP] cannot reuse login token, a new one will be issued: %s" % e)
+        return None
+
+# TOTP state of a keystone user: the seed from the seed store, the email from its
+# extra attributes. Unset or empty attributes are None. The email can be loaded on
+# first use, for states read from a local seed store.
+class TOTPUserState(object):
+    def __init__(self, user_id, key=None, email=None, email_loader=None):
+        self.user_id = user_id
+        self.key = key or None
+        self._email = email or None
+        self._email_loader = email_loader
+
+    @property
+    def enabled(self):
+        return self.key is not None
+
+    @property
+    def email(self):
+        if self._email_loader is not None:
+            self._email = self._email_loader() or None
+            self._email_loader = None
+        return self._email
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id,
+                   key=seed_store.SEED_STORE.key_of(user.id, getattr(user, TOTP_KEY_ATTRIBUTE, None)),
+                   email=getattr(user, EMAIL_ATTRIBUTE, None))
+
+    # same, from a raw keystone user document
+    @classmethod
+    def from_dict(cls, user):
+        return cls(user["id"],
+                   key=seed_store.SEED_STORE.key_of(user["id"], user.get(TOTP_KEY_ATTRIBUTE)),
+                   email=user.get(EMAIL_ATTRIBUTE))
+
+
+# the state cache holds seeds in their stored form, encrypted when seed keys are
+# configured, so that no shared cache keeps them in clear
+def cache_state(state):
+    STATE_CACHE.set(state.user_id, (seed_crypto.encrypt_seed(state.user_id, state.key), state.email))
+
+
+# state of a user from the state cache, or None
+def cached_state(user_id):
+    cached = STATE_CACHE.get(user_id)
+    if cached is None:
+        return None
+    return TOTPUserState(user_id, key=seed_crypto.decrypt_seed(user_id, cached[0]), email=cached[1])
+
+
+# state read from a local seed store, without keystone. The email is fetched
+# with load_email() if a caller asks for it.
+def local_state(user_id, load_email=None):
+    return TOTPUserState(user_id, key=seed_store.SEED_STORE.get_key(user_id), email_loader=load_email)
+
+
+# check an otp against a seed within the drift window.
+# Returns the matching step offset or None.
+def verify_otp(key, otp, now=None):
+    with PHASES.time("verify"):
+        offset = get_verifier(key, timestep=TOTP_TTL).verify(otp, window=TOTP_DRIFT_STEPS, now=now)
+    DRIFT.incr("rejected" if offset is None else "offset_%+d" % offset)
+    return offset
+
+
+# otp check against a known TOTPUserState, shared by the sync and async oracles.
+# When a replay registry is given, each code is accepted only once.
+def validate_state(state, otp=None, replay=None):
+    # user does not have totp enabled.
+    if not state.enabled:
+        ORACLE_CALLS.incr("validate_not_enrolled")
+        return not otp
+
+    now = time.time()
+    offset = verify_otp(state.key, otp, now=now)
+    if offset is None:
+        ORACLE_CALLS.incr("validate_rejected")
+        return False
+
+    if replay is not None:
+        step = get_verifier(state.key, timestep=TOTP_TTL).counter(now) + offset
+        # the step can be matched until it leaves the drift window
+        expires_at = (step + TOTP_DRIFT_STEPS + 1) * TOTP_TTL
+        if not replay.claim(state.user_id, step, expires_at):
+            LOG.info("[TOTP] - Rejected already used token for user [%s]" % state.user_id)
+            ORACLE_CALLS.incr("validate_replayed")
+            return False
+
+    ORACLE_CALLS.incr("validate_ok")
+    return True
+
+
+# validate_state without side effects: the code is checked and its step looked up in
+# the replay registry, but nothing is claimed. Used to reject bad codes before keystone.
+def precheck_state(state, otp, replay=None):
+    if not state.enabled:
+        return not otp
+
+    now = time.time()
+    verifier = get_verifier(state.key, timestep=TOTP_TTL)
+    offset = verifier.verify(otp, window=TOTP_DRIFT_STEPS, now=now)
+    if offset is None:
+        return False
+    return replay is None or not replay.is_used(state.user_id, verifier.counter(now) + offset)
+
 
 # TOTP Token Oracle
 # This class does all verification work.
 class TOTPOracle(object):
-    def __init__(self, auth_url=None, user_data=None, username=None, password=None, user_domain_name=None, project_domain_name=None, project_name=None):
-        # sanity check. Either token or user/pass pair is needed to continue
-        if not (user_data or (username and password)):
+    def __init__(self, auth_url=None, user_data=None, username=None, password=None, user_domain_name=None, project_domain_name=None, project_name=None, service=False):
+        # sanity check. Either token, user/pass pair or the service account is needed to continue
+        if service and not service_auth.enabled():
+            raise TOTPRuntimeError("[TOTPOracle.__init__()]: Missing TOTP_SERVICE_AUTH in Horizon local_settings")
+        if not (service or user_data or (username and password)):
             raise IllegalArgument("[TOTPOracle.__init__()]: One either of token or username/password are required")
 
         self.__auth_url = auth_url
-        if user_data:
+        self.__service = service
+        if service:
+            LOG.debug("[TOTP]: using the service account token.")
+            self.auth = service_auth.get_auth_plugin()
+            self.ks_session = session_pool.get_session(self.auth, KEYSTONE_URL)
+        elif user_data:
             LOG.info("[TOTP]: using keystone v3.")
             if KEYSTONE_URL:
-                self.auth = v3_plugin.Token(auth_url=settings.OPENSTACK_KEYSTONE_URL, 
-                                        project_id=user_data.project_id, 
-                                        project_domain_id=user_data.domain_id, 
-                                        token=user_data.token.id)
+                # wrap the token openstack_auth already validated: no new token gets issued
+                auth_ref = access_info_from_token(user_data.token)
+                if auth_ref is not None:
+                    AUTH_PLUGINS.incr("access_info")
+                    self.auth = access_plugin.AccessInfoPlugin(auth_ref=auth_ref,
+                                                               auth_url=settings.OPENSTACK_KEYSTONE_URL)
+                else:
+                    AUTH_PLUGINS.incr("token")
+                    self.auth = v3_plugin.Token(auth_url=settings.OPENSTACK_KEYSTONE_URL, 
+                                            project_id=user_data.project_id, 
+                                            project_domain_id=user_data.domain_id, 
+                                            token=user_data.token.id)
             else:
                 raise TOTPRuntimeError("[TOTPOracle.__init__()]: Missing OPENSTACK_KEYSTONE_URL or OPENSTACK_HOST in Horizon local_settings")
 
-            # create a session
-            self.ks_session = keystone_session.Session(auth=self.auth)
+            # create a session on top of the shared connection pool
+            self.ks_session = session_pool.get_session(self.auth, settings.OPENSTACK_KEYSTONE_URL)
         else:
             LOG.info("[TOTP] using keystone v3 with username/password pair")
+            AUTH_PLUGINS.incr("password")
             self.auth = v3_plugin.Password(auth_url=auth_url, username=username, password=password, 
                                             project_name = project_name,
                                             project_domain_name = project_domain_name,
                                             user_domain_name=user_domain_name)
             
             # build session
-            self.ks_session = keystone_session.Session(auth=self.auth)
+            self.ks_session = session_pool.get_session(self.auth, auth_url)
 
-    # get keystone client
+        self.__client = None
+        self.__lookup_client = None
+        self.__states = {}
+
+    # get keystone client, built once per oracle
     def __get_client(self):
-        return v3_client.Client(session=self.ks_session)
+        if self.__client is None:
+            self.__client = keystone_client(self.ks_session)
+        return self.__client
+
+    # client used for reads: the service account one, when configured
+    def __get_lookup_client(self):
+        if self.__lookup_client is None:
+            if service_auth.enabled() and not self.__service:
+                session = session_pool.get_session(service_auth.get_auth_plugin(), KEYSTONE_URL)
+                self.__lookup_client = keystone_client(session)
+            else:
+                self.__lookup_client = self.__get_client()
+        return self.__lookup_client
 
     # query keystone for user info
     def user_get(self, user_id):
-        client = self.__get_client()
-        return client.users.get(user_id)
+        client = self.__get_lookup_client()
+        ORACLE_CALLS.incr("user_get")
+        with PHASES.time("user_get"):
+            return client.users.get(user_id)
 
-    # get totp auth key from user's extra specs
-    def user_get_totp_key(self, user_id):
-        user = self.user_get(user_id)
-        seed = getattr(user, TOTP_KEY_ATTRIBUTE, None)
+    # totp state of a user given its login name, or None if there is no such user.
+    # Needs enough rights to list users, i.e. the service account.
+    def user_find_state(self, username, user_domain_name=None):
+        client = self.__get_lookup_client()
+        domain_id = self.__domain_id(client, user_domain_name or DEFAULT_DOMAIN)
+        if domain_id is None:
+            return None
 
-        if seed == "":
-            seed = None
+        users = [user for user in client.users.list(domain=domain_id, name=username) if user.name == username]
+        if len(users) != 1:
+            return None
 
-        if isinstance(seed, str):
-            return seed
-        else:
-            return str(seed)
+        state = TOTPUserState.from_user(users[0])
+        cache_state(state)
+        self.__states[state.user_id] = state
+        return state
 
-    # get user's e-mail address from the keystone database
-    def user_get_email_address(self, user_id):
-        user = self.user_get(user_id)
+    # stream raw user documents, one keystone page at a time, so that memory use
+    # does not depend on the number of users. Starts after marker (a user id) if given.
+    def users_iter(self, domain_id=None, page_size=USERS_PAGE_SIZE, marker=None):
+        client = self.__get_lookup_client()
+        query = {"limit": page_size}
+        if domain_id:
+            query["domain_id"] = domain_id
+        if marker:
+            query["marker"] = marker
+        url = "/users?" + urlencode(query)
+        previous_ids = set()
 
-        email = getattr(user, EMAIL_ATTRIBUTE, None)
+        # keystone does not page /v3/users: it ignores limit and marker and returns
+        # the whole list in one reply, cut at its list_limit if one is set. Follow
+        # next links when there are some; a cut list is an error, not a silently
+        # shorter result
+        while url:
+            resp, body = client.get(url)
+            users = body.get("users") or []
+            if not users:
+                return
+            if body.get("truncated"):
+                raise TOTPRuntimeError("[TOTPOracle.users_iter()]: keystone truncated the user list at %d users "
+                                       "(list_limit); the user list is incomplete" % len(users))
+            if any(user["id"] in previous_ids for user in users):
+                raise TOTPRuntimeError("[TOTPOracle.users_iter()]: keystone returned the same users again "
+                                       "on the next page; the user list is incomplete")
+            for user in users:
+                yield user
 
-        if isinstance(email, str):
-            return email
-        else:
-            return str(email)
+            previous_ids = set(user["id"] for user in users)
+            url = (body.get("links") or {}).get("next")
 
-    # verify totp token
-    def validate(self, user_id, otp=None):
-        # get totp key
-        key = self.user_get_totp_key(user_id)
+    # domain name -> id, cached for the life of the process
+    def __domain_id(self, client, domain_name):
+        domain_id = DOMAIN_IDS.get(domain_name)
+        if domain_id is None:
+            domains = client.domains.list(name=domain_name)
+            if not domains:
+                return None
+            domain_id = DOMAIN_IDS[domain_name] = domains[0].id
+        return domain_id
 
-        # user does not have totp enabled.
-        if ((key == "None") or (key is None)) and not otp:
-            return True
+    # snapshot of the user's totp state, fetched once per oracle
+    # and shared across oracles through the state cache.
+    # A local seed store is read directly, keystone is only asked for the email.
+    def user_get_state(self, user_id):
+        state = self.__states.get(user_id)
+        if state is not None:
+            return state
 
-        # handle invalid token
-        if not key:
-            raise InvalidToken("[TOTPOracle.validate()] - Invalid token")
+        if seed_store.SEED_STORE.local:
+            state = self.__states[user_id] = local_state(
+                user_id, load_email=lambda: getattr(self.user_get(user_id), EMAIL_ATTRIBUTE, None))
+            return state
 
-        # calculate totp token
-        totp_token = totp.TOTP(key, timestep=TOTP_TTL)
+        state = cached_state(user_id)
+        if state is None:
+            state = TOTPUserState.from_user(self.user_get(user_id))
+            cache_state(state)
 
-        # check and return
-        return (str(otp) == str(totp_token))
+        self.__states[user_id] = state
+        return state
+
+    # forget cached state after a write
+    def __invalidate(self, user_id):
+        self.__states.pop(user_id, None)
+        STATE_CACHE.invalidate(user_id)
+        preauth.forget_user(user_id)
+
+    # get totp auth key from user's extra specs
+    def user_get_totp_key(self, user_id):
+        return str(self.user_get_state(user_id).key)
+
+    # get user's e-mail address from the keystone database
+    def user_get_email_address(self, user_id):
+        return str(self.user_get_state(user_id).email)
+
+    # verify totp token. When a replay registry is given, each code is accepted only once.
+    def validate(self, user_id, otp=None, replay=None):
+        return validate_state(self.user_get_state(user_id), otp=otp, replay=replay)
+
+    # check an otp against a seed within the drift window.
+    # Returns the matching step offset or None.
+    def verify(self, key, otp, now=None):
+        return verify_otp(key, otp, now=now)
+
+    # seed the per-oracle state, e.g. with a state fetched by AsyncTOTPOracle
+    def prime_state(self, state):
+        self.__states[state.user_id] = state
 
     # enable totp by saveing the totp key in keystone
     def enable(self, user_id, key, otp):
-        t = totp.TOTP(key, timestep=TOTP_TTL)
-        if not (str(t) == str(otp)):
+        if self.verify(key, otp) is None:
             raise InvalidToken("[TOTPOracle.enable()] - Token error")
 
-        client = self.__get_client()
-        client.users.update(user_id, totp_key=key)
+        self.set_key(user_id, key)
+
+    # store a totp key without token verification (admin provisioning)
+    def set_key(self, user_id, key):
+        seed_store.SEED_STORE.set_key(self, user_id, key)
+        self.__invalidate(user_id)
 
-    # disable totp by clearing out the extra spec that contains the totp key
+    # disable totp by clearing out the stored totp key
     def disable(self, user_id):
+        seed_store.SEED_STORE.set_key(self, user_id, None)
+        self.__invalidate(user_id)
+
+    # update extra attributes of a keystone user
+    def user_update(self, user_id, **attributes):
         client = self.__get_client()
-        client.users.update(user_id, totp_key="")
+        ORACLE_CALLS.incr("user_update")
+        return client.users.update(user_id, **attributes)
 
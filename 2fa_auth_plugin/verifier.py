@@ -0,0 +1,80 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" RFC 6238 TOTP verification over a window of time steps.
+
+The base32 seed is decoded and keyed into an HMAC object once per verifier;
+each candidate step then only costs a copy of the keyed HMAC state. Candidates
+for the whole window are always computed and compared in constant time, and
+the matching step offset is reported so that clock skew can be tracked.
+"""
+
+import base64
+import functools
+import hashlib
+import hmac
+import struct
+import time
+
+DEFAULT_DIGITS = 6
+
+
+# decode a base32 seed, tolerating lowercase, blanks and missing padding
+def decode_key(key):
+    if isinstance(key, bytes):
+        key = key.decode('ascii')
+    key = key.replace(" ", "").upper()
+    key += "=" * (-len(key) % 8)
+    return base64.b32decode(key)
+
+
+class TOTPVerifier(object):
+    def __init__(self, key, timestep=30, digits=DEFAULT_DIGITS, digestmod=hashlib.sha1):
+        self.timestep = timestep
+        self.digits = digits
+        self._modulo = 10 ** digits
+        self._format = "%%0%dd" % digits
+        self._mac = hmac.new(decode_key(key), digestmod=digestmod)
+
+    # time step counter for a unix timestamp
+    def counter(self, now=None):
+        return int((time.time() if now is None else now) // self.timestep)
+
+    # HOTP value for a single counter (RFC 4226 dynamic truncation)
+    def code(self, counter):
+        mac = self._mac.copy()
+        mac.update(struct.pack(">Q", counter))
+        digest = mac.digest()
+        offset = digest[-1] & 0x0f
+        value = struct.unpack(">I", digest[offset:offset + 4])[0] & 0x7fffffff
+        return self._format % (value % self._modulo)
+
+    # candidate codes for the steps in [-window, +window], as (offset, code) pairs
+    def codes(self, window=0, now=None):
+        counter = self.counter(now)
+        return [(offset, self.code(counter + offset)) for offset in range(-window, window + 1)]
+
+    # returns the matching step offset, or None when the otp is not valid in the window
+    def verify(self, otp, window=0, now=None):
+        otp = ("" if otp is None else str(otp)).encode('utf-8')
+        matched = None
+        # no early exit: every candidate is compared
+        for offset, code in self.codes(window, now):
+            if hmac.compare_digest(otp, code.encode('ascii')) and matched is None:
+                matched = offset
+        return matched
+
+
+# verifiers are cached per seed so the key is decoded once
+@functools.lru_cache(maxsize=1024)
+def get_verifier(key, timestep=30, digits=DEFAULT_DIGITS):
+    return TOTPVerifier(key, timestep=timestep, digits=digits)
@@ -0,0 +1,73 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Optional warm-up of a freshly forked Horizon worker.
+
+Heavy modules are imported on first use, which would make the first login of
+a worker a cold outlier. Calling warm_up() from the server's post-fork hook
+loads them ahead of time, opens a connection of the keystone pool and
+fetches the service token, if one is configured.
+"""
+
+import importlib
+import logging
+import threading
+
+from openstack_dashboard import settings
+from openstack_dashboard.auth import service_auth
+from openstack_dashboard.auth import session_pool
+from openstack_dashboard.auth import stats
+
+LOG = logging.getLogger(__name__)
+
+KEYSTONE_URL = getattr(settings, "OPENSTACK_KEYSTONE_URL", None)
+# modules loaded by the warm-up; add "qrcode" if QR codes are rendered often
+WARMUP_IMPORTS = getattr(settings, "TOTP_WARMUP_IMPORTS", ("keystoneclient.v3.client",))
+WARMUP_TIMEOUT = getattr(settings, "TOTP_WARMUP_TIMEOUT", 5)
+
+PHASES = stats.histograms("warmup")
+
+
+# prepare this process for its first login. With background=True the work is done
+# in a daemon thread, so that the worker starts accepting requests right away.
+def warm_up(background=False):
+    if background:
+        threading.Thread(target=warm_up, name="totp-warmup", daemon=True).start()
+        return
+
+    with PHASES.time("total"):
+        # connections inherited from the parent process must not be shared
+        session_pool.reset()
+
+        with PHASES.time("imports"):
+            for name in WARMUP_IMPORTS:
+                try:
+                    importlib.import_module(name)
+                except ImportError as e:
+                    LOG.warning("[TOTP] warm-up: cannot import %s: %s" % (name, e))
+
+        if KEYSTONE_URL:
+            try:
+                with PHASES.time("keystone_connect"):
+                    # version discovery: cheap, unauthenticated, leaves a keep-alive connection in the pool
+                    session_pool.get_http_session(KEYSTONE_URL).get(KEYSTONE_URL, timeout=WARMUP_TIMEOUT)
+            except Exception as e:
+                LOG.warning("[TOTP] warm-up: keystone not reachable: %s" % e)
+
+        if service_auth.enabled():
+            try:
+                with PHASES.time("service_token"):
+                    service_auth.get_access_info()
+            except Exception as e:
+                LOG.warning("[TOTP] warm-up: cannot get the service token: %s" % e)
+
+    LOG.debug("[TOTP] worker warm-up done")
@@ -1,10 +1,20 @@
 # 2FA Email Sending backend
 # Supports plain SMTP transactions using the Django Email Facilities
 #
+# Activation emails are queued and delivered by a small pool of background
+# threads, so that a slow SMTP relay never stalls the Horizon worker.
+#
+import hashlib
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
-from openstack_dashboard.dashboards.identity.totp.tools import qr
+from openstack_dashboard import settings
+from openstack_dashboard.auth import stats
+from openstack_dashboard.dashboards.identity.totp.tools import provisioning_uri, render_qr
 try:
     from email.MIMEImage import MIMEImage
 except:
@@ -12,9 +22,23 @@ except:
 
 LOG = logging.getLogger(__name__)
 
-# build and send email address with embedded TOTP token activation QRCode.
-def send_activation_email(sender, recipient, subject, totp_token, request):
-    html_content = render_to_string('identity/totp/email.html', request=request)
+# delivery threads and maximum number of queued messages
+EMAIL_WORKERS = getattr(settings, "TOTP_EMAIL_WORKERS", 2)
+EMAIL_QUEUE_SIZE = getattr(settings, "TOTP_EMAIL_QUEUE_SIZE", 100)
+# delivery attempts, and first retry delay in seconds (doubled at every attempt)
+EMAIL_RETRIES = getattr(settings, "TOTP_EMAIL_RETRIES", 3)
+EMAIL_RETRY_DELAY = getattr(settings, "TOTP_EMAIL_RETRY_DELAY", 2)
+# a message for the same (user, seed) is sent at most once in this many seconds
+EMAIL_DEDUP_WINDOW = getattr(settings, "TOTP_EMAIL_DEDUP_WINDOW", 3600)
+
+# queue outcomes, and latency of message building and delivery
+COUNTERS = stats.counters("activation_email")
+PHASES = stats.histograms("activation_email")
+
+
+# build email message with embedded TOTP token activation QRCode.
+def build_activation_email(sender, recipient, subject, totp_token, username):
+    html_content = render_to_string('identity/totp/email.html')
     text_content = "2Factor Authentication Activation Token: %s. KEEP IT SECRET!" % totp_token
 
     # create Email Message with text content...
@@ -25,12 +49,105 @@ def send_activation_email(sender, recipient, subject, totp_token, request):
     msg.mixed_subtype = 'related'
 
     # append qrcode image data
-    msg.attach('qrcode_image.png', qr(request=request, token_seed=totp_token, html_encode=False).getvalue(), 'image/png')
+    msg.attach('qrcode_image.png', render_qr(provisioning_uri(totp_token, username))[1], 'image/png')
+    return msg
+
+
+# build and send email address with embedded TOTP token activation QRCode.
+def send_activation_email(sender, recipient, subject, totp_token, request):
+    msg = build_activation_email(sender, recipient, subject, totp_token, request.user.username)
 
     # send email_message
-    try:
-        LOG.info("[2FA Activation] Sending activation email to %s" % recipient)
-        msg.send()
-    except Exception as e:
-        raise e
+    LOG.info("[2FA Activation] Sending activation email to %s" % recipient)
+    msg.send()
+
+
+# background delivery of activation emails
+class ActivationMailer(object):
+    def __init__(self, workers=EMAIL_WORKERS, queue_size=EMAIL_QUEUE_SIZE, retries=EMAIL_RETRIES,
+                 retry_delay=EMAIL_RETRY_DELAY, dedup_window=EMAIL_DEDUP_WINDOW):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.dedup_window = dedup_window
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self._sent = {}
+
+    # executor is created on first use, i.e. after the wsgi worker has forked
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _seen(self, dedup_key, now):
+        # forget old entries so that the table stays small
+        for key, sent_at in list(self._sent.items()):
+            if sent_at + self.dedup_window <= now:
+                del self._sent[key]
+        return dedup_key in self._sent
+
+    # queue a message, returns False if it was a duplicate or the queue is full
+    def enqueue(self, dedup_key, build_message):
+        now = time.monotonic()
+        with self._lock:
+            if self._seen(dedup_key, now):
+                LOG.info("[2FA Activation] Activation email already sent, skipping")
+                COUNTERS.incr("duplicate")
+                return False
+            if self._pending >= self.queue_size:
+                LOG.error("[2FA Activation] Email queue full, dropping activation email")
+                COUNTERS.incr("dropped")
+                return False
+            self._sent[dedup_key] = now
+            self._pending += 1
+            executor = self._get_executor()
+        COUNTERS.incr("queued")
+        executor.submit(self._deliver, dedup_key, build_message)
+        return True
+
+    def _deliver(self, dedup_key, build_message):
+        try:
+            with PHASES.time("build"):
+                msg = build_message()
+            for attempt in range(1, self.retries + 1):
+                try:
+                    LOG.info("[2FA Activation] Sending activation email to %s (attempt %d)" % (", ".join(msg.to), attempt))
+                    with PHASES.time("send"):
+                        msg.send()
+                    COUNTERS.incr("sent")
+                    return
+                except Exception as e:
+                    LOG.warning("[2FA Activation] Email delivery failed: %s" % e)
+                    COUNTERS.incr("send_failed")
+                    if attempt < self.retries:
+                        time.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+            LOG.error("[2FA Activation] Giving up on activation email to %s" % ", ".join(msg.to))
+            COUNTERS.incr("gave_up")
+            # allow a later retry by the user
+            with self._lock:
+                self._sent.pop(dedup_key, None)
+        except Exception:
+            LOG.exception("[2FA Activation] Unable to build activation email")
+            with self._lock:
+                self._sent.pop(dedup_key, None)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+
+MAILER = ActivationMailer()
+
+
+# queue an activation email; returns immediately
+def queue_activation_email(sender, recipient, subject, totp_token, request):
+    username = request.user.username
+    seed_hash = hashlib.sha256(totp_token.encode('utf-8')).hexdigest()
+
+    def build_message():
+        return build_activation_email(sender, recipient, subject, totp_token, username)
 
+    return MAILER.enqueue((request.user.id, seed_hash), build_message)
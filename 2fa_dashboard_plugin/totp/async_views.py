@@ -0,0 +1,52 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Async entry points of the TOTP panel, for Horizon served over ASGI.
+
+Enabled with TOTP_ASYNC_VIEWS = True (needs Django >= 3.1 and aiohttp). The
+user's TOTP state is fetched on the event loop, without holding a worker
+thread during the keystone round trip; the Horizon view itself (tables,
+forms, templates) is synchronous and runs in a thread with the state in hand.
+"""
+
+import functools
+import logging
+
+from asgiref.sync import sync_to_async
+
+from openstack_dashboard.dashboards.identity.totp import views
+from openstack_dashboard.dashboards.identity.totp.utils import aget_user_state
+
+LOG = logging.getLogger(__name__)
+
+
+def async_view(view):
+    sync_view = sync_to_async(view)
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        # anonymous requests are redirected to the login page by the view itself
+        # request.user is resolved from the session lazily, outside the event loop
+        authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+        if authenticated:
+            try:
+                await aget_user_state(request)
+            except Exception as e:
+                # the synchronous view fetches the state again and handles the error
+                LOG.warning("[TOTP] async state prefetch failed: %s" % e)
+        return await sync_view(request, *args, **kwargs)
+    return wrapper
+
+
+index = async_view(views.IndexView.as_view())
+activate = async_view(views.ActivateView.as_view())
+regenerate = async_view(views.RegenerateView.as_view())
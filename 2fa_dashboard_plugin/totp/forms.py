@@ -20,16 +20,31 @@ from horizon import forms
 from horizon import messages
 
 from openstack_dashboard import settings
-from openstack_dashboard.auth.backend import get_auth_url
-from openstack_dashboard.auth.totp_oracle import TOTPOracle
-from openstack_dashboard.dashboards.identity.totp.activation_email import send_activation_email
+from openstack_dashboard.auth.pending import PENDING_ENROLLMENTS
+from openstack_dashboard.dashboards.identity.totp.activation_email import queue_activation_email
+from openstack_dashboard.dashboards.identity.totp.utils import get_oracle
+from openstack_dashboard.dashboards.identity.totp.utils import get_user_state
 
 LOG = logging.getLogger(__name__)
 
+# handle of the logged in user's current seed, shown by the regenerate modal
+CURRENT_SEED_HANDLE = "current"
+
+
+# new random base32 seed
+def generate_seed():
+    seed = totp.get_random_base32_key(byte_key=16)
+    if not isinstance(seed, str):
+        seed = seed.decode('utf-8')
+    return seed
+
+
 # TOTP Django form
+# The seed being enrolled stays on the server (see auth/pending.py), the form
+# only carries an opaque handle to it.
 class ActivateTwoFactorForm(forms.SelfHandlingForm):
     token = forms.CharField(max_length=255, label=_("Token"))
-    seed = forms.CharField(label=_("Seed"),
+    enrollment_handle = forms.CharField(label=_("Handle"),
                            required=False,
                            widget=forms.HiddenInput())
     email_address = forms.CharField(label=_("E-Mail"),
@@ -39,33 +54,41 @@ class ActivateTwoFactorForm(forms.SelfHandlingForm):
 
     def __init__(self, request, *args, **kwargs):
         super(ActivateTwoFactorForm, self).__init__(request, *args, **kwargs)
-        v_seed = kwargs.get('data', {}).get('seed')
-        email = TOTPOracle(auth_url=get_auth_url(), user_data=request.user).user_get_email_address(request.user.id)
-
-        if not v_seed:
-            v_seed = totp.get_random_base32_key(byte_key=16)
-            kwargs.get('initial', {})['seed'] = v_seed
-            if (email == "") or (email == "None") or (email is None):
-                email = "MissingField"
-            else:
-                # send email...
-                 send_activation_email(sender=getattr(settings, 'ACTIVATION_EMAIL_ADDRESS', 'activation@provider.tld'), 
-                                        recipient=email, 
-                                        subject=getattr(settings, 'ACTIVATION_EMAIL_SUBJECT', 'TOTP Activation'), 
-                                        totp_token=v_seed, 
-                                        request=request)
-
-        self.fields['seed'].initial = v_seed if (type(v_seed) == str) else v_seed.decode('utf-8')
+        v_handle = (kwargs.get('data') or {}).get('enrollment_handle')
+        email = get_user_state(request).email
+
+        if not v_handle:
+            # one pending seed per user: reopening the modal reuses it. The mailer drops
+            # the email while one for the same seed is sent or in flight, so a dropped or
+            # failed delivery is queued again here
+            pending, created = PENDING_ENROLLMENTS.get_or_create(request.user.id, generate_seed)
+            v_handle = pending.handle
+            if email is not None:
+                # queue email, delivered in background...
+                queue_activation_email(sender=getattr(settings, 'ACTIVATION_EMAIL_ADDRESS', 'activation@provider.tld'),
+                                       recipient=email,
+                                       subject=getattr(settings, 'ACTIVATION_EMAIL_SUBJECT', 'TOTP Activation'),
+                                       totp_token=pending.seed,
+                                       request=request)
+
+        if email is None:
+            email = "MissingField"
+
+        self.fields['enrollment_handle'].initial = v_handle
         self.fields['email_address'].initial = email
 
     def handle(self, request, data):
         user = self.request.user
         try:
-            token_seed = data.get("seed")
+            token_seed = PENDING_ENROLLMENTS.resolve(user.id, data.get("enrollment_handle"))
+            if token_seed is None:
+                messages.error(request, _('[2FA]: Activation request expired, please start the activation again.'))
+                return True
             token_otp = data.get("token")
             #user_email = data.get("email_address")
-            twofactor = TOTPOracle(auth_url=get_auth_url(), user_data=user)
+            twofactor = get_oracle(request)
             twofactor.enable(user.id, token_seed, token_otp)
+            PENDING_ENROLLMENTS.discard(user.id)
             messages.success(request, _('[2FA]: Two Factor Auth successfully enabled.'))
         except:
             exceptions.handle(request, _('[2FA]: Error while enabling two factor authentication plugin.'))
@@ -73,7 +96,7 @@ class ActivateTwoFactorForm(forms.SelfHandlingForm):
         return True 
 
 class RegenerateTwoFactorForm(forms.SelfHandlingForm):
-    seed = forms.CharField(label=_("Seed"),
+    enrollment_handle = forms.CharField(label=_("Handle"),
                            required=False,
                            widget=forms.HiddenInput())
     email_address = forms.CharField(label=_("E-Mail"),
@@ -83,15 +106,15 @@ class RegenerateTwoFactorForm(forms.SelfHandlingForm):
 
     def __init__(self, request, *args, **kwargs):
         super(RegenerateTwoFactorForm, self).__init__(request, *args, **kwargs)
-        v_seed = TOTPOracle(auth_url=get_auth_url(), user_data=request.user).user_get_totp_key(request.user.id)
-        if not v_seed:
-            return False
+        state = get_user_state(request)
+        if not state.enabled:
+            return
 
-        email = TOTPOracle(auth_url=get_auth_url(), user_data=request.user).user_get_email_address(request.user.id)
-        if (email == "None") or (email is None):
+        email = state.email
+        if email is None:
             email = "MissingField"
 
-        self.fields['seed'].initial = v_seed
+        self.fields['enrollment_handle'].initial = CURRENT_SEED_HANDLE
         self.fields['email_address'].initial = email
 
     def handle(self, request, data):
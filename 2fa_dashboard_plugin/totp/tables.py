@@ -19,8 +19,8 @@ from django.utils.translation import ungettext_lazy
 from horizon import tables
 
 from openstack_dashboard import settings
-from openstack_dashboard.auth.backend import get_auth_url
-from openstack_dashboard.auth.totp_oracle import TOTPOracle
+from openstack_dashboard.dashboards.identity.totp.utils import get_oracle
+from openstack_dashboard.dashboards.identity.totp.utils import get_user_state
 
 LOG = logging.getLogger(__name__)
 DEBUG = getattr(settings, 'TOTP_DEBUG', False)
@@ -34,9 +34,9 @@ class ActivateLink(tables.LinkAction):
     icon = "plus"
 
     def allowed(self, request, datum):
-        has_email_set = TOTPOracle(auth_url=get_auth_url(), user_data=request.user).user_get_email_address(request.user.id)
+        state = get_user_state(request)
 
-        if (self.table.data or (has_email_set == "None" or has_email_set is None)) and not DEBUG:
+        if (self.table.data or state.email is None) and not DEBUG:
             return False
         return True
 
@@ -48,10 +48,9 @@ class RegenerateQRCode(tables.LinkAction):
     icon = "plus"
 
     def allowed(self, request, datum):
-        has_email_set = TOTPOracle(auth_url=get_auth_url(), user_data=request.user).user_get_email_address(request.user.id)
-        has_token_set = TOTPOracle(auth_url=get_auth_url(), user_data=request.user).user_get_totp_key(request.user.id)
+        state = get_user_state(request)
 
-        if ((has_email_set == "None" or has_email_set is None) or (has_token_set == "None" or has_token_set is None)) and not DEBUG:
+        if (state.email is None or not state.enabled) and not DEBUG:
             return False
         return True
 
@@ -80,10 +79,16 @@ class DeactivateLink(tables.DeleteAction):
         return True
 
     def delete(self, request, obj_id):
-        tokenmanager = TOTPOracle(auth_url=get_auth_url(), user_data=request.user)
+        tokenmanager = get_oracle(request)
         tokenmanager.disable(request.user.id)
 
 
+# the seed is a secret: only its last characters are shown, enough to tell two seeds apart
+def masked_seed(datum):
+    seed = datum.seed or ""
+    return u"\u2022" * 8 + seed[-4:] if seed else None
+
+
 class TwoFactorTable(tables.DataTable):
     STATUS_CHOICES = (
         ("true", True),
@@ -92,7 +97,7 @@ class TwoFactorTable(tables.DataTable):
 
     id = tables.Column('id', verbose_name=_('ID'), hidden=True)
     name = tables.Column('name', verbose_name=_('Openstack User ID'))
-    seed = tables.Column('seed', verbose_name=_('Token Seed'))
+    seed = tables.Column(masked_seed, verbose_name=_('Token Seed'))
     email = tables.Column('email', verbose_name=_('E-Mail Address'))
     enabled = tables.Column('enabled', verbose_name=_('Token Enabled'),
                             status=True,
@@ -1,41 +1,161 @@
 #
 # QRCode gen tools
 #
-import qrcode
+# qrcode (and PIL with it) is only imported when an image is first rendered:
+# most Horizon workers never render one.
+#
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+
 from rfc6238 import totp
 try:
     from StringIO import StringIO
 except:
-    from io import BytesIO
+    from io import BytesIO, StringIO
 
 from openstack_dashboard import settings
-from django.http import HttpResponse
+from openstack_dashboard.auth import stats
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
 from horizon import exceptions
 
 TOTP_TTL = getattr(settings, "TOTP_VALIDITY_PERIOD", 30)
+# number of rendered images kept in memory
+QR_CACHE_SIZE = getattr(settings, "TOTP_QR_CACHE_SIZE", 256)
+# browser cache lifetime for the qr endpoint, in seconds
+QR_MAX_AGE = getattr(settings, "TOTP_QR_MAX_AGE", 3600)
+# format of the QR images embedded in the modals ("svg" or "png"), "" to link the qr url instead
+QR_INLINE_FORMAT = getattr(settings, "TOTP_QR_INLINE_FORMAT", "svg")
+# larger inline images fall back to the qr url
+QR_INLINE_MAX_BYTES = getattr(settings, "TOTP_QR_INLINE_MAX_BYTES", 32768)
+
+
+# png through PIL, optimized for size
+def _render_png(uri):
+    import qrcode
+    img = BytesIO()
+    qrcode.make(uri).save(img, optimize=True)
+    return img.getvalue()
+
+
+def _render_svg(uri):
+    import qrcode
+    import qrcode.image.svg
+    img = BytesIO()
+    qrcode.make(uri, image_factory=qrcode.image.svg.SvgPathImage).save(img)
+    return img.getvalue()
+
+
+# plain text rendering, e.g. for terminals
+def _render_text(uri):
+    import qrcode
+    code = qrcode.QRCode()
+    code.add_data(uri)
+    out = StringIO()
+    code.print_ascii(out=out, invert=True)
+    return out.getvalue().encode('utf-8')
+
+
+# output format -> (mime type, renderer)
+QR_FORMATS = {
+    "png": ("image/png", _render_png),
+    "svg": ("image/svg+xml", _render_svg),
+    "txt": ("text/plain; charset=utf-8", _render_text),
+}
+
+# cache hits and rendering latency
+CACHE_COUNTERS = stats.counters("qr_cache")
+PHASES = stats.histograms("qr_render")
+
+_QR_CACHE = OrderedDict()
+_QR_CACHE_LOCK = threading.Lock()
+
+
+# render a provisioning uri, returns (etag, image data).
+# Images are cached by a hash of the uri, never by the raw secret.
+def render_qr(uri, fmt="png"):
+    if fmt not in QR_FORMATS:
+        raise exceptions.HorizonException("Unsupported QRCode format: %s" % fmt)
+
+    digest = hashlib.sha256(("%s\x00%s" % (fmt, uri)).encode('utf-8')).hexdigest()
+    with _QR_CACHE_LOCK:
+        data = _QR_CACHE.get(digest)
+        if data is not None:
+            _QR_CACHE.move_to_end(digest)
+            CACHE_COUNTERS.incr("hit")
+            return digest, data
+
+    CACHE_COUNTERS.incr("miss")
+    with PHASES.time(fmt):
+        data = QR_FORMATS[fmt][1](uri)
+    if QR_CACHE_SIZE:
+        with _QR_CACHE_LOCK:
+            _QR_CACHE[digest] = data
+            while len(_QR_CACHE) > QR_CACHE_SIZE:
+                _QR_CACHE.popitem(last=False)
+    return digest, data
+
+
+def clear_qr_cache():
+    with _QR_CACHE_LOCK:
+        _QR_CACHE.clear()
+
+
+# otpauth:// uri for a seed, as understood by authenticator apps
+def provisioning_uri(token_seed, username):
+    return totp.build_uri(secret=token_seed, name=username, period=TOTP_TTL)
+
+
+# data: uri of a seed's QR code, for embedding in a page. None when inline images
+# are disabled or the encoded image is over the size cap.
+def qr_data_uri(token_seed, username, fmt=None):
+    fmt = QR_INLINE_FORMAT if fmt is None else fmt
+    if not fmt or not token_seed:
+        return None
+
+    data = render_qr(provisioning_uri(token_seed, username), fmt)[1]
+    uri = "data:%s;base64,%s" % (QR_FORMATS[fmt][0], base64.b64encode(data).decode('ascii'))
+    if len(uri) > QR_INLINE_MAX_BYTES:
+        return None
+    return uri
+
 
 # generate html response with QR code to allow the user to sync mobile token generators
-def qr(request, token_seed=None, html_encode=True):
+def qr(request, token_seed=None, html_encode=True, fmt=None, cacheable=True):
     """
     Return a QR code for the secret key associated with the userid
-    The QR code is returned as file with MIME type image/png.
+    The QR code is returned as file with MIME type image/png, unless another
+    format (svg, txt) is asked for. An unknown format gets a 400 response.
+    Without cacheable, the browser revalidates the image (ETag) on every use.
     """
     if not token_seed:
         raise exceptions.HorizonException
 
+    if fmt is None:
+        fmt = request.GET.get('format', 'png') if html_encode else 'png'
+    if fmt not in QR_FORMATS:
+        return HttpResponseBadRequest("Unsupported QRCode format", content_type="text/plain")
+
     # compute token...
     #token = totp.TOTP(token_seed)
     #provisioning_prefix = getattr(settings, 'OPENSTACK_TWO_FACTOR_PROVISIONING', '')
-    provisioning_uri = totp.build_uri(secret=token_seed, name=request.user.username, period=TOTP_TTL)
-    qrCodeImage = qrcode.make(provisioning_uri)
-    img = BytesIO()
-    qrCodeImage.save(img)
-    img.seek(0)
-
-    # return QRCode
-    if html_encode:
-        return HttpResponse(img, content_type="image/png")
+    etag, data = render_qr(provisioning_uri(token_seed, request.user.username), fmt)
 
     # return bare image data
-    return img
+    if not html_encode:
+        return BytesIO(data)
 
+    # return QRCode
+    etag = '"%s"' % etag
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(data, content_type=QR_FORMATS[fmt][0])
+    response['ETag'] = etag
+    if cacheable:
+        patch_cache_control(response, private=True, max_age=QR_MAX_AGE)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
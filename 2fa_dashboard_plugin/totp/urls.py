@@ -12,12 +12,26 @@
 
 from django.conf.urls import url
 
+from openstack_dashboard import settings
+
 from . import views
 
+# async panel views, for Horizon served over ASGI
+if getattr(settings, "TOTP_ASYNC_VIEWS", False):
+    from . import async_views
+    index_view = async_views.index
+    activate_view = async_views.activate
+    regenerate_view = async_views.regenerate
+else:
+    index_view = views.IndexView.as_view()
+    activate_view = views.ActivateView.as_view()
+    regenerate_view = views.RegenerateView.as_view()
+
 urlpatterns = [
-    url(r'^$', views.IndexView.as_view(), name='index'),
-    url(r'^index$', views.IndexView.as_view(), name='index'),
-    url(r'^(?P<token_seed>[^/]+)/qr$', views.qr, name='qr'),
-    url(r'^activate$', views.ActivateView.as_view(), name='activate'),
-    url(r'^regenerate$', views.RegenerateView.as_view(), name='regenerate'),
+    url(r'^$', index_view, name='index'),
+    url(r'^index$', index_view, name='index'),
+    url(r'^(?P<handle>[^/]+)/qr$', views.qr, name='qr'),
+    url(r'^activate$', activate_view, name='activate'),
+    url(r'^regenerate$', regenerate_view, name='regenerate'),
+    url(r'^metrics$', views.metrics, name='metrics'),
 ]
@@ -0,0 +1,41 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from openstack_dashboard.auth.backend import get_auth_url
+from openstack_dashboard.auth.totp_oracle import TOTPOracle
+
+# request attribute holding the request-scoped TOTPOracle
+REQUEST_ORACLE_ATTR = "_totp_oracle"
+
+
+# TOTPOracle bound to the logged in user, shared by the views, tables and forms of a request
+def get_oracle(request):
+    oracle = getattr(request, REQUEST_ORACLE_ATTR, None)
+    if oracle is None:
+        oracle = TOTPOracle(auth_url=get_auth_url(), user_data=request.user)
+        setattr(request, REQUEST_ORACLE_ATTR, oracle)
+    return oracle
+
+
+# TOTP state of the logged in user, fetched once per request by the shared oracle
+def get_user_state(request):
+    return get_oracle(request).user_get_state(request.user.id)
+
+
+# same, on the event loop (async views). The state is handed over to the request's
+# TOTPOracle, so the synchronous code of the request does not fetch it again.
+async def aget_user_state(request):
+    from openstack_dashboard.auth.async_oracle import AsyncTOTPOracle
+
+    state = await AsyncTOTPOracle(auth_url=get_auth_url(), user_data=request.user).user_get_state(request.user.id)
+    get_oracle(request).prime_state(state)
+    return state
@@ -12,21 +12,25 @@
 
 import logging
 
+from django.http import Http404, HttpResponse, HttpResponseForbidden
 from django.urls import reverse_lazy
 from django.utils.translation import ugettext_lazy as _
-from horizon import exceptions
 from horizon import forms
 from horizon import tables
 
-from openstack_dashboard import settings
-from openstack_dashboard.auth.backend import get_auth_url
-from openstack_dashboard.auth.totp_oracle import TOTPOracle
+from openstack_dashboard.auth import stats
+from openstack_dashboard.auth.pending import PENDING_ENROLLMENTS
 from openstack_dashboard.dashboards.identity.totp import forms as totp_forms
 from openstack_dashboard.dashboards.identity.totp import tables as totp_tables
 from openstack_dashboard.dashboards.identity.totp.tools import qr as QR
+from openstack_dashboard.dashboards.identity.totp.tools import qr_data_uri
+from openstack_dashboard.dashboards.identity.totp.utils import get_user_state
 
 LOG = logging.getLogger(__name__)
 
+# latency of the panel views
+PHASES = stats.histograms("panel")
+
 
 class TwoFactorData(object):
     def __init__(self, id, name, seed, enabled, email):
@@ -41,36 +45,61 @@ class IndexView(tables.DataTableView):
     table_class = totp_tables.TwoFactorTable
     template_name = 'identity/totp/index.html'
     page_title = _("Two Factor Authentication")
-    
+
+    def get(self, request, *args, **kwargs):
+        with PHASES.time("index"):
+            return super(IndexView, self).get(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         context = super(IndexView, self).get_context_data(**kwargs)
-        manager = TOTPOracle(auth_url=get_auth_url(), user_data=self.request.user)
-        email_address = manager.user_get_email_address(self.request.user.id)
-        if email_address == "None" or email_address is None:
+        state = get_user_state(self.request)
+        if state.email is None:
                 context['emailaddress'] = "MissingField"
         else:
-                context['emailaddress'] = email_address
+                context['emailaddress'] = state.email
 
         return context
 
     def get_data(self):
         objects = []
         try:
-            manager = TOTPOracle(auth_url=get_auth_url(), user_data=self.request.user)
-            totp_key = manager.user_get_totp_key(self.request.user.id)
-            email = manager.user_get_email_address(self.request.user.id)
-            if (email == "None") or (email is None):
+            state = get_user_state(self.request)
+            email = state.email
+            if email is None:
                 email = "MissingAddress"
 
-            if totp_key and not ((totp_key == "None") or (totp_key is None)):
-                objects.append(TwoFactorData(self.request.user.id, self.request.user.username, totp_key, True, email))
+            if state.enabled:
+                objects.append(TwoFactorData(self.request.user.id, self.request.user.username, state.key, True, email))
         except:
             objects = [] 
 
         return objects
 
 
-class ActivateView(forms.ModalFormView):
+# seed behind a handle: the pending enrollment of the user, or its current seed
+def resolve_seed(request, handle):
+    if handle == totp_forms.CURRENT_SEED_HANDLE:
+        return get_user_state(request).key
+    return PENDING_ENROLLMENTS.resolve(request.user.id, handle)
+
+
+# the modals embed their QR code, which saves the browser a request to the qr url
+class InlineQRMixin(object):
+    # whether the modal shows the QR code for this form
+    def shows_qr(self, form):
+        return True
+
+    def get_context_data(self, **kwargs):
+        context = super(InlineQRMixin, self).get_context_data(**kwargs)
+        form = context.get('form')
+        if form is not None and self.shows_qr(form):
+            with PHASES.time("qr_inline"):
+                context['qr_inline'] = qr_data_uri(resolve_seed(self.request, form['enrollment_handle'].value()),
+                                                   self.request.user.username)
+        return context
+
+
+class ActivateView(InlineQRMixin, forms.ModalFormView):
     template_name = 'identity/totp/activate.html'
     modal_header = _("Activate TOTP Authentication")
     form_id = "activate_totp_form"
@@ -80,7 +109,11 @@ class ActivateView(forms.ModalFormView):
     success_url = reverse_lazy('horizon:identity:totp:index')
     page_title = _("Activate TOTP Authentication")
 
-class RegenerateView(forms.ModalFormView):
+    # with an email address on file, the QR code is mailed instead
+    def shows_qr(self, form):
+        return form['email_address'].value() == "MissingField"
+
+class RegenerateView(InlineQRMixin, forms.ModalFormView):
     template_name = 'identity/totp/regenerate.html'
     modal_header = _("Add a TOTP SoftToken")
     form_id = "regenerate_totp_form"
@@ -90,7 +123,20 @@ class RegenerateView(forms.ModalFormView):
     submit_url = reverse_lazy("horizon:identity:totp:regenerate")
     success_url = reverse_lazy('horizon:identity:totp:index')
 
-# generate qrcode
-def qr(request, token_seed=None, html_encode=True):
-    return QR(request=request, token_seed=token_seed, html_encode=html_encode)
+# generate qrcode for a seed handle, for clients that do not use the inline images
+def qr(request, handle=None, html_encode=True):
+    with PHASES.time("qr"):
+        token_seed = resolve_seed(request, handle)
+        if not token_seed:
+            raise Http404
+        # the current seed changes on regeneration, under the same handle
+        return QR(request=request, token_seed=token_seed, html_encode=html_encode,
+                  cacheable=handle != totp_forms.CURRENT_SEED_HANDLE)
+
+# prometheus metrics of this horizon process, for cloud admins only.
+# Scrapers use the token protected openstack_dashboard.auth.metrics.scrape instead.
+def metrics(request):
+    if not request.user.is_superuser:
+        return HttpResponseForbidden()
+    return HttpResponse(stats.render_prometheus(), content_type="text/plain; version=0.0.4")
 
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Activation modal latency against a slow SMTP relay, and duplicate emails.
+
+Renders the activation modal --renders times, each time for a new pending
+seed, with the locmem email backend delayed by 0 and by --smtp-delay seconds:
+the modal must not wait for the delivery. Then checks that every queued email
+is delivered, that reopening the modal, or queueing the same (user, seed)
+again, sends nothing more, and that reopening it after a failed delivery sends
+the email. Exits non-zero when a check fails.
+"""
+
+import argparse
+import statistics
+import sys
+import time
+
+import common
+from fake_keystone import FakeKeystone
+
+from django.core.mail.backends import locmem
+
+PASSWORD = "secret"
+# seconds each delivery takes, and whether it fails, see SlowEmailBackend
+SMTP_DELAY = [0.0]
+SMTP_DOWN = [False]
+
+
+# locmem backend behind a slow relay
+class SlowEmailBackend(locmem.EmailBackend):
+    def send_messages(self, messages):
+        time.sleep(SMTP_DELAY[0])
+        if SMTP_DOWN[0]:
+            raise IOError("relay unavailable")
+        return super(SlowEmailBackend, self).send_messages(messages)
+
+
+# wait for the outbox to hold count messages, returns its final size
+def wait_outbox(mail, count, timeout):
+    deadline = time.monotonic() + timeout
+    while len(mail.outbox) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return len(mail.outbox)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--renders', type=int, default=10)
+    parser.add_argument('--smtp-delay', type=float, default=0.5, help='seconds per delivery')
+    args = parser.parse_args()
+
+    with FakeKeystone() as keystone:
+        user_id = keystone.add_user("plain", password=PASSWORD, email="plain@example.com", totp_key="")
+        common.setup_horizon(keystone,
+                             ALLOWED_HOSTS=["*"],
+                             EMAIL_BACKEND="__main__.SlowEmailBackend",
+                             TOTP_EMAIL_DEDUP_WINDOW=3600,
+                             TOTP_EMAIL_RETRIES=1)
+        from django.core import mail
+        from django.test import Client
+        from django.urls import reverse
+
+        from openstack_dashboard.auth.pending import PENDING_ENROLLMENTS
+        from openstack_dashboard.dashboards.identity.totp import activation_email
+
+        browser = Client()
+        response = browser.post(reverse("login"), {"username": "plain", "password": PASSWORD,
+                                                   "region": keystone.auth_url, "domain": "Default"})
+        if response.status_code != 302:
+            raise RuntimeError("horizon login failed with status %d" % response.status_code)
+        url = reverse("horizon:identity:totp:activate")
+
+        def render():
+            start = time.perf_counter()
+            response = browser.get(url)
+            if response.status_code != 200:
+                raise RuntimeError("activate view returned %d" % response.status_code)
+            return time.perf_counter() - start
+
+        failures = []
+        for delay in (0.0, args.smtp_delay):
+            SMTP_DELAY[0] = delay
+            mail.outbox = []
+            samples = []
+            for i in range(args.renders):
+                PENDING_ENROLLMENTS.discard(user_id)
+                samples.append(render())
+            print("smtp delay %5.2f s  modal p50 %7.2f ms  max %7.2f ms"
+                  % (delay, statistics.median(samples) * 1000, max(samples) * 1000))
+            if delay and max(samples) >= delay / 2:
+                failures.append("the modal waits for the smtp relay (%.2f ms)" % (max(samples) * 1000))
+
+            timeout = args.renders * delay + 10
+            delivered = wait_outbox(mail, args.renders, timeout)
+            print("smtp delay %5.2f s  %d of %d emails delivered" % (delay, delivered, args.renders))
+            if delivered != args.renders:
+                failures.append("%d emails delivered for %d new seeds" % (delivered, args.renders))
+
+        # reopening the modal reuses the pending seed, and the mailer drops duplicates
+        SMTP_DELAY[0] = 0.0
+        mail.outbox = []
+        PENDING_ENROLLMENTS.discard(user_id)
+        for i in range(3):
+            render()
+        wait_outbox(mail, 2, 2)
+        print("modal opened 3 times: %d email(s)" % len(mail.outbox))
+        if len(mail.outbox) != 1:
+            failures.append("%d emails sent for one pending seed" % len(mail.outbox))
+
+        # a delivery that was given up is queued again when the modal is reopened
+        mail.outbox = []
+        PENDING_ENROLLMENTS.discard(user_id)
+        SMTP_DOWN[0] = True
+        render()
+        deadline = time.monotonic() + 10
+        while activation_email.MAILER._pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+        SMTP_DOWN[0] = False
+        render()
+        wait_outbox(mail, 1, 10)
+        print("modal reopened after a failed delivery: %d email(s)" % len(mail.outbox))
+        if len(mail.outbox) != 1:
+            failures.append("%d emails sent after a failed delivery" % len(mail.outbox))
+
+        build = lambda: mail.EmailMessage("subject", "body", "noreply@example.com", ["plain@example.com"])
+        first = activation_email.MAILER.enqueue(("check", "seed"), build)
+        again = activation_email.MAILER.enqueue(("check", "seed"), build)
+        print("same (user, seed) queued twice: %s, %s" % (first, again))
+        if not first or again:
+            failures.append("duplicate (user, seed) not dropped")
+
+    for failure in failures:
+        print("FAIL: %s" % failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
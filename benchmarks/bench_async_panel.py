@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Sync versus async TOTP state reads and panel latency, with keystone latency.
+
+Compares TOTPOracle and AsyncTOTPOracle fetching the state of one and of
+--users users (state cache off), then times the TOTP panel index page while
+--concurrency pages are in flight: with --views sync through the test
+Client and the regular views, with --views async through AsyncClient and
+TOTP_ASYNC_VIEWS. The url patterns are fixed at import, so run the script
+once per mode to compare page latency.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import common
+from fake_keystone import FakeKeystone
+
+PASSWORD = "secret"
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    print("%-40s p50 %8.1f ms  max %8.1f ms" % (name, statistics.median(samples) * 1000, samples[-1] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=0.05, help='keystone latency, seconds')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=10, help='pages in flight for the page benchmark')
+    parser.add_argument('--views', default='async', choices=('sync', 'async'))
+    args = parser.parse_args()
+
+    with FakeKeystone(latency=args.latency) as keystone:
+        user_ids = [keystone.add_user("user%d" % i, password=PASSWORD, email="user%d@example.com" % i, totp_key="")
+                    for i in range(args.users)]
+        common.setup_horizon(keystone,
+                             ALLOWED_HOSTS=["*"],
+                             TOTP_STATE_CACHE_BACKEND="",
+                             TOTP_ASYNC_VIEWS=args.views == 'async')
+        from django.test import AsyncClient, Client
+        from django.urls import reverse
+
+        from openstack_dashboard.auth.async_oracle import AsyncTOTPOracle, close
+        from openstack_dashboard.auth.backend import get_auth_url
+        from openstack_dashboard.auth.totp_oracle import TOTPOracle
+
+        user = common.login(keystone, "user0", PASSWORD)
+
+        def sync_states(ids):
+            oracle = TOTPOracle(auth_url=get_auth_url(), user_data=user)
+            return [oracle.user_get_state(user_id) for user_id in ids]
+
+        async def async_states(ids):
+            return await AsyncTOTPOracle(auth_url=get_auth_url(), user_data=user).user_get_states(ids)
+
+        async def timed(coroutine_factory):
+            start = time.perf_counter()
+            await coroutine_factory()
+            return time.perf_counter() - start
+
+        def timed_sync(function):
+            start = time.perf_counter()
+            function()
+            return time.perf_counter() - start
+
+        async def oracle_bench():
+            for count in (1, args.users):
+                ids = user_ids[:count]
+                report("TOTPOracle, %d users" % count,
+                       [timed_sync(lambda: sync_states(ids)) for _ in range(args.iterations)])
+                report("AsyncTOTPOracle, %d users" % count,
+                       [await timed(lambda: async_states(ids)) for _ in range(args.iterations)])
+            await close()
+
+        asyncio.run(oracle_bench())
+
+        # page latency, concurrency pages at a time
+        credentials = {"username": "user0", "password": PASSWORD, "region": keystone.auth_url, "domain": "Default"}
+        browser = Client()
+        browser.post(reverse("login"), credentials)
+        index_url = reverse("horizon:identity:totp:index")
+
+        def sync_page():
+            page_browser = Client()
+            page_browser.cookies = browser.cookies
+            start = time.perf_counter()
+            page_browser.get(index_url)
+            return time.perf_counter() - start
+
+        async def async_pages():
+            async def page():
+                page_browser = AsyncClient()
+                page_browser.cookies = browser.cookies
+                start = time.perf_counter()
+                await page_browser.get(index_url)
+                return time.perf_counter() - start
+
+            samples = []
+            for _ in range(args.iterations):
+                samples.extend(await asyncio.gather(*[page() for _ in range(args.concurrency)]))
+            await close()
+            return samples
+
+        if args.views == 'sync':
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                samples = list(pool.map(lambda i: sync_page(), range(args.iterations * args.concurrency)))
+        else:
+            samples = asyncio.run(async_pages())
+        report("index page, %s views x%d" % (args.views, args.concurrency), samples)
+
+
+if __name__ == '__main__':
+    main()
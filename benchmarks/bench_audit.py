@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Throughput and peak memory of the totp_audit command against a paginating fake Keystone.
+
+Then audits the same users as Keystone itself lists them, in one unpaged reply,
+with their seeds moved to a sqlite seed store, and with the list cut at
+list_limit, which must fail. Exits non-zero otherwise.
+"""
+
+import argparse
+import importlib.util
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import common
+from fake_keystone import FakeKeystone
+
+COMMAND_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "totp_audit.py")
+
+
+# discard output, only its size matters here
+class NullWriter(io.TextIOBase):
+    def write(self, data):
+        return len(data)
+
+
+def load_command():
+    spec = importlib.util.spec_from_file_location("totp_audit", COMMAND_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Command()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--page-size', type=int, default=500)
+    args = parser.parse_args()
+
+    with FakeKeystone(page_size=args.page_size) as keystone:
+        keystone.add_user("admin", password="secret", domain_id="admin")
+        common.setup_horizon(keystone)
+        command = load_command()
+        options = dict(os_auth_url=keystone.auth_url, os_username="admin", os_password="secret",
+                       project_name="project", project_domain_name="Default", user_domain_name="Default")
+        oracle = command.get_oracle(options)
+
+        count = 0
+        for size in [int(s) for s in args.sizes.split(',')]:
+            while count < size:
+                extra = {"email": "user%d@example.com" % count} if count % 10 else {}
+                if count % 3 == 0:
+                    extra["totp_key"] = "JBSWY3DPEHPK3PXP"
+                elif count % 3 == 1:
+                    extra["totp_key"] = ""
+                keystone.add_user("user%d" % count, domain_id="acme", **extra)
+                count += 1
+
+            keystone.reset_counters()
+            tracemalloc.start()
+            start = time.perf_counter()
+            totals = command.audit(oracle, NullWriter(), domain="acme", page_size=args.page_size)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print("users %7d  %8.1f users/s  peak %7.1f KiB  pages %4d  %s"
+                  % (size, size / elapsed, peak / 1024.0, keystone.calls[("GET", "user_list")], totals))
+
+        # keystone itself does not page: the whole list comes in a single reply
+        keystone.paging = False
+        keystone.reset_counters()
+        start = time.perf_counter()
+        totals = command.audit(oracle, NullWriter(), domain="acme", page_size=args.page_size)
+        elapsed = time.perf_counter() - start
+        print("unpaged  %7d  %8.1f users/s  requests %d  %s"
+              % (count, count / elapsed, keystone.calls[("GET", "user_list")], totals))
+        if totals["users"] != count:
+            print("FAIL: unpaged listing audited %d users of %d" % (totals["users"], count))
+            sys.exit(1)
+
+        # seeds moved to the sqlite store, as after totp_migrate_seeds --clear-keystone:
+        # the enrollment counts must not change
+        from openstack_dashboard.auth.seed_store import TOTP_KEY_ATTRIBUTE, SQLiteSeedStore
+        workdir = tempfile.mkdtemp()
+        try:
+            store = SQLiteSeedStore(os.path.join(workdir, "seeds.sqlite3"))
+            store.import_keys((user["id"], user.pop(TOTP_KEY_ATTRIBUTE))
+                              for password, user in keystone.users.values() if user.get(TOTP_KEY_ATTRIBUTE))
+            start = time.perf_counter()
+            moved = command.audit(oracle, NullWriter(), domain="acme", page_size=args.page_size, store=store)
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(workdir)
+        print("sqlite   %7d  %8.1f users/s  %s" % (count, count / elapsed, moved))
+        if moved["enrolled"] != totals["enrolled"]:
+            print("FAIL: sqlite store audited %d enrolled users, keystone %d" % (moved["enrolled"], totals["enrolled"]))
+            sys.exit(1)
+
+        # a keystone that cuts the list at list_limit must fail the audit, not shorten it
+        from openstack_dashboard.auth.exception import TOTPRuntimeError
+        keystone.list_limit = args.page_size // 2
+        try:
+            command.audit(oracle, NullWriter(), domain="acme", page_size=args.page_size)
+        except TOTPRuntimeError as e:
+            print("truncated listing detected: %s" % e)
+        else:
+            print("FAIL: truncated listing not detected")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
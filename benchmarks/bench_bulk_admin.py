@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Throughput of the totp_disable bulk command versus worker count. """
+
+import argparse
+import importlib.util
+import io
+import os
+import time
+
+import common
+from fake_keystone import FakeKeystone
+
+COMMAND_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "totp_disable.py")
+
+
+def load_command():
+    spec = importlib.util.spec_from_file_location("totp_disable", COMMAND_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Command()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.01, help='keystone latency, seconds')
+    parser.add_argument('--action', default='status', choices=('status', 'disable'))
+    parser.add_argument('--workers', default='1,2,4,8,16')
+    args = parser.parse_args()
+
+    with FakeKeystone(latency=args.latency) as keystone:
+        keystone.add_user("admin", password="secret")
+        user_ids = [keystone.add_user("user%d" % i, email="user%d@example.com" % i, totp_key="")
+                    for i in range(args.users)]
+        common.setup_horizon(keystone)
+        command = load_command()
+
+        for workers in [int(w) for w in args.workers.split(',')]:
+            options = dict(action=args.action, domain=None, concurrency=workers,
+                           os_auth_url=keystone.auth_url, os_username="admin", os_password="secret",
+                           project_name="project", project_domain_name="Default", user_domain_name="Default")
+            oracle = command.get_oracle(options)
+            oracle.ks_session.get_token()
+            keystone.reset_counters()
+
+            start = time.perf_counter()
+            totals = command.run(oracle, options, ((user_id, None) for user_id in user_ids), io.StringIO())
+            elapsed = time.perf_counter() - start
+            print("workers %3d  %8.1f users/s  connections %3d  %s"
+                  % (workers, args.users / elapsed, keystone.connections, totals))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Count keystone TCP connections and requests per N TOTPOracle validations.
+
+With the login token reused by the oracle, no POST /v3/auth/tokens shows up,
+and the pooled sessions open no more connections than the pool holds. Exits
+non-zero when either check fails.
+"""
+
+import argparse
+import sys
+
+import common
+from fake_keystone import FakeKeystone
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=1000)
+    args = parser.parse_args()
+
+    with FakeKeystone() as keystone:
+        keystone.add_user("alice", email="alice@example.com", totp_key="")
+        common.setup_horizon(keystone)
+        from openstack_dashboard.auth import stats
+        from openstack_dashboard.auth.session_pool import POOL_SIZE
+        from openstack_dashboard.auth.totp_oracle import TOTPOracle
+
+        user = common.login(keystone, "alice")
+
+        # warm up the pool
+        TOTPOracle(auth_url=keystone.auth_url, user_data=user).validate(user.id)
+        keystone.reset_counters()
+
+        for _ in range(args.iterations):
+            TOTPOracle(auth_url=keystone.auth_url, user_data=user).validate(user.id)
+
+        print("validations:          %d" % args.iterations)
+        print("connections opened:   %d" % keystone.connections)
+        for (method, route), count in sorted(keystone.calls.items()):
+            print("%-6s %-15s %d" % (method, route, count))
+        print("oracle auth plugins:  %s" % stats.counters("oracle_auth_plugin").snapshot())
+
+        failures = []
+        if keystone.calls[("POST", "token_issue")]:
+            failures.append("%d token requests, the login token is not reused" % keystone.calls[("POST", "token_issue")])
+        if keystone.connections > POOL_SIZE:
+            failures.append("%d connections opened, the pool holds %d" % (keystone.connections, POOL_SIZE))
+
+    for failure in failures:
+        print("FAIL: %s" % failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
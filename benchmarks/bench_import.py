@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Import-time budget of the plugin, measured with python -X importtime.
+
+Imports the plugin modules loaded by every Horizon worker on top of
+django.setup() and the Horizon modules the plugin builds on (openstack_auth,
+horizon tables and forms), and accounts the modules only the plugin pulls in.
+Exits with status 1 when they take more than --budget-ms, or when one of the
+lazily imported modules (qrcode, PIL, keystoneclient) is loaded at import.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+SETUP = ("import django; django.setup(); "
+         "import openstack_auth.backend, horizon.tables, horizon.forms")
+PLUGIN_MODULES = (
+    "openstack_dashboard.auth.backend",
+    "openstack_dashboard.dashboards.identity.totp.views",
+    "openstack_dashboard.dashboards.identity.totp.urls",
+)
+LAZY_MODULES = ("qrcode", "PIL", "keystoneclient")
+
+LINE_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+
+# module -> self time (us) of every module imported by a python snippet
+def import_times(code):
+    env = dict(os.environ)
+    env.setdefault("DJANGO_SETTINGS_MODULE", "openstack_dashboard.settings")
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.getcwd(), env.get("PYTHONPATH")]))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            universal_newlines=True)
+    if result.returncode:
+        sys.stderr.write(result.stderr)
+        raise SystemExit("import failed")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        match = LINE_RE.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(1))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--budget-ms', type=float, default=150.0)
+    parser.add_argument('--runs', type=int, default=5, help='the best run is kept')
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    plugin_code = "%s; %s" % (SETUP, "; ".join("import %s" % module for module in PLUGIN_MODULES))
+    best = None
+    for _ in range(args.runs):
+        baseline = import_times(SETUP)
+        full = import_times(plugin_code)
+        extra = dict((module, us) for module, us in full.items() if module not in baseline)
+        total = sum(extra.values())
+        if best is None or total < best[0]:
+            best = (total, extra)
+
+    total, extra = best
+    print("modules imported by the plugin: %d, %.1f ms (budget %.1f ms)" % (len(extra), total / 1000.0, args.budget_ms))
+    for module, us in sorted(extra.items(), key=lambda item: -item[1])[:args.top]:
+        print("  %8.2f ms  %s" % (us / 1000.0, module))
+
+    failed = False
+    eager = sorted(module for module in extra if module.split('.')[0] in LAZY_MODULES)
+    if eager:
+        print("FAIL: imported eagerly: %s" % ", ".join(eager))
+        failed = True
+    if total / 1000.0 > args.budget_ms:
+        print("FAIL: over the import-time budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Keystone password auths per login, for each login mode of the backend.
+
+Once the login hint is learned, a login costs exactly one keystone password
+auth, whether it succeeds, carries a wrong password or comes with the OTP in
+its own field. A wrong password drops the hint, so that a stale one cannot
+lock the user out. Exits non-zero when a login mode makes another number of
+password auths, or a failed login keeps its hint.
+"""
+
+import argparse
+import sys
+
+import common
+from fake_keystone import FakeKeystone
+
+PASSWORD = "secret"
+SEED = "JBSWY3DPEHPK3PXPJBSWY3DPEHPK3PXP"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--logins', type=int, default=5)
+    args = parser.parse_args()
+
+    with FakeKeystone() as keystone:
+        # one user per login and case: a failed login drops the hint of its user,
+        # and an otp is accepted once per user and time step
+        users = {}
+        for case, totp_key in (("plain", ""), ("plain-wrong", ""), ("enrolled", SEED), ("enrolled-wrong", SEED)):
+            users[case] = ["%s%d" % (case, i) for i in range(args.logins)]
+            for username in users[case]:
+                keystone.add_user(username, password=PASSWORD, totp_key=totp_key)
+        common.setup_horizon(keystone,
+                             TOTP_METRICS_ENABLED=True,
+                             TOTP_RATELIMIT_USER_BURST=10 ** 9,
+                             TOTP_RATELIMIT_IP_BURST=10 ** 9,
+                             TOTP_RATELIMIT_ACCOUNT_BURST=10 ** 9)
+        from django.test import Client, RequestFactory
+        from openstack_auth import exceptions
+
+        from openstack_dashboard.auth import backend as backend_module
+        from openstack_dashboard.auth import preauth
+        from openstack_dashboard.auth.verifier import get_verifier
+
+        factory = RequestFactory()
+        backend = backend_module.TwoFactorAuthBackend()
+        verifier = get_verifier(SEED)
+
+        def login(username, password, otp=None):
+            request = factory.post("/auth/login/")
+            request.session = Client().session
+            try:
+                backend.authenticate(request=request, username=username, password=password, otp=otp,
+                                     user_domain_name="Default", auth_url=keystone.auth_url)
+            except exceptions.KeystoneAuthException:
+                pass
+
+        # learn the hints
+        counter = verifier.counter()
+        for case, usernames in users.items():
+            for username in usernames:
+                login(username, PASSWORD + (verifier.code(counter - 1) if case.startswith("enrolled") else ""))
+
+        cases = (("not enrolled", lambda i: login(users["plain"][i], PASSWORD), True),
+                 ("enrolled", lambda i: login(users["enrolled"][i], PASSWORD + verifier.code(counter)), True),
+                 ("wrong password, not enrolled", lambda i: login(users["plain-wrong"][i], "wrong-password"), False),
+                 ("wrong password, enrolled", lambda i: login(users["enrolled-wrong"][i], "wrong-password123456"), False),
+                 ("separate otp field", lambda i: login(users["plain"][i], PASSWORD, otp="123456"), False))
+
+        failures = []
+        for name, case, keeps_hint in cases:
+            # password auths as counted by the backend, per login mode ("<mode>_failed" are the same calls)
+            backend_module.KEYSTONE_CALLS.reset()
+            for i in range(args.logins):
+                case(i)
+            calls = backend_module.KEYSTONE_CALLS.snapshot()
+            auths = sum(count for mode, count in calls.items() if not mode.endswith("_failed")) / float(args.logins)
+            print("%-30s keystone password auths/login %.2f  %s" % (name, auths, sorted(calls.items())))
+            if auths != 1:
+                failures.append("%s: %.2f keystone password auths per login" % (name, auths))
+
+        for case in ("plain-wrong", "enrolled-wrong"):
+            kept = [username for username in users[case] if preauth.get_hint(username, "Default") is not None]
+            if kept:
+                failures.append("%d failed logins kept their hint" % len(kept))
+
+    for failure in failures:
+        print("FAIL: %s" % failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
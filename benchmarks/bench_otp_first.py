@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Keystone password hashing cost of failed OTP logins, with and without TOTP_OTP_FIRST.
+
+Every user logs in once with a valid code (this learns the login hint and
+fills the state cache), then --attempts logins with a wrong or malformed OTP
+and the right password are made from --threads threads. The fake keystone
+hashes every password it checks (--hash-rounds of PBKDF2, in place of
+bcrypt) and accounts the CPU time spent on it.
+"""
+
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import common
+from fake_keystone import FakeKeystone
+
+PASSWORD = "secret"
+SEED = "JBSWY3DPEHPK3PXPJBSWY3DPEHPK3PXP"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--attempts', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--hash-rounds', type=int, default=100000)
+    parser.add_argument('--latency', type=float, default=0.005, help='keystone latency, seconds')
+    args = parser.parse_args()
+
+    with FakeKeystone(latency=args.latency, hash_rounds=args.hash_rounds) as keystone:
+        common.setup_horizon(keystone,
+                             TOTP_STATE_CACHE_TTL=3600,
+                             TOTP_RATELIMIT_USER_BURST=10 ** 9,
+                             TOTP_RATELIMIT_IP_BURST=10 ** 9,
+                             TOTP_RATELIMIT_ACCOUNT_BURST=10 ** 9)
+        from django.test import Client, RequestFactory
+        from openstack_auth import exceptions
+
+        from openstack_dashboard.auth import backend as backend_module
+        from openstack_dashboard.auth.verifier import get_verifier
+
+        factory = RequestFactory()
+        backend = backend_module.TwoFactorAuthBackend()
+        verifier = get_verifier(SEED)
+
+        def authenticate(username, password):
+            request = factory.post("/auth/login/")
+            request.session = Client().session
+            return backend.authenticate(request=request, username=username, password=password,
+                                        user_domain_name="Default", auth_url=keystone.auth_url)
+
+        for otp_first in (False, True):
+            backend_module.OTP_FIRST = otp_first
+            # fresh users: the warm-up codes are spent by the replay registry
+            usernames = ["user%d-%s" % (i, otp_first) for i in range(args.users)]
+            for username in usernames:
+                keystone.add_user(username, password=PASSWORD, totp_key=SEED)
+                authenticate(username, PASSWORD + verifier.code(verifier.counter() - 1))
+
+            good = verifier.code(verifier.counter())
+            wrong = ["%06d" % ((int(good) + 1) % 1000000), "12ab56", good[:5] + "x"]
+
+            def attempt(i):
+                start = time.perf_counter()
+                try:
+                    authenticate(usernames[i % len(usernames)], PASSWORD + wrong[i % len(wrong)])
+                except exceptions.KeystoneAuthException:
+                    return time.perf_counter() - start
+                raise RuntimeError("bad otp accepted")
+
+            keystone.reset_counters()
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.threads) as pool:
+                latencies = sorted(pool.map(attempt, range(args.attempts)))
+            elapsed = time.perf_counter() - start
+
+            password_auths = keystone.calls[("POST", "token_issue")]
+            print("TOTP_OTP_FIRST=%-5s  keystone token requests/attempt %.2f  hash cpu/attempt %7.2f ms  "
+                  "p50 %7.2f ms  p99 %7.2f ms  %7.1f attempts/s"
+                  % (otp_first, password_auths / float(args.attempts), keystone.hash_cpu * 1000 / args.attempts,
+                     statistics.median(latencies) * 1000, latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+                     args.attempts / elapsed))
+
+
+if __name__ == '__main__':
+    main()
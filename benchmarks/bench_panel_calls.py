@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Keystone calls per TOTP panel page, with the state cache off.
+
+The views, table actions and forms of a request share one TOTPOracle, so each
+page reads the user once whatever the number of table actions. Renders the
+index page and the modals of a user with and without TOTP --renders times,
+and exits non-zero when a page reads the user more than once, or creates a
+keystone token.
+"""
+
+import argparse
+import sys
+
+import common
+from fake_keystone import FakeKeystone
+
+PASSWORD = "secret"
+SEED = "JBSWY3DPEHPK3PXPJBSWY3DPEHPK3PXP"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--renders', type=int, default=20)
+    args = parser.parse_args()
+
+    with FakeKeystone() as keystone:
+        keystone.add_user("plain", password=PASSWORD, email="plain@example.com", totp_key="")
+        keystone.add_user("enrolled", password=PASSWORD, email="enrolled@example.com", totp_key=SEED)
+        common.setup_horizon(keystone,
+                             ALLOWED_HOSTS=["*"],
+                             EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+                             TOTP_STATE_CACHE_BACKEND="")
+        from django.test import Client
+        from django.urls import reverse
+
+        from openstack_dashboard.auth.verifier import get_verifier
+
+        verifier = get_verifier(SEED)
+        pages = (("plain", PASSWORD, ("index", "activate")),
+                 ("enrolled", PASSWORD + verifier.code(verifier.counter()), ("index", "regenerate")))
+
+        failures = []
+        for username, password, names in pages:
+            browser = Client()
+            response = browser.post(reverse("login"), {"username": username, "password": password,
+                                                       "region": keystone.auth_url, "domain": "Default"})
+            if response.status_code != 302:
+                raise RuntimeError("horizon login of %s failed with status %d" % (username, response.status_code))
+
+            for name in names:
+                url = reverse("horizon:identity:totp:%s" % name)
+                keystone.reset_counters()
+                for i in range(args.renders):
+                    response = browser.get(url)
+                    if response.status_code != 200:
+                        raise RuntimeError("%s view returned %d" % (name, response.status_code))
+                user_gets = keystone.calls[("GET", "user_get")] / float(args.renders)
+                tokens = keystone.calls[("POST", "token_issue")]
+                print("%-8s %-10s user GETs/page %.2f  keystone calls/page %.2f  token requests %d"
+                      % (username, name, user_gets, sum(keystone.calls.values()) / float(args.renders), tokens))
+                if user_gets > 1:
+                    failures.append("%s page of %s reads the user %.2f times" % (name, username, user_gets))
+                if tokens:
+                    failures.append("%s page of %s requested %d keystone tokens" % (name, username, tokens))
+
+    for failure in failures:
+        print("FAIL: %s" % failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" QRCode renders per second, cold (empty cache) versus warm, per output format.
+
+Also prints the size of the data: uris embedded in the modals, to be compared
+with TOTP_QR_INLINE_MAX_BYTES.
+"""
+
+import argparse
+import os
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "openstack_dashboard.settings")
+    import django
+    django.setup()
+    from rfc6238 import totp
+    from openstack_dashboard.dashboards.identity.totp import tools
+
+    uris = [totp.build_uri(secret=totp.get_random_base32_key(byte_key=16), name="user%d" % i, period=30)
+            for i in range(args.iterations)]
+
+    for fmt in sorted(tools.QR_FORMATS):
+        tools.clear_qr_cache()
+        start = time.perf_counter()
+        for uri in uris:
+            tools.render_qr(uri, fmt)
+        cold = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for uri in uris:
+            tools.render_qr(uri, fmt)
+        warm = time.perf_counter() - start
+
+        print("%-4s cold %10.1f renders/s   warm %12.1f renders/s"
+              % (fmt, args.iterations / cold, args.iterations / warm))
+
+    seeds = [totp.get_random_base32_key(byte_key=16) for _ in range(args.iterations)]
+    seeds = [seed.decode('utf-8') if isinstance(seed, bytes) else seed for seed in seeds]
+    for fmt in ("svg", "png"):
+        prefix = len("data:%s;base64," % tools.QR_FORMATS[fmt][0])
+        sizes = [prefix + 4 * ((len(tools.render_qr(tools.provisioning_uri(seed, "user"), fmt)[1]) + 2) // 3)
+                 for seed in seeds]
+        print("inline %-4s data uri %6d bytes average, %6d max (cap %d)"
+              % (fmt, sum(sizes) // len(sizes), max(sizes), tools.QR_INLINE_MAX_BYTES))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Attack simulation against the failed login rate limiter.
+
+Lockout: an attacker sends --attempts wrong passwords for a victim from one
+address; the victim must still log in from another address, and the attacker
+must not get more keystone password auths than the (user, address) burst.
+Spraying: an attacker tries one wrong password on each of --attempts users
+from one address, and must not get more keystone password auths than the
+address burst. Stuffing: an attacker tries --attempts wrong passwords for one
+user, each from another address, and must not get more keystone password
+auths than the user's burst; the user must still log in from the address of
+an earlier login. Exits non-zero when a check fails.
+"""
+
+import argparse
+import sys
+
+import common
+from fake_keystone import FakeKeystone
+
+PASSWORD = "secret"
+ATTACKER = "203.0.113.1"
+SPRAYER = "203.0.113.2"
+VICTIM = "198.51.100.7"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--attempts', type=int, default=200)
+    parser.add_argument('--user-burst', type=int, default=10)
+    parser.add_argument('--ip-burst', type=int, default=50)
+    parser.add_argument('--account-burst', type=int, default=30)
+    args = parser.parse_args()
+
+    with FakeKeystone() as keystone:
+        keystone.add_user("victim", password=PASSWORD, totp_key="")
+        keystone.add_user("stuffed", password=PASSWORD, totp_key="")
+        sprayed = ["user%d" % i for i in range(args.attempts)]
+        for username in sprayed:
+            keystone.add_user(username, password=PASSWORD, totp_key="")
+        common.setup_horizon(keystone,
+                             TOTP_STATE_CACHE_BACKEND="",
+                             TOTP_RATELIMIT_BACKEND="local",
+                             TOTP_RATELIMIT_USER_BURST=args.user_burst,
+                             TOTP_RATELIMIT_IP_BURST=args.ip_burst,
+                             TOTP_RATELIMIT_ACCOUNT_BURST=args.account_burst)
+        from django.test import Client, RequestFactory
+        from openstack_auth import exceptions
+
+        from openstack_dashboard.auth import backend as backend_module
+
+        factory = RequestFactory()
+        backend = backend_module.TwoFactorAuthBackend()
+
+        # "ok", "rejected" (keystone said no) or "limited" (refused before keystone)
+        def login(username, password, client_ip):
+            request = factory.post("/auth/login/", REMOTE_ADDR=client_ip)
+            request.session = Client().session
+            calls = keystone.calls[("POST", "token_issue")]
+            try:
+                backend.authenticate(request=request, username=username, password=password,
+                                     user_domain_name="Default", auth_url=keystone.auth_url)
+            except exceptions.KeystoneAuthException:
+                return "limited" if keystone.calls[("POST", "token_issue")] == calls else "rejected"
+            return "ok"
+
+        failures = []
+
+        keystone.reset_counters()
+        outcomes = [login("victim", "wrong", ATTACKER) for i in range(args.attempts)]
+        print("lockout:  %d attempts from the attacker, %d reached keystone, %d refused up front"
+              % (args.attempts, outcomes.count("rejected"), outcomes.count("limited")))
+        if outcomes.count("rejected") > args.user_burst + 1:
+            failures.append("the attacker got %d password checks, burst is %d" % (outcomes.count("rejected"), args.user_burst))
+        outcome = login("victim", PASSWORD, VICTIM)
+        print("lockout:  victim from another address: %s" % outcome)
+        if outcome != "ok":
+            failures.append("the victim is locked out (%s)" % outcome)
+
+        keystone.reset_counters()
+        outcomes = [login(username, "wrong", SPRAYER) for username in sprayed]
+        auths = keystone.calls[("POST", "token_issue")]
+        print("spraying: %d users tried from one address, %d keystone password auths, %d refused up front"
+              % (args.attempts, auths, outcomes.count("limited")))
+        if auths > args.ip_burst + 1:
+            failures.append("the spraying address got %d password checks, burst is %d" % (auths, args.ip_burst))
+
+        # the user logged in from VICTIM before the attack
+        login("stuffed", PASSWORD, VICTIM)
+        keystone.reset_counters()
+        outcomes = [login("stuffed", "wrong", "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255))
+                    for i in range(args.attempts)]
+        print("stuffing: %d attempts from as many addresses, %d reached keystone, %d refused up front"
+              % (args.attempts, outcomes.count("rejected"), outcomes.count("limited")))
+        if outcomes.count("rejected") > args.account_burst + 1:
+            failures.append("the stuffing addresses got %d password checks, burst is %d"
+                            % (outcomes.count("rejected"), args.account_burst))
+        outcome = login("stuffed", PASSWORD, VICTIM)
+        print("stuffing: user from a known address: %s, from a new one: %s"
+              % (outcome, login("stuffed", PASSWORD, "198.51.100.8")))
+        if outcome != "ok":
+            failures.append("the stuffed user is locked out of its known address (%s)" % outcome)
+
+    for failure in failures:
+        print("FAIL: %s" % failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Insert and lookup cost of the OTP replay registries at N live entries. """
+
+import argparse
+import os
+import time
+
+
+def bench(name, registry, entries):
+    expires_at = time.time() + 3600
+    start = time.perf_counter()
+    for i in range(entries):
+        registry.claim("user-%d" % i, 1000 + i % 3, expires_at)
+    insert = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(entries):
+        registry.is_used("user-%d" % i, 1000 + i % 3)
+    lookup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(entries):
+        registry.claim("user-%d" % i, 1000 + i % 3, expires_at)
+    replay = time.perf_counter() - start
+
+    print("%-8s insert %6.2f us  lookup %6.2f us  replayed claim %6.2f us  (%d entries)"
+          % (name, insert * 1e6 / entries, lookup * 1e6 / entries, replay * 1e6 / entries, entries))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=100000)
+    args = parser.parse_args()
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "openstack_dashboard.settings")
+    import django
+    django.setup()
+    from openstack_dashboard.auth import replay
+
+    bench("local", replay.LocalReplayRegistry(), args.entries)
+    bench("django", replay.DjangoReplayRegistry(), args.entries)
+
+
+if __name__ == '__main__':
+    main()
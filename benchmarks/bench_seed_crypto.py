@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Cost of encrypted seeds on the login path, and throughput of the key rotation job.
+
+Login path: the first decryption with a key version (key derivation), then
+decryptions with the cached cipher, next to a validation read from the sqlite
+seed store with plain and with encrypted seeds. Rotation: --users seeds
+encrypted under key version 1 are re-encrypted under version 2 by the
+totp_rotate_seeds command with each --workers count, in the sqlite store and
+in the (fake) keystone one, over --latency.
+"""
+
+import argparse
+import importlib.util
+import io
+import os
+import tempfile
+import time
+import timeit
+
+import common
+from fake_keystone import FakeKeystone
+
+COMMAND_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "totp_rotate_seeds.py")
+PASSWORD = "secret"
+SEED = "JBSWY3DPEHPK3PXPJBSWY3DPEHPK3PXP"
+KEYS = {1: "first seed key", 2: "second seed key"}
+
+
+def load_command_module():
+    spec = importlib.util.spec_from_file_location("totp_rotate_seeds", COMMAND_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def per_call_us(function, iterations):
+    return min(timeit.repeat(function, number=iterations, repeat=5)) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0.005, help='keystone latency, seconds')
+    parser.add_argument('--workers', default='1,2,4,8,16')
+    args = parser.parse_args()
+
+    with FakeKeystone(latency=args.latency) as keystone, tempfile.TemporaryDirectory() as directory:
+        keystone.add_user("admin", password=PASSWORD)
+        user_ids = [keystone.add_user("user%d" % i, password=PASSWORD) for i in range(args.users)]
+        common.setup_horizon(keystone, TOTP_STATE_CACHE_BACKEND="")
+
+        from openstack_dashboard.auth import seed_crypto
+        from openstack_dashboard.auth import seed_store
+        from openstack_dashboard.auth.totp_oracle import local_state, validate_state
+
+        # login path
+        seed_crypto.KEYRING = seed_crypto.Keyring(KEYS, 1)
+        sealed = seed_crypto.encrypt_seed(user_ids[0], SEED)
+        seed_crypto.KEYRING = seed_crypto.Keyring(KEYS, 1)
+        start = time.perf_counter()
+        seed_crypto.decrypt_seed(user_ids[0], sealed)
+        print("first decryption (key derivation)    %10.1f us" % ((time.perf_counter() - start) * 1e6))
+        print("decryption, cached cipher            %10.1f us"
+              % per_call_us(lambda: seed_crypto.decrypt_seed(user_ids[0], sealed), args.iterations))
+        print("plain seed                           %10.1f us"
+              % per_call_us(lambda: seed_crypto.decrypt_seed(user_ids[0], SEED), args.iterations))
+
+        for name, keys in (("plain", {}), ("encrypted", KEYS)):
+            seed_crypto.KEYRING = seed_crypto.Keyring(keys, 1 if keys else None)
+            store = seed_store.SEED_STORE = seed_store.SQLiteSeedStore(path=os.path.join(directory, name + ".sqlite"))
+            store.set_key(None, user_ids[0], SEED)
+            print("sqlite store validate, %-14s %10.1f us"
+                  % (name, per_call_us(lambda: validate_state(local_state(user_ids[0]), otp="000000"), args.iterations)))
+
+        # rotation
+        module = load_command_module()
+        command = module.Command()
+        options = dict(os_auth_url=keystone.auth_url, os_username="admin", os_password=PASSWORD,
+                       project_name="project", project_domain_name="Default", user_domain_name="Default")
+        oracle = command.get_oracle(options)
+        oracle.ks_session.get_token()
+        stores = (("sqlite", seed_store.SQLiteSeedStore(path=os.path.join(directory, "rotation.sqlite"))),
+                  ("keystone", seed_store.KeystoneSeedStore()))
+
+        for name, store in stores:
+            for workers in [int(w) for w in args.workers.split(',')]:
+                seed_crypto.KEYRING = seed_crypto.Keyring(KEYS, 1)
+                for user_id in user_ids:
+                    store.set_key(oracle, user_id, SEED)
+                seed_crypto.KEYRING = seed_crypto.Keyring(KEYS, 2)
+                seed_crypto.KEYRING.cipher(1)
+                seed_crypto.KEYRING.cipher(2)
+
+                start = time.perf_counter()
+                totals = command.rotate(store, oracle, module.RotationState(), concurrency=workers,
+                                        progress_interval=3600, out=io.StringIO())
+                elapsed = time.perf_counter() - start
+                print("rotation, %-8s workers %3d  %9.1f users/s  %s"
+                      % (name, workers, totals["users"] / elapsed, totals))
+
+
+if __name__ == '__main__':
+    main()
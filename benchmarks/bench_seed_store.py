@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Per-validation latency of the keystone and sqlite seed stores.
+
+Every iteration builds a TOTPOracle for a logged in user and validates a
+code, as the login backend does, with the state cache off: the keystone store
+reads the seed with a user GET, the sqlite store with one row read. Seeds are
+copied to a temporary sqlite file with the migration command's batch import.
+Also times enable/disable round trips from --threads threads.
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import common
+from fake_keystone import FakeKeystone
+
+PASSWORD = "secret"
+SEED = "JBSWY3DPEHPK3PXPJBSWY3DPEHPK3PXP"
+
+
+def report(name, samples, calls):
+    samples = sorted(samples)
+    print("%-30s p50 %8.3f ms  p99 %8.3f ms  keystone requests/op %.2f"
+          % (name, statistics.median(samples) * 1000, samples[int(0.99 * (len(samples) - 1))] * 1000,
+             calls / float(len(samples))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=0.005, help='keystone latency, seconds')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    with FakeKeystone(latency=args.latency) as keystone, tempfile.TemporaryDirectory() as directory:
+        user_ids = [keystone.add_user("user%d" % i, password=PASSWORD, totp_key=SEED) for i in range(args.users)]
+        common.setup_horizon(keystone, TOTP_STATE_CACHE_BACKEND="")
+
+        from openstack_dashboard.auth import seed_store
+        from openstack_dashboard.auth.totp_oracle import TOTPOracle
+        from openstack_dashboard.auth.verifier import get_verifier
+
+        sqlite_store = seed_store.SQLiteSeedStore(path=os.path.join(directory, "seeds.sqlite"))
+        sqlite_store.import_keys((user_id, SEED) for user_id in user_ids)
+        user = common.login(keystone, "user0", PASSWORD)
+        stores = (("keystone", seed_store.KeystoneSeedStore()), ("sqlite", sqlite_store))
+
+        def validate(i):
+            # a wrong code: the replay registry stays out of the measure
+            verifier = get_verifier(SEED)
+            otp = "%06d" % ((int(verifier.code(verifier.counter())) + 1) % 1000000)
+            start = time.perf_counter()
+            TOTPOracle(auth_url=keystone.auth_url, user_data=user).validate(user_ids[i % len(user_ids)], otp=otp)
+            return time.perf_counter() - start
+
+        def enable_disable(i):
+            oracle = TOTPOracle(auth_url=keystone.auth_url, user_data=user)
+            start = time.perf_counter()
+            oracle.set_key(user_ids[i % len(user_ids)], SEED)
+            oracle.disable(user_ids[i % len(user_ids)])
+            return time.perf_counter() - start
+
+        for name, store in stores:
+            seed_store.SEED_STORE = store
+            validate(0)
+
+            keystone.reset_counters()
+            samples = [validate(i) for i in range(args.iterations)]
+            report("validate, %s" % name, samples, sum(keystone.calls.values()))
+
+            keystone.reset_counters()
+            with ThreadPoolExecutor(max_workers=args.threads) as pool:
+                samples = list(pool.map(enable_disable, range(args.iterations // 10)))
+            report("enable+disable x%d, %s" % (args.threads, name), samples, sum(keystone.calls.values()))
+
+
+if __name__ == '__main__':
+    main()
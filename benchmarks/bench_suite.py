@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Regression benchmark suite for the plugin hot paths.
+
+Runs the login backend (enrolled, non-enrolled and bad OTP users), the oracle
+validation, QR rendering, the activation email (locmem backend) and a full
+TOTP panel render against an in-process fake keystone. Reports ops/sec,
+p50/p99 latency and keystone calls per operation, and saves the results as
+JSON so that two runs can be compared with --compare.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import common
+from fake_keystone import FakeKeystone
+
+PASSWORD = "secret"
+SEED = "JBSWY3DPEHPK3PXPJBSWY3DPEHPK3PXP"
+
+
+def percentile(samples, fraction):
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+# run op() iterations times, returns the result record of the case
+def measure(keystone, name, op, iterations, warmup=10):
+    for i in range(warmup):
+        op(i)
+    keystone.reset_counters()
+
+    samples = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        op_start = time.perf_counter()
+        op(i)
+        samples.append(time.perf_counter() - op_start)
+    elapsed = time.perf_counter() - start
+
+    samples.sort()
+    calls = dict(("%s %s" % key, count) for key, count in sorted(keystone.calls.items()))
+    return {"name": name,
+            "iterations": iterations,
+            "ops_per_sec": iterations / elapsed,
+            "p50_ms": percentile(samples, 0.50) * 1000,
+            "p99_ms": percentile(samples, 0.99) * 1000,
+            "keystone_calls_per_op": sum(calls.values()) / float(iterations),
+            "keystone_calls": calls}
+
+
+def run(keystone, args):
+    from django.core import mail
+    from django.test import Client, RequestFactory
+    from django.urls import reverse
+    from openstack_auth import exceptions
+
+    from openstack_dashboard.auth.backend import TwoFactorAuthBackend
+    from openstack_dashboard.auth.totp_oracle import TOTPOracle
+    from openstack_dashboard.auth.verifier import get_verifier
+    from openstack_dashboard.dashboards.identity.totp import tools
+    from openstack_dashboard.dashboards.identity.totp.activation_email import send_activation_email
+
+    factory = RequestFactory()
+    backend = TwoFactorAuthBackend()
+    verifier = get_verifier(SEED)
+
+    def login_request():
+        request = factory.post("/auth/login/")
+        request.session = Client().session
+        return request
+
+    def authenticate(username, password):
+        return backend.authenticate(request=login_request(), username=username, password=password,
+                                    user_domain_name="Default", auth_url=keystone.auth_url)
+
+    # one enrolled user per login: an otp is accepted once per user and time step
+    enrolled = ["enrolled%d" % i for i in range(args.iterations + 10)]
+    for username in enrolled:
+        keystone.add_user(username, password=PASSWORD, email="%s@example.com" % username, totp_key=SEED)
+    keystone.add_user("plain", password=PASSWORD, email="plain@example.com", totp_key="")
+    keystone.add_user("victim", password=PASSWORD, email="victim@example.com", totp_key=SEED)
+
+    counter = verifier.counter()
+    # learn the login hint of every enrolled user with the previous step's code
+    for username in enrolled:
+        authenticate(username, PASSWORD + verifier.code(counter - 1))
+    authenticate("victim", PASSWORD + verifier.code(counter + 1))
+    otp = verifier.code(counter)
+    bad_otp = "%06d" % ((int(otp) + 1) % 1000000)
+
+    def bad_login(i):
+        try:
+            authenticate("victim", PASSWORD + bad_otp)
+        except exceptions.KeystoneAuthException:
+            return
+        raise RuntimeError("bad otp accepted")
+
+    user = common.login(keystone, "victim", PASSWORD)
+
+    qr_request = factory.get("/identity/totp/%s/qr" % SEED)
+    qr_request.user = user
+
+    def uncached_qr(i):
+        tools.clear_qr_cache()
+        tools.qr(qr_request, SEED)
+
+    mail_request = factory.get("/identity/totp/activate")
+    mail_request.user = user
+
+    def send_mail(i):
+        mail.outbox = []
+        send_activation_email("noreply@example.com", "victim@example.com", "TOTP Activation", SEED, mail_request)
+
+    browser = Client()
+    response = browser.post(reverse("login"), {"username": "plain", "password": PASSWORD,
+                                               "region": keystone.auth_url, "domain": "Default"})
+    if response.status_code != 302:
+        raise RuntimeError("horizon login failed with status %d" % response.status_code)
+    index_url = reverse("horizon:identity:totp:index")
+
+    def index(i):
+        response = browser.get(index_url)
+        if response.status_code != 200:
+            raise RuntimeError("index view returned %d" % response.status_code)
+
+    cases = [
+        ("backend.authenticate enrolled",
+         lambda i: authenticate(enrolled[i % len(enrolled)], PASSWORD + otp), 0),
+        ("backend.authenticate not enrolled", lambda i: authenticate("plain", PASSWORD), 10),
+        ("backend.authenticate bad otp", bad_login, 10),
+        ("oracle.validate", lambda i: TOTPOracle(auth_url=keystone.auth_url, user_data=user).validate(user.id, otp=otp), 10),
+        ("tools.qr cached", lambda i: tools.qr(qr_request, SEED), 10),
+        ("tools.qr uncached", uncached_qr, 10),
+        ("send_activation_email", send_mail, 10),
+        ("IndexView render", index, 10),
+    ]
+
+    results = []
+    for name, op, warmup in cases:
+        if args.only and args.only not in name:
+            continue
+        # enrolled logins use their own users, warming up would spend them
+        iterations = args.iterations if warmup else min(args.iterations, len(enrolled))
+        result = measure(keystone, name, op, iterations, warmup=warmup)
+        results.append(result)
+        print("%-36s %9.1f ops/s  p50 %8.3f ms  p99 %8.3f ms  keystone %5.2f/op"
+              % (name, result["ops_per_sec"], result["p50_ms"], result["p99_ms"], result["keystone_calls_per_op"]))
+    return results
+
+
+# print the relative change of every case against a previous run
+def compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = dict((result["name"], result) for result in json.load(baseline_file)["results"])
+    print("\nagainst %s:" % baseline_path)
+    for result in results:
+        old = baseline.get(result["name"])
+        if old is None:
+            continue
+        print("%-36s ops/s %+7.1f%%  p99 %+7.1f%%  keystone/op %+.2f"
+              % (result["name"],
+                 (result["ops_per_sec"] / old["ops_per_sec"] - 1) * 100,
+                 (result["p99_ms"] / old["p99_ms"] - 1) * 100,
+                 result["keystone_calls_per_op"] - old["keystone_calls_per_op"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0, help='keystone latency, seconds')
+    parser.add_argument('--only', default=None, help='run the cases whose name contains this string')
+    parser.add_argument('--output', default='bench_suite.json', help='where to save the results')
+    parser.add_argument('--compare', default=None, metavar='<json>', help='previous results to compare with')
+    args = parser.parse_args()
+
+    with FakeKeystone(latency=args.latency) as keystone:
+        common.setup_horizon(keystone,
+                             ALLOWED_HOSTS=["*"],
+                             EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+                             # failed logins of the bad otp case must not be throttled
+                             TOTP_RATELIMIT_USER_BURST=10 ** 9,
+                             TOTP_RATELIMIT_IP_BURST=10 ** 9,
+                             TOTP_RATELIMIT_ACCOUNT_BURST=10 ** 9)
+        results = run(keystone, args)
+
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+              "python": sys.version.split()[0],
+              "platform": platform.platform(),
+              "iterations": args.iterations,
+              "keystone_latency": args.latency,
+              "results": results}
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    print("results saved to %s" % args.output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
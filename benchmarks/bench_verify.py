@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Per-validation cost of the verifier against the single-step python-otp-lib path. """
+
+import argparse
+import timeit
+
+from rfc6238 import totp
+
+from openstack_dashboard.auth.verifier import get_verifier
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--timestep', type=int, default=30)
+    args = parser.parse_args()
+
+    key = totp.get_random_base32_key(byte_key=16)
+    if not isinstance(key, str):
+        key = key.decode('utf-8')
+    otp = "000000"
+
+    cases = [("python-otp-lib, single step", lambda: str(otp) == str(totp.TOTP(key, timestep=args.timestep)))]
+    for window in (0, 1, 2, 4):
+        cases.append(("verifier, +/-%d steps" % window,
+                      lambda window=window: get_verifier(key, timestep=args.timestep).verify(otp, window=window)))
+
+    for name, case in cases:
+        elapsed = timeit.timeit(case, number=args.iterations)
+        print("%-32s %8.2f us/validation" % (name, elapsed * 1e6 / args.iterations))
+
+
+if __name__ == '__main__':
+    main()
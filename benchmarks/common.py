@@ -0,0 +1,86 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Helpers shared by the benchmark scripts.
+
+The benchmarks import the plugin the way Horizon does (openstack_dashboard.auth
+and openstack_dashboard.dashboards.identity.totp), so they must be run with the
+plugin installed in a Horizon tree, e.g.:
+
+    cd /usr/share/openstack-dashboard
+    PYTHONPATH=. python /path/to/benchmarks/bench_connections.py
+"""
+
+import datetime
+import json
+import os
+import urllib.request
+
+
+def parse_isotime(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=datetime.timezone.utc)
+
+
+# stand-in for the openstack_auth user object handed to TOTPOracle
+class FakeToken(object):
+    def __init__(self, id, body=None):
+        body = body or {}
+        user = body.get("user", {})
+        self.id = id
+        self.expires = parse_isotime(body["expires_at"]) if "expires_at" in body else None
+        self.user = {"id": user.get("id"), "name": user.get("name")}
+        self.user_domain_id = user.get("domain", {}).get("id")
+        self.user_domain_name = user.get("domain", {}).get("name")
+        self.project = body.get("project", {})
+        self.roles = body.get("roles", [])
+        self.serviceCatalog = body.get("catalog", [])
+
+
+class FakeUserData(object):
+    def __init__(self, id, username, token_id, project_id="project", domain_id="default", token_body=None):
+        self.id = id
+        self.username = username
+        self.project_id = project_id
+        self.domain_id = domain_id
+        self.user_domain_name = domain_id
+        self.token = FakeToken(token_id, token_body)
+
+
+# point horizon at the fake keystone, with optional extra settings.
+# Must run before the plugin modules are imported.
+def setup_horizon(keystone, **overrides):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "openstack_dashboard.settings")
+    import django
+    django.setup()
+
+    # the plugin reads openstack_dashboard.settings, django and openstack_auth django.conf.settings
+    from django.conf import settings as django_settings
+    from openstack_dashboard import settings
+    overrides["OPENSTACK_KEYSTONE_URL"] = keystone.auth_url
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+        setattr(django_settings, name, value)
+    return settings
+
+
+# issue a token directly against the fake keystone
+def login(keystone, username, password="secret"):
+    body = {"auth": {"identity": {"methods": ["password"],
+                                  "password": {"user": {"name": username, "password": password,
+                                                        "domain": {"id": "default"}}}}}}
+    request = urllib.request.Request(keystone.auth_url + "/auth/tokens",
+                                     data=json.dumps(body).encode('utf-8'),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        token_id = response.headers["X-Subject-Token"]
+        token = json.loads(response.read())["token"]
+    return FakeUserData(token["user"]["id"], username, token_id, token_body=token)
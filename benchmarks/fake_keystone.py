@@ -0,0 +1,289 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" In-process fake Keystone v3 server used by the benchmarks.
+
+It implements just enough of the identity API for TOTPOracle and the
+Horizon login: version discovery, token issue/validation, project and
+domain listing for the token owner, user get/update and paginated user
+list. Accepted TCP connections and requests per route are counted, and a fixed
+latency can be injected into every response. With hash_rounds, every password
+check costs a PBKDF2 hash, standing in for keystone's bcrypt; the CPU time
+spent on it is accounted in hash_cpu. With list_limit, the user list behaves
+like a keystone without paging support: limit and marker are ignored and the
+list is cut at list_limit users, with "truncated": true.
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+USER_RE = re.compile(r'^/v3/users/(?P<user_id>[^/]+)$')
+EXPIRES_AT = "2099-12-31T23:59:59.000000Z"
+ISSUED_AT = "2020-01-01T00:00:00.000000Z"
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # every accepted connection passes through here
+    def process_request(self, request, client_address):
+        self.keystone.count_connection()
+        return super(_Server, self).process_request(request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, so that connection reuse is visible
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode('utf-8') if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _dispatch(self, method):
+        keystone = self.server.keystone
+        path = urlsplit(self.path).path.rstrip('/') or '/'
+        status, body, headers = keystone.handle(method, path, self.path, self.headers,
+                                                self._body() if method in ("POST", "PATCH") else None)
+        self._reply(status, body, headers)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_HEAD(self):
+        self._dispatch("HEAD")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+
+class FakeKeystone(object):
+    # paging=False behaves like keystone itself: limit and marker are ignored and
+    # the whole user list comes back at once, cut at list_limit when it is set
+    def __init__(self, latency=0.0, page_size=100, hash_rounds=0, list_limit=None, paging=True):
+        self.latency = latency
+        self.page_size = page_size
+        self.list_limit = list_limit
+        self.paging = paging
+        self.hash_rounds = hash_rounds
+        self.hash_cpu = 0.0
+        self.users = {}
+        self.tokens = {}
+        self.connections = 0
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.keystone = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return "http://%s:%d" % (host, port)
+
+    @property
+    def auth_url(self):
+        return self.url + "/v3"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def reset_counters(self):
+        with self._lock:
+            self.connections = 0
+            self.hash_cpu = 0.0
+            self.calls.clear()
+
+    def add_user(self, name, password="secret", domain_id="default", **extra):
+        user_id = uuid.uuid4().hex
+        user = dict(id=user_id, name=name, domain_id=domain_id, enabled=True,
+                    links={"self": "%s/users/%s" % (self.auth_url, user_id)})
+        user.update(extra)
+        self.users[user_id] = (password, user)
+        return user_id
+
+    # route a request, returns (status, body, headers)
+    def handle(self, method, path, raw_path, headers, body):
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path in ("/", "/v3"):
+            route = "discovery"
+            result = self._discovery(path)
+        elif path == "/v3/auth/tokens":
+            route = "token_issue" if method == "POST" else "token_validate"
+            result = self._issue(body) if method == "POST" else self._validate(headers)
+        elif path == "/v3/auth/projects":
+            route = "auth_projects"
+            result = (200, {"projects": [self._project()], "links": {"next": None}}, {})
+        elif path == "/v3/auth/domains":
+            route = "auth_domains"
+            result = (200, {"domains": [], "links": {"next": None}}, {})
+        elif path == "/v3/users" and method == "GET":
+            route = "user_list"
+            result = self._list(raw_path)
+        else:
+            match = USER_RE.match(path)
+            if match and method == "GET":
+                route = "user_get"
+                result = self._user_get(match.group('user_id'))
+            elif match and method == "PATCH":
+                route = "user_update"
+                result = self._user_update(match.group('user_id'), body)
+            else:
+                route = "unknown"
+                result = (404, {"error": {"code": 404, "message": "not found"}}, {})
+
+        with self._lock:
+            self.calls[(method, route)] += 1
+        return result
+
+    def _version(self):
+        return {"id": "v3.14", "status": "stable", "updated": ISSUED_AT,
+                "links": [{"rel": "self", "href": self.auth_url + "/"}],
+                "media-types": [{"base": "application/json",
+                                 "type": "application/vnd.openstack.identity-v3+json"}]}
+
+    def _discovery(self, path):
+        if path == "/v3":
+            return 200, {"version": self._version()}, {}
+        return 300, {"versions": {"values": [self._version()]}}, {}
+
+    def _project(self):
+        return {"id": "project", "name": "project", "domain_id": "default", "enabled": True,
+                "domain": {"id": "default", "name": "Default"}}
+
+    def _catalog(self):
+        endpoints = [{"id": interface, "interface": interface, "region": "RegionOne",
+                      "region_id": "RegionOne", "url": self.auth_url}
+                     for interface in ("public", "internal", "admin")]
+        return [{"id": "identity", "type": "identity", "name": "keystone", "endpoints": endpoints}]
+
+    def _token(self, user):
+        return {"methods": ["password"], "expires_at": EXPIRES_AT, "issued_at": ISSUED_AT,
+                "audit_ids": [uuid.uuid4().hex],
+                "user": {"id": user["id"], "name": user["name"],
+                         "domain": {"id": user["domain_id"], "name": user["domain_id"]}},
+                "project": self._project(),
+                "roles": [{"id": "member", "name": "member"}],
+                "catalog": self._catalog()}
+
+    def _find(self, identity):
+        method = (identity.get("methods") or ["password"])[0]
+        if method == "token":
+            token = self.tokens.get(identity["token"]["id"])
+            return token and token["user"]["id"]
+        credentials = identity["password"]["user"]
+        for user_id, (password, user) in self.users.items():
+            if credentials.get("id") == user_id or credentials.get("name") == user["name"]:
+                self._hash(credentials.get("password") or "")
+                return user_id if credentials.get("password") == password else None
+        return None
+
+    # password hashing cost of a password check
+    def _hash(self, password):
+        if not self.hash_rounds:
+            return
+        start = time.thread_time()
+        hashlib.pbkdf2_hmac("sha256", password.encode('utf-8'), b"fake-keystone", self.hash_rounds)
+        with self._lock:
+            self.hash_cpu += time.thread_time() - start
+
+    def _issue(self, body):
+        user_id = self._find(body["auth"]["identity"])
+        if user_id is None:
+            return 401, {"error": {"code": 401, "message": "unauthorized"}}, {}
+        token_id = uuid.uuid4().hex
+        token = self._token(self.users[user_id][1])
+        self.tokens[token_id] = token
+        return 201, {"token": token}, {"X-Subject-Token": token_id}
+
+    def _validate(self, headers):
+        token_id = headers.get("X-Subject-Token")
+        token = self.tokens.get(token_id)
+        if token is None:
+            return 404, {"error": {"code": 404, "message": "token not found"}}, {}
+        return 200, {"token": token}, {"X-Subject-Token": token_id}
+
+    def _user_get(self, user_id):
+        if user_id not in self.users:
+            return 404, {"error": {"code": 404, "message": "user not found"}}, {}
+        return 200, {"user": self.users[user_id][1]}, {}
+
+    def _user_update(self, user_id, body):
+        if user_id not in self.users:
+            return 404, {"error": {"code": 404, "message": "user not found"}}, {}
+        self.users[user_id][1].update(body.get("user", {}))
+        return 200, {"user": self.users[user_id][1]}, {}
+
+    def _list(self, raw_path):
+        query = parse_qs(urlsplit(raw_path).query)
+        domain_id = query.get("domain_id", [None])[0]
+        marker = query.get("marker", [None])[0]
+        limit = int(query.get("limit", [self.page_size])[0])
+
+        users = sorted((user for _, user in self.users.values()
+                        if domain_id is None or user["domain_id"] == domain_id),
+                       key=lambda user: user["id"])
+        if not self.paging or self.list_limit:
+            body = {"users": users, "links": {"self": self.auth_url + "/users", "next": None}}
+            if self.list_limit:
+                body.update(users=users[:self.list_limit], truncated=len(users) > self.list_limit)
+            return 200, body, {}
+        if marker:
+            users = [user for user in users if user["id"] > marker]
+        page = users[:limit]
+
+        next_link = None
+        if len(users) > limit:
+            next_link = "%s/users?limit=%d&marker=%s" % (self.auth_url, limit, page[-1]["id"])
+            if domain_id:
+                next_link += "&domain_id=%s" % domain_id
+        return 200, {"users": page, "links": {"self": self.auth_url + "/users", "next": next_link}}, {}
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Login storm load generator.
+
+Replays a login trace through TwoFactorAuthBackend.authenticate from N worker
+processes against the fake keystone, once per worker count, and reports the
+throughput / latency curve. The trace is synthetic (a mix of enrolled and
+non-enrolled users, valid and invalid OTPs) or read from a JSON lines file
+of {"at": seconds, "username": ..., "otp": "valid" | "invalid" | "none"}
+records. Every worker replays its share as fast as it can, unless --paced
+is given, in which case the "at" offsets are honoured.
+
+--profile cprofile|tracemalloc profiles every request and keeps the slowest
+--slowest percent of them; this slows the run down, so compare curves with
+profiling off.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import pstats
+import random
+import time
+import types
+
+import common
+from fake_keystone import FakeKeystone
+
+PASSWORD = "secret"
+SEED = "JBSWY3DPEHPK3PXPJBSWY3DPEHPK3PXP"
+
+
+# synthetic trace: every user logs in once, spread over `duration` seconds
+def synthetic_trace(users, enrolled, invalid, duration, rng):
+    records = []
+    for i in range(users):
+        username = "user%06d" % i
+        if rng.random() < enrolled:
+            otp = "invalid" if rng.random() < invalid else "valid"
+        else:
+            otp = "none"
+        records.append({"at": rng.uniform(0, duration), "username": username, "otp": otp})
+    records.sort(key=lambda record: record["at"])
+    return records
+
+
+def read_trace(path):
+    with open(path) as trace:
+        return [json.loads(line) for line in trace if line.strip()]
+
+
+# keeps the `size` slowest (latency, payload) pairs
+class Slowest(object):
+    def __init__(self, size):
+        self.size = size
+        self._heap = []
+        self._order = itertools.count()
+
+    def offer(self, latency, payload_factory):
+        if self.size <= 0:
+            return
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, (latency, next(self._order), payload_factory()))
+        elif latency > self._heap[0][0]:
+            heapq.heapreplace(self._heap, (latency, next(self._order), payload_factory()))
+
+    def items(self):
+        return sorted(((latency, payload) for latency, _, payload in self._heap), reverse=True)
+
+
+# replay a share of the trace in a worker process
+def worker(index, auth_url, records, start_at, paced, profile, slowest_percent, profile_dir):
+    common.setup_horizon(types.SimpleNamespace(auth_url=auth_url),
+                         # the storm must not be throttled by the failed logins of the trace
+                         TOTP_RATELIMIT_USER_BURST=10 ** 9,
+                         TOTP_RATELIMIT_IP_BURST=10 ** 9,
+                         TOTP_RATELIMIT_ACCOUNT_BURST=10 ** 9)
+    from django.test import Client, RequestFactory
+    from openstack_auth import exceptions
+
+    from openstack_dashboard.auth.backend import TwoFactorAuthBackend
+    from openstack_dashboard.auth.verifier import get_verifier
+
+    if profile == "cprofile":
+        import cProfile
+    elif profile == "tracemalloc":
+        import tracemalloc
+        tracemalloc.start(25)
+
+    factory = RequestFactory()
+    backend = TwoFactorAuthBackend()
+    verifier = get_verifier(SEED)
+    keep = Slowest(int(len(records) * slowest_percent / 100.0 + 0.5) if profile else 0)
+    samples = []
+
+    while time.time() < start_at:
+        time.sleep(0.001)
+
+    for record in records:
+        if paced:
+            delay = start_at + record["at"] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        password = PASSWORD
+        if record["otp"] == "valid":
+            password += verifier.code(verifier.counter())
+        elif record["otp"] == "invalid":
+            password += "%06d" % ((int(verifier.code(verifier.counter())) + 1) % 1000000)
+
+        request = factory.post("/auth/login/", REMOTE_ADDR="10.%d.%d.%d" % (index, random.randint(0, 255), random.randint(1, 254)))
+        request.session = Client().session
+
+        profiler = snapshot = None
+        if profile == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+        elif profile == "tracemalloc":
+            snapshot = tracemalloc.take_snapshot()
+
+        start = time.perf_counter()
+        try:
+            backend.authenticate(request=request, username=record["username"], password=password,
+                                 user_domain_name="Default", auth_url=auth_url)
+            outcome = "ok"
+        except exceptions.KeystoneAuthException:
+            outcome = "rejected"
+        except Exception:
+            outcome = "error"
+        latency = time.perf_counter() - start
+
+        if profiler is not None:
+            profiler.disable()
+            keep.offer(latency, lambda: profiler)
+        elif snapshot is not None:
+            keep.offer(latency, lambda: [str(stat) for stat in
+                                         tracemalloc.take_snapshot().compare_to(snapshot, "lineno")[:10]])
+        samples.append((latency, outcome, record["otp"]))
+    finished = time.time()
+
+    captured = []
+    for rank, (latency, payload) in enumerate(keep.items()):
+        if profile == "cprofile":
+            path = os.path.join(profile_dir, "worker%d-slow%d.prof" % (index, rank))
+            payload.dump_stats(path)
+            captured.append({"latency_ms": latency * 1000, "profile": path})
+        else:
+            captured.append({"latency_ms": latency * 1000, "top_allocations": payload})
+    return samples, captured, finished
+
+
+def percentile(samples, fraction):
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+# one point of the curve
+def run_level(keystone, records, workers, args, profile_dir):
+    shares = [records[i::workers] for i in range(workers)]
+    # leave the workers time to import django before the storm starts
+    start_at = time.time() + args.startup
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers) as pool:
+        keystone.reset_counters()
+        pending = [pool.apply_async(worker, (index, keystone.auth_url, share, start_at, args.paced,
+                                             args.profile, args.slowest, profile_dir))
+                   for index, share in enumerate(shares)]
+        results = [result.get() for result in pending]
+    elapsed = max(finished for _, _, finished in results) - start_at
+
+    samples = sorted(sample for worker_samples, _, _ in results for sample in worker_samples)
+    latencies = [latency for latency, _, _ in samples]
+    outcomes = {}
+    for _, outcome, otp in samples:
+        key = "%s/%s" % (otp, outcome)
+        outcomes[key] = outcomes.get(key, 0) + 1
+
+    return {"workers": workers,
+            "requests": len(samples),
+            "throughput": len(samples) / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p90_ms": percentile(latencies, 0.90) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": latencies[-1] * 1000,
+            "outcomes": outcomes,
+            "keystone_calls_per_login": sum(keystone.calls.values()) / float(len(samples)),
+            "slowest": [capture for _, captures, _ in results for capture in captures]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trace', default=None, metavar='<jsonl>', help='recorded trace to replay')
+    parser.add_argument('--save-trace', default=None, metavar='<jsonl>', help='write the synthetic trace here')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--enrolled', type=float, default=0.7, help='fraction of enrolled users')
+    parser.add_argument('--invalid', type=float, default=0.05, help='fraction of invalid otps for enrolled users')
+    parser.add_argument('--duration', type=float, default=60.0, help='synthetic trace length, seconds')
+    parser.add_argument('--paced', action='store_true',
+                        help='honour the trace timestamps instead of replaying as fast as possible')
+    parser.add_argument('--workers', default='1,2,4,8')
+    parser.add_argument('--latency', type=float, default=0.02, help='keystone latency, seconds')
+    parser.add_argument('--startup', type=float, default=5.0, help='seconds given to workers to start')
+    parser.add_argument('--profile', default=None, choices=('cprofile', 'tracemalloc'))
+    parser.add_argument('--slowest', type=float, default=1.0, help='percent of requests to keep profiles for')
+    parser.add_argument('--profile-dir', default='load_profiles')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='load_login.json')
+    args = parser.parse_args()
+
+    if args.trace:
+        records = read_trace(args.trace)
+    else:
+        records = synthetic_trace(args.users, args.enrolled, args.invalid, args.duration, random.Random(args.seed))
+        if args.save_trace:
+            with open(args.save_trace, "w") as trace:
+                for record in records:
+                    trace.write(json.dumps(record) + "\n")
+
+    enrolled = set(record["username"] for record in records if record["otp"] != "none")
+    curve = []
+    with FakeKeystone(latency=args.latency) as keystone:
+        for username in set(record["username"] for record in records):
+            keystone.add_user(username, password=PASSWORD, email="%s@example.com" % username,
+                              totp_key=SEED if username in enrolled else "")
+
+        for workers in [int(w) for w in args.workers.split(',')]:
+            profile_dir = os.path.join(args.profile_dir, "workers%d" % workers)
+            if args.profile:
+                os.makedirs(profile_dir, exist_ok=True)
+            point = run_level(keystone, records, workers, args, profile_dir)
+            curve.append(point)
+            print("workers %3d  %8.1f logins/s  p50 %8.2f ms  p90 %8.2f ms  p99 %8.2f ms  keystone %.2f/login  %s"
+                  % (workers, point["throughput"], point["p50_ms"], point["p90_ms"], point["p99_ms"],
+                     point["keystone_calls_per_login"], point["outcomes"]))
+
+            if args.profile == "cprofile" and point["slowest"]:
+                stats = pstats.Stats(*[capture["profile"] for capture in point["slowest"]])
+                stats.dump_stats(os.path.join(profile_dir, "slowest.prof"))
+                stats.sort_stats("cumulative").print_stats(15)
+
+    with open(args.output, "w") as output:
+        json.dump({"trace": args.trace or "synthetic", "requests": len(records),
+                   "keystone_latency": args.latency, "paced": args.paced, "curve": curve},
+                  output, indent=2, sort_keys=True)
+    print("results saved to %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+#   Two Factor Auth (TOTP) enrollment audit
+#
+#   Streams every user of a domain (or of the whole cloud) from keystone, one
+#   page at a time, and writes one CSV or JSON lines record per user with its
+#   TOTP enrollment state. Seeds are never written out. Aggregate counts are
+#   printed on stderr at the end. Memory use does not depend on the number of
+#   users. Enrollment is read from the configured seed store (TOTP_SEED_BACKEND)
+#   as it is, one batch of users at a time for the sqlite store. Seeds are not
+#   decrypted: an encrypted seed whose key version is not configured is
+#   reported on its user's record, and the audit goes on.
+#
+
+import sys
+import csv
+import json
+from itertools import islice
+
+# import horizon totp plugin libraries
+from openstack_dashboard.auth import seed_crypto
+from openstack_dashboard.auth.seed_store import SEED_STORE
+from openstack_dashboard.auth.totp_oracle import EMAIL_ATTRIBUTE
+from openstack_dashboard.management.commands.totp_disable import TOTPBaseCommand
+
+FIELDS = ("user_id", "name", "domain_id", "enrolled", "key", "seed", "email")
+# users whose stored values are read at once
+BATCH_SIZE = 500
+
+
+# form of a stored seed, told from its prefix: "plain", "encrypted" or "unknown_key"
+# (encrypted under a key version that is not configured), None when there is none
+def seed_status(value):
+    if not value:
+        return None
+    try:
+        version = seed_crypto.key_version(value)
+    except ValueError:
+        return "unknown_key"
+    if version is None:
+        return "plain"
+    return "encrypted" if version in seed_crypto.KEYRING.secrets else "unknown_key"
+
+
+# audit record for a raw keystone user document, given the stored values of its batch
+def audit_record(user, stored):
+    value = stored.get(user["id"])
+    if value:
+        key = "set"
+    elif user["id"] in stored:
+        key = "empty"
+    else:
+        key = "missing"
+
+    return {"user_id": user["id"],
+            "name": user.get("name"),
+            "domain_id": user.get("domain_id"),
+            "enrolled": bool(value),
+            "key": key,
+            "seed": seed_status(value),
+            "email": user.get(EMAIL_ATTRIBUTE) or None}
+
+
+# running aggregate counts
+class AuditTotals(object):
+    def __init__(self):
+        self.counts = dict.fromkeys(("users", "enrolled", "not_enrolled", "empty_key", "unknown_key",
+                                     "missing_email", "enrolled_missing_email"), 0)
+
+    def add(self, record):
+        self.counts["users"] += 1
+        self.counts["enrolled" if record["enrolled"] else "not_enrolled"] += 1
+        if record["key"] == "empty":
+            self.counts["empty_key"] += 1
+        if record["seed"] == "unknown_key":
+            self.counts["unknown_key"] += 1
+        if record["email"] is None:
+            self.counts["missing_email"] += 1
+            if record["enrolled"]:
+                self.counts["enrolled_missing_email"] += 1
+
+
+class Command(TOTPBaseCommand):
+    help = "Stream the TOTP enrollment state of every user of a domain"
+
+    # generator pipeline: keystone pages -> batches with their stored values -> records
+    # -> output, updating totals on the way
+    def audit(self, oracle, out, domain=None, fmt="jsonl", page_size=None, store=None):
+        store = SEED_STORE if store is None else store
+        totals = AuditTotals()
+        kwargs = {"page_size": page_size} if page_size else {}
+        users = oracle.users_iter(domain_id=domain, **kwargs)
+
+        def records():
+            while True:
+                batch = list(islice(users, BATCH_SIZE))
+                if not batch:
+                    return
+                stored = store.stored_values(batch)
+                for user in batch:
+                    yield audit_record(user, stored)
+
+        if fmt == "csv":
+            writer = csv.DictWriter(out, fieldnames=FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            write = lambda record: out.write(json.dumps(record) + "\n")
+
+        for record in records():
+            totals.add(record)
+            write(record)
+
+        out.flush()
+        return totals.counts
+
+    def add_arguments(self, parser):
+        self.add_auth_arguments(parser)
+
+        parser.add_argument('--domain',
+                            metavar='<domain_id>',
+                            default=None,
+                            help='Audit the users of this domain id only')
+
+        parser.add_argument('--format',
+                            default='jsonl',
+                            choices=('jsonl', 'csv'),
+                            help='Output format (default: jsonl)')
+
+        parser.add_argument('--output',
+                            metavar='<file>',
+                            default='-',
+                            help='Where to write the records. Defaults to stdout.')
+
+        parser.add_argument('--page-size',
+                            metavar='<users>',
+                            type=int,
+                            default=None,
+                            help='Users fetched per keystone request')
+
+    def handle(self, *args, **options):
+        self.conn_values_check(options)
+        oracle = self.get_oracle(options)
+
+        out = sys.stdout if options.get('output') == '-' else open(options.get('output'), 'w', newline='')
+        try:
+            totals = self.audit(oracle, out,
+                                domain=options.get('domain'),
+                                fmt=options.get('format'),
+                                page_size=options.get('page_size'))
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+        sys.stderr.write("%s\n" % json.dumps(totals))
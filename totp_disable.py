@@ -2,16 +2,26 @@
 #
 #   Two Factor Auth (TOTP) Command line interface
 #
+#   Enables, disables or reports TOTP for one or many users. User ids are taken
+#   from --user-id or streamed from a file (or stdin), one per line, optionally
+#   followed by a seed for the enable action. Users are processed concurrently
+#   over a single authenticated keystone session and results are written as
+#   JSON lines.
 #
 
 import os
 import sys
+import json
 import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 from django.core.management import base
 
+# import python-otp-lib, TOTP
+from rfc6238 import totp
+
 # import horizon totp plugin libraries
-from openstack_dashboard.auth.totp_oracle import TOTPOracle
+from openstack_dashboard.auth.totp_oracle import TOTPOracle, TOTPUserState
 from openstack_dashboard.auth.exception import IllegalArgument
 
 # check current environment for specific keys
@@ -24,7 +34,8 @@ def env(*vars, **kwargs):
     return kwargs.get('default', '')
 
 
-class Command(base.BaseCommand):
+# keystone admin credentials handling shared by the totp management commands
+class TOTPBaseCommand(base.BaseCommand):
     def __init__(self, parser_class=argparse.ArgumentParser):
         self.parser_class = parser_class
 
@@ -44,24 +55,22 @@ class Command(base.BaseCommand):
 
         return True
 
-    def disable(self, options):
+    # one authenticated oracle, shared by all the worker threads
+    def get_oracle(self, options):
         os_password = options.get('os_password')
         os_auth_url = options.get('os_auth_url')
         os_username = options.get('os_username')
-        project_name = options.get('project_name')
-        project_domain_name = options.get('project_domain_name')
-        user_domain_name = options.get('user_domain_name')
         if not (os_auth_url and os_password and os_username):
             raise IllegalArgument("Username, password and auth url are required")
 
-        user_id = options.get('user_id')
-        if not (os_auth_url and os_password and os_username):
-            raise IllegalArgument("User id is required")
-
-        token_oracle = TOTPOracle(auth_url=os_auth_url, username=os_username, password=os_password, project_name=project_name, project_domain_name=project_domain_name, user_domain_name=user_domain_name)
-        token_oracle.disable(user_id)
+        return TOTPOracle(auth_url=os_auth_url,
+                          username=os_username,
+                          password=os_password,
+                          project_name=options.get('project_name'),
+                          project_domain_name=options.get('project_domain_name'),
+                          user_domain_name=options.get('user_domain_name'))
 
-    def add_arguments(self, parser):
+    def add_auth_arguments(self, parser):
         parser.add_argument('--os-username',
                             metavar='<auth-user-name>',
                             default=env('OS_USERNAME'),
@@ -101,17 +110,136 @@ class Command(base.BaseCommand):
                             help='Admin user domain name'
                                  'Defaults to env[OS_USER_DOMAIN_NAME].')
 
+
+class Command(TOTPBaseCommand):
+    help = "Enable, disable or show TOTP for one or many users"
+
+    # yield (user_id, seed) pairs from --user-id or from the input stream
+    def read_users(self, options):
+        if options.get('user_id'):
+            yield options.get('user_id'), None
+            return
+
+        source = options.get('input')
+        stream = sys.stdin if source == '-' else open(source)
+        try:
+            for line in stream:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                yield fields[0], (fields[1] if len(fields) > 1 else None)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+    # run one action for one user, returns the result record
+    def process(self, oracle, action, user_id, seed, domain):
+        result = {"user_id": user_id, "action": action}
+        try:
+            if domain or action == 'status':
+                user = oracle.user_get(user_id)
+                if domain and getattr(user, 'domain_id', None) != domain:
+                    result["status"] = "skipped"
+                    return result
+                state = TOTPUserState.from_user(user)
+
+            if action == 'disable':
+                oracle.disable(user_id)
+                result["enabled"] = False
+            elif action == 'enable':
+                new_seed = seed
+                if not new_seed:
+                    new_seed = totp.get_random_base32_key(byte_key=16)
+                    if not isinstance(new_seed, str):
+                        new_seed = new_seed.decode('utf-8')
+                    # a generated seed has to be handed to the user
+                    result["seed"] = new_seed
+                oracle.set_key(user_id, new_seed)
+                result["enabled"] = True
+            else:
+                result["enabled"] = state.enabled
+                result["email"] = state.email
+
+            result["status"] = "ok"
+        except Exception as e:
+            result["status"] = "error"
+            result["error"] = str(e)
+        return result
+
+    # process a stream of users over a bounded thread pool, writing results as they complete
+    def run(self, oracle, options, users, out):
+        action = options.get('action')
+        domain = options.get('domain')
+        concurrency = max(1, options.get('concurrency'))
+        totals = {}
+
+        def write(future):
+            result = future.result()
+            totals[result["status"]] = totals.get(result["status"], 0) + 1
+            out.write(json.dumps(result) + "\n")
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = set()
+            for user_id, seed in users:
+                pending.add(executor.submit(self.process, oracle, action, user_id, seed, domain))
+                # keep a bounded number of users in flight
+                if len(pending) >= concurrency * 4:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        write(future)
+            for future in pending:
+                write(future)
+
+        out.flush()
+        return totals
+
+    def add_arguments(self, parser):
+        parser.add_argument('action',
+                            nargs='?',
+                            default='disable',
+                            choices=('disable', 'enable', 'status'),
+                            help='Action to run for every user (default: disable)')
+
+        self.add_auth_arguments(parser)
+
         parser.add_argument('--user-id',
                             metavar='<user_id>',
                             default=None,
                             help='Specify the user id for which TOTP must be disabled')
 
-    def handle(self, *args, **options):
-        print(options)
-        self.conn_values_check(options)
-        if options.get('user_id') is not None:
-            self.disable(options)
-        else:
-            print("syntax error: user-id is missing")
+        parser.add_argument('--input',
+                            metavar='<file>',
+                            default='-',
+                            help='File with one user id per line, optionally followed by '
+                                 'a seed for the enable action. Defaults to stdin.')
+
+        parser.add_argument('--output',
+                            metavar='<file>',
+                            default='-',
+                            help='Where to write the JSON lines results. Defaults to stdout.')
 
+        parser.add_argument('--domain',
+                            metavar='<domain_id>',
+                            default=None,
+                            help='Only process users belonging to this domain id')
+
+        parser.add_argument('--concurrency',
+                            metavar='<workers>',
+                            type=int,
+                            default=8,
+                            help='Number of users processed in parallel')
 
+    def handle(self, *args, **options):
+        self.conn_values_check(options)
+        oracle = self.get_oracle(options)
+        # authenticate once, before the workers share the session
+        oracle.ks_session.get_token()
+
+        out = sys.stdout if options.get('output') == '-' else open(options.get('output'), 'w')
+        try:
+            totals = self.run(oracle, options, self.read_users(options), out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+        sys.stderr.write("%s\n" % json.dumps(totals))
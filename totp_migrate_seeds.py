@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+#   Two Factor Auth (TOTP) seed migration
+#
+#   Streams every user of a domain (or of the whole cloud) from keystone, one
+#   page at a time, and copies the seeds found in the totp_key attribute into
+#   the local SQLite seed store, in batches of one transaction each. Users
+#   that already have a seed in the store keep it: once Horizon uses the store,
+#   a seed enrolled there is newer than the keystone copy. With
+#   --clear-keystone the attribute is blanked once the store is found to hold
+#   a seed for the user, so that keystone no longer holds a copy; this is
+#   refused unless TOTP_SEED_BACKEND is already "sqlite" on that same file, as
+#   the seeds would otherwise be lost to Horizon. Counts are printed on stderr
+#   at the end. Run it before switching TOTP_SEED_BACKEND to "sqlite" (and
+#   again with --clear-keystone after).
+#
+
+import os
+import sys
+import json
+from itertools import islice
+
+# import horizon totp plugin libraries
+from openstack_dashboard.auth.seed_store import SEED_SQLITE_PATH, SEED_STORE, SQLiteSeedStore
+from openstack_dashboard.auth.totp_oracle import TOTP_KEY_ATTRIBUTE
+from openstack_dashboard.management.commands.totp_disable import TOTPBaseCommand
+
+
+class Command(TOTPBaseCommand):
+    help = "Copy the TOTP seeds stored in keystone into the local SQLite seed store"
+
+    # generator pipeline: keystone pages -> enrolled users -> batches -> sqlite
+    def migrate(self, oracle, store, domain=None, page_size=None, batch_size=500, clear_keystone=False, dry_run=False):
+        totals = dict.fromkeys(("users", "migrated", "kept", "cleared", "clear_failed", "verify_failed"), 0)
+        kwargs = {"page_size": page_size} if page_size else {}
+
+        def enrolled():
+            for user in oracle.users_iter(domain_id=domain, **kwargs):
+                totals["users"] += 1
+                key = user.get(TOTP_KEY_ATTRIBUTE)
+                if key:
+                    yield user["id"], key
+
+        pairs = enrolled()
+        while True:
+            batch = list(islice(pairs, batch_size))
+            if not batch:
+                break
+            if dry_run:
+                migrated = len(batch) - len(store.get_raw(user_id for user_id, key in batch))
+            else:
+                migrated = store.import_keys(batch)
+            totals["migrated"] += migrated
+            totals["kept"] += len(batch) - migrated
+
+            # keystone copies are removed only for the users the store holds a seed for,
+            # copied now or kept from an earlier run or enrollment
+            if clear_keystone and not dry_run:
+                stored = store.get_raw(user_id for user_id, key in batch)
+                for user_id, key in batch:
+                    if not stored.get(user_id):
+                        totals["verify_failed"] += 1
+                        sys.stderr.write("seed of user %s not found in the store, keystone copy kept\n" % user_id)
+                        continue
+                    try:
+                        oracle.user_update(user_id, **{TOTP_KEY_ATTRIBUTE: ""})
+                        totals["cleared"] += 1
+                    except Exception as e:
+                        totals["clear_failed"] += 1
+                        sys.stderr.write("cannot clear the seed of user %s: %s\n" % (user_id, e))
+
+        return totals
+
+    def add_arguments(self, parser):
+        self.add_auth_arguments(parser)
+
+        parser.add_argument('--domain',
+                            metavar='<domain_id>',
+                            default=None,
+                            help='Migrate the users of this domain id only')
+
+        parser.add_argument('--path',
+                            metavar='<file>',
+                            default=SEED_SQLITE_PATH,
+                            help='SQLite seed store. Defaults to TOTP_SEED_SQLITE_PATH.')
+
+        parser.add_argument('--page-size',
+                            metavar='<users>',
+                            type=int,
+                            default=None,
+                            help='Users fetched per keystone request')
+
+        parser.add_argument('--batch-size',
+                            metavar='<seeds>',
+                            type=int,
+                            default=500,
+                            help='Seeds written per SQLite transaction')
+
+        parser.add_argument('--clear-keystone',
+                            action='store_true',
+                            default=False,
+                            help='Blank the keystone attribute of every migrated user')
+
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            default=False,
+                            help='Count the seeds to migrate, write nothing')
+
+    def handle(self, *args, **options):
+        if options.get('clear_keystone'):
+            # the keystone copy is the only one Horizon reads until it uses this very file
+            if not SEED_STORE.local or os.path.realpath(SEED_STORE.pool.path) != os.path.realpath(options.get('path')):
+                raise ValueError('--clear-keystone needs TOTP_SEED_BACKEND = "sqlite" with TOTP_SEED_SQLITE_PATH = %s'
+                                 % options.get('path'))
+        self.conn_values_check(options)
+        oracle = self.get_oracle(options)
+        store = SQLiteSeedStore(path=options.get('path'), pool_size=1)
+
+        totals = self.migrate(oracle, store,
+                              domain=options.get('domain'),
+                              page_size=options.get('page_size'),
+                              batch_size=max(1, options.get('batch_size')),
+                              clear_keystone=options.get('clear_keystone'),
+                              dry_run=options.get('dry_run'))
+        if not options.get('dry_run'):
+            totals["stored"] = store.count()
+
+        sys.stderr.write("%s\n" % json.dumps(totals))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+#   Two Factor Auth (TOTP) seed key rotation
+#
+#   Re-encrypts every stored TOTP seed under the current key version
+#   (TOTP_SEED_KEY_VERSION), and encrypts the seeds still stored in clear.
+#   Enrolled users are streamed from the seed store in user id order and
+#   re-encrypted over a bounded thread pool; seeds already under the current
+#   key are skipped. Progress is printed on stderr as JSON lines. With
+#   --state-file, the last user id up to which every user is done is saved as
+#   the job goes, and a new run starts after it. Keep the old key versions in
+#   TOTP_SEED_KEYS until the job has completed.
+#
+
+import os
+import sys
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# import horizon totp plugin libraries
+from openstack_dashboard.auth import seed_crypto
+from openstack_dashboard.auth.seed_store import SEED_STORE
+from openstack_dashboard.management.commands.totp_disable import TOTPBaseCommand
+
+
+# checkpoint of a rotation job: totals and the user id up to which every user is done
+class RotationState(object):
+    def __init__(self, path=None):
+        self.path = path
+        self.marker = None
+        self.totals = dict.fromkeys(("users", "rotated", "current", "changed", "error"), 0)
+        if path and os.path.exists(path):
+            with open(path) as stream:
+                saved = json.load(stream)
+            self.marker = saved.get("marker")
+            self.totals.update(saved.get("totals", {}))
+
+    # written to a temporary file first, so that an interrupted job never leaves a torn state
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path + ".tmp", "w") as stream:
+            json.dump({"marker": self.marker, "totals": self.totals}, stream)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class Command(TOTPBaseCommand):
+    help = "Re-encrypt the stored TOTP seeds under the current seed key version"
+
+    # re-encrypt one stored value, returns the outcome
+    def rotate_one(self, store, oracle, user_id, value, dry_run=False):
+        if seed_crypto.is_current(value):
+            return "current"
+        try:
+            rotated = seed_crypto.encrypt_seed(user_id, seed_crypto.decrypt_seed(user_id, value))
+            if dry_run:
+                return "rotated"
+            # sqlite only replaces the value it read: an enable since then wins
+            return "rotated" if store.put_raw(oracle, user_id, rotated, value) else "changed"
+        except Exception as e:
+            sys.stderr.write("cannot rotate the seed of user %s: %s\n" % (user_id, e))
+            return "error"
+
+    # stream of enrolled users -> bounded pool of workers, with periodic progress and checkpoints
+    def rotate(self, store, oracle, state, domain=None, concurrency=8, progress_interval=10.0,
+               dry_run=False, out=sys.stderr):
+        totals = state.totals
+        start = last_report = time.monotonic()
+        done_at_start = totals["users"]
+        # futures in submission (user id) order, to move the checkpoint past completed users only
+        in_order = deque()
+
+        def report(final=False):
+            elapsed = time.monotonic() - start
+            record = dict(totals, marker=state.marker, elapsed=round(elapsed, 1),
+                          users_per_s=round((totals["users"] - done_at_start) / elapsed, 1) if elapsed else 0.0)
+            if final:
+                record["done"] = True
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            state.save()
+
+        def collect(block):
+            nonlocal last_report
+            while in_order and (block or in_order[0][1].done()):
+                user_id, future = in_order.popleft()
+                outcome = future.result()
+                totals["users"] += 1
+                totals[outcome] += 1
+                state.marker = user_id
+            if time.monotonic() - last_report >= progress_interval:
+                last_report = time.monotonic()
+                report()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = set()
+            for user_id, value in store.iter_raw(oracle, domain_id=domain, marker=state.marker):
+                future = executor.submit(self.rotate_one, store, oracle, user_id, value, dry_run)
+                in_order.append((user_id, future))
+                pending.add(future)
+                # keep a bounded number of users in flight
+                if len(pending) >= concurrency * 4:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(False)
+            wait(pending)
+            collect(True)
+
+        report(final=True)
+        return totals
+
+    def add_arguments(self, parser):
+        self.add_auth_arguments(parser)
+
+        parser.add_argument('--domain',
+                            metavar='<domain_id>',
+                            default=None,
+                            help='Rotate the seeds of the users of this domain id only (keystone store)')
+
+        parser.add_argument('--concurrency',
+                            metavar='<workers>',
+                            type=int,
+                            default=8,
+                            help='Number of users processed in parallel')
+
+        parser.add_argument('--state-file',
+                            metavar='<file>',
+                            default=None,
+                            help='Checkpoint file: resume from it if it exists, update it as the job goes')
+
+        parser.add_argument('--progress-interval',
+                            metavar='<seconds>',
+                            type=float,
+                            default=10.0,
+                            help='Seconds between progress records')
+
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            default=False,
+                            help='Count the seeds to rotate, write nothing')
+
+    def handle(self, *args, **options):
+        oracle = None
+        if not SEED_STORE.local:
+            self.conn_values_check(options)
+            oracle = self.get_oracle(options)
+            # authenticate once, before the workers share the session
+            oracle.ks_session.get_token()
+
+        state = RotationState(options.get('state_file'))
+        if options.get('dry_run'):
+            # a dry run must not move the checkpoint of the real job
+            state.path = None
+        if state.marker:
+            sys.stderr.write("resuming after user %s\n" % state.marker)
+        self.rotate(SEED_STORE, oracle, state,
+                    domain=options.get('domain'),
+                    concurrency=max(1, options.get('concurrency')),
+                    progress_interval=options.get('progress_interval'),
+                    dry_run=options.get('dry_run'))